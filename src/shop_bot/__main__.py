@@ -105,6 +105,7 @@ def main():
     # Импортируем модули, которые косвенно тянут handlers.py, только после инициализации БД
     from shop_bot.bot_controller import BotController
     from shop_bot.webhook_server.app import create_webhook_app
+    from shop_bot.webhook_server import serving, event_bus
     from shop_bot.data_manager.scheduler import periodic_subscription_check
 
     bot_controller = BotController()
@@ -115,6 +116,10 @@ def main():
         if bot_controller.get_status()["is_running"]:
             bot_controller.stop()
             await asyncio.sleep(2)
+        # Закрываем потоки событий панели, иначе они держат рабочие потоки до своего таймаута
+        event_bus.shutdown()
+        # Даём текущим HTTP-запросам (в т.ч. платёжным вебхукам) доработать, новые соединения не принимаем
+        await asyncio.to_thread(serving.stop)
         tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
         if tasks:
             [task.cancel() for task in tasks]
@@ -131,12 +136,11 @@ def main():
                 loop.add_signal_handler(sig, lambda sig=sig: asyncio.create_task(shutdown(sig, loop)))
         
         flask_thread = threading.Thread(
-            target=lambda: flask_app.run(host='0.0.0.0', port=1488, use_reloader=False, debug=False),
+            target=lambda: serving.serve(flask_app, host='0.0.0.0', port=1488),
+            name="http-server",
             daemon=True
         )
         flask_thread.start()
-        
-        logger.info("Flask-сервер запущен: http://0.0.0.0:1488")
             
         logger.info("Приложение запущено. Бота можно стартовать из веб-панели.")
         
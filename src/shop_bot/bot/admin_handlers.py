@@ -15,10 +15,11 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from shop_bot.bot import keyboards
+from shop_bot.bot import message_dispatcher
+from shop_bot.bot import broadcast_engine
 from shop_bot.data_manager import speedtest_runner
 from shop_bot.data_manager import resource_monitor, database
 from shop_bot.data_manager.database import (
-    get_all_users,
     get_setting,
     get_user,
     get_keys_for_user,
@@ -53,6 +54,8 @@ from shop_bot.modules.xui_api import create_or_update_key_on_host, delete_client
 logger = logging.getLogger(__name__)
 
 class Broadcast(StatesGroup):
+    waiting_for_segment = State()
+    waiting_for_segment_param = State()
     waiting_for_message = State()
     waiting_for_button_option = State()
     waiting_for_button_text = State()
@@ -328,7 +331,7 @@ def get_admin_router() -> Router:
         start_text = f"🚀 Запущен тест скорости для хоста: <b>{host_name}</b>\n(инициатор: {initiator})"
         for aid in admin_ids:
             try:
-                await callback.bot.send_message(aid, start_text)
+                await message_dispatcher.send_message(callback.bot, aid, start_text, priority=message_dispatcher.PRIORITY_ALERT)
             except Exception:
                 pass
 
@@ -381,7 +384,7 @@ def get_admin_router() -> Router:
             if wait_msg and aid == callback.from_user.id:
                 continue
             try:
-                await callback.bot.send_message(aid, text_res)
+                await message_dispatcher.send_message(callback.bot, aid, text_res, priority=message_dispatcher.PRIORITY_ALERT)
             except Exception:
                 pass
 
@@ -411,31 +414,20 @@ def get_admin_router() -> Router:
         start_text = f"🚀 Запущен тест скорости для всех хостов\n(инициатор: {initiator})"
         for aid in admin_ids:
             try:
-                await callback.bot.send_message(aid, start_text)
+                await message_dispatcher.send_message(callback.bot, aid, start_text, priority=message_dispatcher.PRIORITY_ALERT)
             except Exception:
                 pass
-        # пробежимся по хостам
+        # тестируем хосты параллельно, результаты пишутся в БД по мере готовности
         hosts = get_all_hosts() or []
-        summary_lines = []
-        for h in hosts:
-            name = h.get('host_name')
-            try:
-                res = await speedtest_runner.run_both_for_host(name)
-                ok = res.get('ok')
-                det = res.get('details') or {}
-                dm = det.get('ssh', {}).get('download_mbps') or det.get('net', {}).get('download_mbps')
-                um = det.get('ssh', {}).get('upload_mbps') or det.get('net', {}).get('upload_mbps')
-                summary_lines.append(f"• {name}: {'✅' if ok else '❌'} ↓ {dm or '—'} ↑ {um or '—'}")
-            except Exception as e:
-                summary_lines.append(f"• {name}: ❌ {e}")
-        text = "🏁 Тест для всех завершён:\n" + "\n".join(summary_lines)
+        summary = await speedtest_runner.run_speedtests_for_hosts([h.get('host_name') for h in hosts])
+        text = speedtest_runner.format_speedtest_summary(summary)
         await callback.message.answer(text)
         for aid in admin_ids:
             # Не дублируем результат инициатору/в текущий чат
             if aid == callback.from_user.id or aid == callback.message.chat.id:
                 continue
             try:
-                await callback.bot.send_message(aid, text)
+                await message_dispatcher.send_message(callback.bot, aid, text, priority=message_dispatcher.PRIORITY_ALERT)
             except Exception:
                 pass
 
@@ -1109,18 +1101,81 @@ def get_admin_router() -> Router:
             await callback.answer("У вас нет прав.", show_alert=True)
             return
         await callback.answer()
-        users = get_all_users()
-        page = 0
+        token = "0"
         if callback.data.startswith("admin_users_page_"):
-            try:
-                page = int(callback.data.split("_")[-1])
-            except Exception:
-                page = 0
+            token = callback.data[len("admin_users_page_"):] or "0"
+        await _show_users_picker(callback.message, state, "list", token)
+
+    _USERS_PICKER_TITLES = {
+        "list": "👥 <b>Пользователи</b>",
+        "gift": "🎁 Выдача подарочного ключа\n\nВыберите пользователя:",
+        "add_balance": "➕ Начисление баланса\n\nВыберите пользователя:",
+        "deduct_balance": "➖ Списание баланса\n\nВыберите пользователя:",
+    }
+
+    async def _show_users_picker(message: types.Message, state: FSMContext, scope: str, token: str = "0", edit: bool = True):
+        """Страница списка пользователей из БД по курсору (и поисковому запросу из FSM).
+        token: "0" — первая страница со сбросом поиска, "s" — первая страница текущего поиска, n{id}/p{id} — курсор.
+        """
+        if token == "0":
+            await state.update_data(users_query=None)
+            query = None
+        else:
+            query = (await state.get_data()).get('users_query')
+        cursor = None if token in ("0", "s") else token
+        users, prev_cursor, next_cursor = await asyncio.to_thread(database.get_users_keyset, cursor, 10, query)
+        text = _USERS_PICKER_TITLES.get(scope, _USERS_PICKER_TITLES["list"])
+        if query:
+            text += f"\n🔍 Поиск: <code>{html_escape.escape(query)}</code>"
+        if not users:
+            text += "\n\nНикого не найдено."
+        if scope == "list":
+            kb = keyboards.create_admin_users_keyboard(users, prev_cursor, next_cursor, query_active=bool(query))
+        else:
+            kb = keyboards.create_admin_users_pick_keyboard(users, prev_cursor, next_cursor, action=scope, query_active=bool(query))
+        if edit:
+            await message.edit_text(text, reply_markup=kb)
+        else:
+            await message.answer(text, reply_markup=kb)
+
+    class AdminUserSearch(StatesGroup):
+        waiting_for_query = State()
+
+    @admin_router.callback_query(F.data.startswith("admin_find_user:"))
+    async def admin_find_user_prompt(callback: types.CallbackQuery, state: FSMContext):
+        if not is_admin(callback.from_user.id):
+            await callback.answer("У вас нет прав.", show_alert=True)
+            return
+        scope = callback.data.split(":", 1)[1]
+        if scope not in _USERS_PICKER_TITLES:
+            await callback.answer()
+            return
+        await callback.answer()
+        await state.update_data(users_search_scope=scope)
+        await state.set_state(AdminUserSearch.waiting_for_query)
         await callback.message.edit_text(
-            "👥 <b>Пользователи</b>",
-            reply_markup=keyboards.create_admin_users_keyboard(users, page=page)
+            "🔍 Введите ID пользователя или часть username:",
+            reply_markup=keyboards.create_admin_cancel_keyboard()
         )
 
+    @admin_router.message(AdminUserSearch.waiting_for_query)
+    async def admin_find_user_query(message: types.Message, state: FSMContext):
+        if not is_admin(message.from_user.id):
+            return
+        query = (message.text or '').strip().lstrip('@')[:64]
+        if not query:
+            await message.answer("❌ Пустой запрос. Введите ID или username.")
+            return
+        data = await state.get_data()
+        scope = data.get('users_search_scope') or "list"
+        await state.update_data(users_query=query)
+        # Возвращаемся в состояние, в котором работают кнопки выбора пользователя
+        if scope == "gift":
+            await state.set_state(AdminGiftKey.picking_user)
+        else:
+            await state.set_state(None)
+        await _show_users_picker(message, state, scope, "s", edit=False)
+
     @admin_router.callback_query(F.data.startswith("admin_view_user_"))
     async def admin_view_user_handler(callback: types.CallbackQuery):
         if not is_admin(callback.from_user.id):
@@ -1203,10 +1258,11 @@ def get_admin_router() -> Router:
                     kb.button(text="🆘 Написать в поддержку", url=url)
                 else:
                     kb.button(text="🆘 Поддержка", callback_data="show_help")
-                await callback.bot.send_message(
-                    user_id,
+                await message_dispatcher.send_message(
+                    callback.bot, user_id,
                     "🚫 Ваш аккаунт заблокирован администратором. Если это ошибка — напишите в поддержку.",
-                    reply_markup=kb.as_markup()
+                    reply_markup=kb.as_markup(),
+                    priority=message_dispatcher.PRIORITY_ALERT,
                 )
             except Exception:
                 pass
@@ -1311,10 +1367,11 @@ def get_admin_router() -> Router:
                 # Отправляем пользователю уведомление о разбане с кнопкой в главное меню
                 kb = InlineKeyboardBuilder()
                 kb.row(keyboards.get_main_menu_button())
-                await callback.bot.send_message(
-                    user_id,
+                await message_dispatcher.send_message(
+                    callback.bot, user_id,
                     "✅ Доступ к аккаунту восстановлен администратором.",
-                    reply_markup=kb.as_markup()
+                    reply_markup=kb.as_markup(),
+                    priority=message_dispatcher.PRIORITY_ALERT,
                 )
             except Exception:
                 pass
@@ -1608,13 +1665,9 @@ def get_admin_router() -> Router:
             # 3) Фолбэк: ищем пользователя в локальной БД по username
             if target_id is None:
                 try:
-                    users = get_all_users() or []
-                    uname_low = uname.lower()
-                    for u in users:
-                        u_un = (u.get('username') or '').lstrip('@').lower()
-                        if u_un and u_un == uname_low:
-                            target_id = int(u.get('telegram_id') or u.get('user_id') or u.get('id'))
-                            break
+                    found = database.get_user_by_username(uname)
+                    if found:
+                        target_id = int(found.get('telegram_id'))
                 except Exception:
                     target_id = None
         if target_id is None:
@@ -1686,13 +1739,9 @@ def get_admin_router() -> Router:
             # 3) Фолбэк: поиск в БД
             if target_id is None and uname:
                 try:
-                    users = get_all_users() or []
-                    uname_low = uname.lower()
-                    for u in users:
-                        u_un = (u.get('username') or '').lstrip('@').lower()
-                        if u_un and u_un == uname_low:
-                            target_id = int(u.get('telegram_id') or u.get('user_id') or u.get('id'))
-                            break
+                    found = database.get_user_by_username(uname)
+                    if found:
+                        target_id = int(found.get('telegram_id'))
                 except Exception:
                     target_id = None
         if target_id is None:
@@ -1823,8 +1872,8 @@ def get_admin_router() -> Router:
                 )
             # Уведомление пользователю (если получится)
             try:
-                await callback.bot.send_message(
-                    user_id,
+                await message_dispatcher.send_message(
+                    callback.bot, user_id,
                     "ℹ️ Администратор удалил один из ваших ключей. Если это ошибка — напишите в поддержку.",
                     reply_markup=keyboards.create_support_keyboard()
                 )
@@ -1923,13 +1972,9 @@ def get_admin_router() -> Router:
             await callback.answer("У вас нет прав.", show_alert=True)
             return
         await callback.answer()
-        users = get_all_users()
         await state.clear()
         await state.set_state(AdminGiftKey.picking_user)
-        await callback.message.edit_text(
-            "🎁 Выдача подарочного ключа\n\nВыберите пользователя:",
-            reply_markup=keyboards.create_admin_users_pick_keyboard(users, page=0, action="gift")
-        )
+        await _show_users_picker(callback.message, state, "gift")
 
     # Запуск выдачи подарка сразу для выбранного пользователя из карточки пользователя
     @admin_router.callback_query(F.data.startswith("admin_gift_key_"))
@@ -1958,15 +2003,8 @@ def get_admin_router() -> Router:
             await callback.answer("У вас нет прав.", show_alert=True)
             return
         await callback.answer()
-        try:
-            page = int(callback.data.split("_")[-1])
-        except Exception:
-            page = 0
-        users = get_all_users()
-        await callback.message.edit_text(
-            "🎁 Выдача подарочного ключа\n\nВыберите пользователя:",
-            reply_markup=keyboards.create_admin_users_pick_keyboard(users, page=page, action="gift")
-        )
+        token = callback.data[len("admin_gift_pick_user_page_"):] or "0"
+        await _show_users_picker(callback.message, state, "gift", token)
 
     @admin_router.callback_query(AdminGiftKey.picking_user, F.data.startswith("admin_gift_pick_user_"))
     async def admin_gift_pick_user(callback: types.CallbackQuery, state: FSMContext):
@@ -1993,12 +2031,8 @@ def get_admin_router() -> Router:
             await callback.answer("У вас нет прав.", show_alert=True)
             return
         await callback.answer()
-        users = get_all_users()
         await state.set_state(AdminGiftKey.picking_user)
-        await callback.message.edit_text(
-            "🎁 Выдача подарочного ключа\n\nВыберите пользователя:",
-            reply_markup=keyboards.create_admin_users_pick_keyboard(users, page=0, action="gift")
-        )
+        await _show_users_picker(callback.message, state, "gift")
 
     @admin_router.callback_query(AdminGiftKey.picking_host, F.data.startswith("admin_gift_pick_host_"))
     async def admin_gift_pick_host(callback: types.CallbackQuery, state: FSMContext):
@@ -2098,7 +2132,7 @@ def get_admin_router() -> Router:
                 if connection_link:
                     cs = html_escape.escape(connection_link)
                     notify_text += f"\n🔗 Подписка:\n<pre><code>{cs}</code></pre>"
-                await message.bot.send_message(user_id, notify_text, parse_mode='HTML', disable_web_page_preview=True)
+                await message_dispatcher.send_message(message.bot, user_id, notify_text, parse_mode='HTML', disable_web_page_preview=True)
             except Exception:
                 pass
         else:
@@ -2119,13 +2153,9 @@ def get_admin_router() -> Router:
             await callback.answer("У вас нет прав.", show_alert=True)
             return
         await callback.answer()
-        users = get_all_users()
-        await callback.message.edit_text(
-            "➕ Начисление баланса\n\nВыберите пользователя:",
-            reply_markup=keyboards.create_admin_users_pick_keyboard(users, page=0, action="add_balance")
-        )
+        await _show_users_picker(callback.message, state, "add_balance")
 
-    @admin_router.callback_query(F.data.startswith("admin_add_balance_"))
+    @admin_router.callback_query(F.data.regexp(r"^admin_add_balance_\d+$"))
     async def admin_add_balance_user(callback: types.CallbackQuery, state: FSMContext):
         if not is_admin(callback.from_user.id):
             await callback.answer("У вас нет прав.", show_alert=True)
@@ -2150,15 +2180,8 @@ def get_admin_router() -> Router:
             await callback.answer("У вас нет прав.", show_alert=True)
             return
         await callback.answer()
-        try:
-            page = int(callback.data.split("_")[-1])
-        except Exception:
-            page = 0
-        users = get_all_users()
-        await callback.message.edit_text(
-            "➕ Начисление баланса\n\nВыберите пользователя:",
-            reply_markup=keyboards.create_admin_users_pick_keyboard(users, page=page, action="add_balance")
-        )
+        token = callback.data[len("admin_add_balance_pick_user_page_"):] or "0"
+        await _show_users_picker(callback.message, state, "add_balance", token)
 
     # Выбор пользователя для начисления: дальше админ вводит только сумму
     @admin_router.callback_query(F.data.startswith("admin_add_balance_pick_user_"))
@@ -2198,7 +2221,7 @@ def get_admin_router() -> Router:
             if ok:
                 await message.answer(f"✅ Начислено {amount:.2f} RUB на баланс пользователю {user_id}")
                 try:
-                    await message.bot.send_message(user_id, f"💰 Вам начислено {amount:.2f} RUB на баланс администратором.")
+                    await message_dispatcher.send_message(message.bot, user_id, f"💰 Вам начислено {amount:.2f} RUB на баланс администратором.")
                 except Exception:
                     pass
             else:
@@ -2269,14 +2292,10 @@ def get_admin_router() -> Router:
             await callback.answer("У вас нет прав.", show_alert=True)
             return
         await callback.answer()
-        users = get_all_users()
-        await callback.message.edit_text(
-            "➖ Списание баланса\n\nВыберите пользователя:",
-            reply_markup=keyboards.create_admin_users_pick_keyboard(users, page=0, action="deduct_balance")
-        )
+        await _show_users_picker(callback.message, state, "deduct_balance")
 
     # Быстрый путь из карточки пользователя
-    @admin_router.callback_query(F.data.startswith("admin_deduct_balance_"))
+    @admin_router.callback_query(F.data.regexp(r"^admin_deduct_balance_\d+$"))
     async def admin_deduct_balance_user(callback: types.CallbackQuery, state: FSMContext):
         if not is_admin(callback.from_user.id):
             await callback.answer("У вас нет прав.", show_alert=True)
@@ -2301,15 +2320,8 @@ def get_admin_router() -> Router:
             await callback.answer("У вас нет прав.", show_alert=True)
             return
         await callback.answer()
-        try:
-            page = int(callback.data.split("_")[-1])
-        except Exception:
-            page = 0
-        users = get_all_users()
-        await callback.message.edit_text(
-            "➖ Списание баланса\n\nВыберите пользователя:",
-            reply_markup=keyboards.create_admin_users_pick_keyboard(users, page=page, action="deduct_balance")
-        )
+        token = callback.data[len("admin_deduct_balance_pick_user_page_"):] or "0"
+        await _show_users_picker(callback.message, state, "deduct_balance", token)
 
     # Выбор пользователя -> ввод суммы
     @admin_router.callback_query(F.data.startswith("admin_deduct_balance_pick_user_"))
@@ -2349,8 +2361,8 @@ def get_admin_router() -> Router:
             if ok:
                 await message.answer(f"✅ Списано {amount:.2f} RUB с баланса пользователя {user_id}")
                 try:
-                    await message.bot.send_message(
-                        user_id,
+                    await message_dispatcher.send_message(
+                        message.bot, user_id,
                         f"➖ С вашего баланса списано {amount:.2f} RUB администратором.\nЕсли это ошибка — напишите в поддержку.",
                         reply_markup=keyboards.create_support_keyboard()
                     )
@@ -2552,7 +2564,7 @@ def get_admin_router() -> Router:
         await message.answer(f"✅ Ключ #{key_id} продлён на {days} дн.")
         # Попробуем уведомить пользователя
         try:
-            await message.bot.send_message(int(key.get('user_id')), f"ℹ️ Администратор продлил ваш ключ #{key_id} на {days} дн.")
+            await message_dispatcher.send_message(message.bot, int(key.get('user_id')), f"ℹ️ Администратор продлил ваш ключ #{key_id} на {days} дн.")
         except Exception:
             pass
 
@@ -2563,13 +2575,106 @@ def get_admin_router() -> Router:
             return
         await callback.answer()
         await callback.message.edit_text(
-            "Пришлите сообщение, которое вы хотите разослать всем пользователям.\n"
+            "Выберите аудиторию рассылки:",
+            reply_markup=keyboards.create_broadcast_segment_keyboard(database.BROADCAST_SEGMENTS)
+        )
+        await state.set_state(Broadcast.waiting_for_segment)
+
+    def _segment_label(segment: str, params: dict) -> str:
+        title = database.BROADCAST_SEGMENTS.get(segment, segment)
+        if segment == 'expired_within':
+            return f"Ключ истёк за {params.get('days')} дн. (нет активных)"
+        if segment == 'host':
+            return f"{title}: {params.get('host_name')}"
+        if segment == 'spent_above':
+            return f"Потратили больше {params.get('amount')} RUB"
+        return title
+
+    async def _ask_broadcast_message(message: types.Message, state: FSMContext, edit: bool = False):
+        data = await state.get_data()
+        segment = data.get('segment') or 'all'
+        params = data.get('segment_params') or {}
+        count = await asyncio.to_thread(database.count_segment_users, segment, params)
+        text = (
+            f"Аудитория: <b>{html_escape.escape(_segment_label(segment, params))}</b> — {count} польз.\n\n"
+            "Пришлите сообщение для рассылки.\n"
             "Вы можете использовать форматирование (<b>жирный</b>, <i>курсив</i>).\n"
-            "Также поддерживаются фото, видео и документы.\n",
-            reply_markup=keyboards.create_broadcast_cancel_keyboard()
+            "Также поддерживаются фото, видео и документы.\n"
         )
+        if edit:
+            await message.edit_text(text, reply_markup=keyboards.create_broadcast_cancel_keyboard())
+        else:
+            await message.answer(text, reply_markup=keyboards.create_broadcast_cancel_keyboard())
         await state.set_state(Broadcast.waiting_for_message)
 
+    @admin_router.callback_query(Broadcast.waiting_for_segment, F.data.startswith("bcast_seg:"))
+    async def broadcast_segment_selected_handler(callback: types.CallbackQuery, state: FSMContext):
+        segment = callback.data.split(":", 1)[1]
+        if segment not in database.BROADCAST_SEGMENTS:
+            await callback.answer("Неизвестный сегмент", show_alert=True)
+            return
+        await callback.answer()
+        await state.update_data(segment=segment, segment_params={})
+        if segment == 'host':
+            hosts = database.get_all_hosts()
+            if not hosts:
+                await callback.message.edit_text("❌ Хосты не настроены.", reply_markup=keyboards.create_broadcast_cancel_keyboard())
+                return
+            await callback.message.edit_text(
+                "Выберите хост:",
+                reply_markup=keyboards.create_broadcast_host_keyboard(hosts)
+            )
+            return
+        if segment == 'expired_within':
+            await callback.message.edit_text(
+                "Введите количество дней (например, 7):",
+                reply_markup=keyboards.create_broadcast_cancel_keyboard()
+            )
+            await state.set_state(Broadcast.waiting_for_segment_param)
+            return
+        if segment == 'spent_above':
+            await callback.message.edit_text(
+                "Введите сумму в RUB (например, 500):",
+                reply_markup=keyboards.create_broadcast_cancel_keyboard()
+            )
+            await state.set_state(Broadcast.waiting_for_segment_param)
+            return
+        await _ask_broadcast_message(callback.message, state, edit=True)
+
+    @admin_router.callback_query(Broadcast.waiting_for_segment, F.data.startswith("bcast_seg_host:"))
+    async def broadcast_segment_host_handler(callback: types.CallbackQuery, state: FSMContext):
+        try:
+            idx = int(callback.data.split(":", 1)[1])
+            host = database.get_all_hosts()[idx]
+        except (ValueError, IndexError):
+            await callback.answer("Хост не найден", show_alert=True)
+            return
+        await callback.answer()
+        await state.update_data(segment='host', segment_params={'host_name': host.get('host_name')})
+        await _ask_broadcast_message(callback.message, state, edit=True)
+
+    @admin_router.message(Broadcast.waiting_for_segment_param)
+    async def broadcast_segment_param_handler(message: types.Message, state: FSMContext):
+        data = await state.get_data()
+        segment = data.get('segment')
+        raw = (message.text or '').strip().replace(',', '.')
+        try:
+            if segment == 'expired_within':
+                value = int(raw)
+                if value <= 0:
+                    raise ValueError
+                params = {'days': value}
+            else:
+                value = float(raw)
+                if value < 0:
+                    raise ValueError
+                params = {'amount': value}
+        except ValueError:
+            await message.answer("❌ Введите положительное число.")
+            return
+        await state.update_data(segment_params=params)
+        await _ask_broadcast_message(message, state)
+
     @admin_router.message(Broadcast.waiting_for_message)
     async def broadcast_message_received_handler(message: types.Message, state: FSMContext):
         # сохраняем оригинальное сообщение целиком, чтобы потом скопировать
@@ -2629,7 +2734,11 @@ def get_admin_router() -> Router:
             builder.button(text=button_text, url=button_url)
             preview_keyboard = builder.as_markup()
 
+        segment = data.get('segment') or 'all'
+        params = data.get('segment_params') or {}
+        count = await asyncio.to_thread(database.count_segment_users, segment, params)
         await message.answer(
+            f"Аудитория: <b>{html_escape.escape(_segment_label(segment, params))}</b> — {count} польз.\n"
             "Вот так будет выглядеть ваше сообщение. Отправляем?",
             reply_markup=keyboards.create_broadcast_confirmation_keyboard()
         )
@@ -2645,55 +2754,95 @@ def get_admin_router() -> Router:
 
     @admin_router.callback_query(Broadcast.waiting_for_confirmation, F.data == "confirm_broadcast")
     async def confirm_broadcast_handler(callback: types.CallbackQuery, state: FSMContext, bot: Bot):
-        await callback.message.edit_text("⏳ Начинаю рассылку... Это может занять некоторое время.")
-
         data = await state.get_data()
         message_json = data.get('message_to_send')
         original_message = types.Message.model_validate_json(message_json)
 
         button_text = data.get('button_text')
         button_url = data.get('button_url')
-
-        final_keyboard = None
-        if button_text and button_url:
-            builder = InlineKeyboardBuilder()
-            builder.button(text=button_text, url=button_url)
-            final_keyboard = builder.as_markup()
+        segment = data.get('segment') or 'all'
+        segment_params = data.get('segment_params') or {}
 
         await state.clear()
 
-        users = get_all_users()
-        logger.info(f"Broadcast: Starting to iterate over {len(users)} users.")
-
-        sent_count = 0
-        failed_count = 0
-        banned_count = 0
+        # Кампания и список получателей сохраняются в БД: рассылка переживает перезапуск бота
+        campaign_id = database.create_broadcast_campaign(
+            created_by=callback.from_user.id,
+            from_chat_id=original_message.chat.id,
+            message_id=original_message.message_id,
+            button_text=button_text,
+            button_url=button_url,
+            segment=segment,
+            segment_params=segment_params,
+        )
+        if not campaign_id:
+            await callback.message.edit_text("❌ Не удалось создать рассылку. Подробности в логах.")
+            await show_admin_menu(callback.message)
+            return
+        total = await asyncio.to_thread(database.populate_broadcast_recipients, campaign_id)
+        logger.info(f"Broadcast: campaign #{campaign_id} ({segment}) created for {total} recipients.")
 
-        for user in users:
-            user_id = user['telegram_id']
-            if user.get('is_banned'):
-                banned_count += 1
-                continue
-            try:
-                await bot.copy_message(
-                    chat_id=user_id,
-                    from_chat_id=original_message.chat.id,
-                    message_id=original_message.message_id,
-                    reply_markup=final_keyboard
-                )
-                sent_count += 1
-                await asyncio.sleep(0.1)
-            except Exception as e:
-                failed_count += 1
-                logger.warning(f"Failed to send broadcast message to user {user_id}: {e}")
-
-        await callback.message.answer(
-            f"✅ Рассылка завершена!\n\n"
-            f"👍 Отправлено: {sent_count}\n"
-            f"👎 Не удалось отправить: {failed_count}\n"
-            f"🚫 Пропущено (забанены): {banned_count}"
+        await callback.answer()
+        progress = await callback.message.edit_text(
+            broadcast_engine.render_progress(database.get_broadcast_campaign(campaign_id) or {'campaign_id': campaign_id, 'status': 'pending'})
+            + "\n\nℹ️ Не удаляйте исходное сообщение до окончания рассылки.",
+            reply_markup=broadcast_engine.create_progress_keyboard(campaign_id)
         )
-        await show_admin_menu(callback.message)
+        try:
+            if isinstance(progress, types.Message):
+                database.set_broadcast_progress_message(campaign_id, progress.chat.id, progress.message_id)
+            else:
+                database.set_broadcast_progress_message(campaign_id, callback.message.chat.id, callback.message.message_id)
+        except Exception:
+            pass
+        broadcast_engine.start_campaign(bot, campaign_id)
+
+    @admin_router.callback_query(F.data.startswith("bcast_refresh:"))
+    async def broadcast_refresh_handler(callback: types.CallbackQuery):
+        if not is_admin(callback.from_user.id):
+            await callback.answer("У вас нет прав.", show_alert=True)
+            return
+        try:
+            campaign_id = int(callback.data.split(":", 1)[1])
+        except Exception:
+            await callback.answer("Некорректная рассылка", show_alert=True)
+            return
+        campaign = database.get_broadcast_campaign(campaign_id)
+        if not campaign:
+            await callback.answer("Рассылка не найдена", show_alert=True)
+            return
+        await callback.answer()
+        running = campaign.get('status') in ('pending', 'running')
+        try:
+            await callback.message.edit_text(
+                broadcast_engine.render_progress(campaign),
+                reply_markup=broadcast_engine.create_progress_keyboard(campaign_id, running)
+            )
+        except Exception:
+            pass
+
+    @admin_router.callback_query(F.data.startswith("bcast_stop:"))
+    async def broadcast_stop_handler(callback: types.CallbackQuery):
+        if not is_admin(callback.from_user.id):
+            await callback.answer("У вас нет прав.", show_alert=True)
+            return
+        try:
+            campaign_id = int(callback.data.split(":", 1)[1])
+        except Exception:
+            await callback.answer("Некорректная рассылка", show_alert=True)
+            return
+        if broadcast_engine.cancel_campaign(campaign_id):
+            await callback.answer("Рассылка останавливается…")
+        else:
+            await callback.answer("Рассылка уже завершена.", show_alert=True)
+        campaign = database.get_broadcast_campaign(campaign_id) or {'campaign_id': campaign_id}
+        try:
+            await callback.message.edit_text(
+                broadcast_engine.render_progress(campaign),
+                reply_markup=broadcast_engine.create_progress_keyboard(campaign_id, running=False)
+            )
+        except Exception:
+            pass
 
     @admin_router.callback_query(StateFilter(Broadcast), F.data == "cancel_broadcast")
     async def cancel_broadcast_handler(callback: types.CallbackQuery, state: FSMContext):
@@ -2716,8 +2865,8 @@ def get_admin_router() -> Router:
             set_referral_balance(user_id, 0)
             set_referral_balance_all(user_id, 0)
             await message.answer(f"✅ Выплата {balance:.2f} RUB пользователю {user_id} подтверждена.")
-            await message.bot.send_message(
-                user_id,
+            await message_dispatcher.send_message(
+                message.bot, user_id,
                 f"✅ Ваша заявка на вывод {balance:.2f} RUB одобрена. Деньги будут переведены в ближайшее время."
             )
         except Exception as e:
@@ -2730,8 +2879,8 @@ def get_admin_router() -> Router:
         try:
             user_id = int(message.text.split("_")[-1])
             await message.answer(f"❌ Заявка пользователя {user_id} отклонена.")
-            await message.bot.send_message(
-                user_id,
+            await message_dispatcher.send_message(
+                message.bot, user_id,
                 "❌ Ваша заявка на вывод отклонена. Проверьте корректность реквизитов и попробуйте снова."
             )
         except Exception as e:
@@ -0,0 +1,223 @@
+import asyncio
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest
+from aiogram.types import InlineKeyboardMarkup
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+
+from shop_bot.data_manager import database
+from shop_bot.bot import message_dispatcher
+
+logger = logging.getLogger(__name__)
+
+# Получатели читаются из БД порциями по курсору user_id, поэтому память не растёт с числом пользователей
+BROADCAST_CHUNK_SIZE = 500
+# Сколько отправок держать одновременно в очереди бота (темп задаёт MessageDispatcher)
+BROADCAST_MAX_IN_FLIGHT = 50
+PROGRESS_EDIT_INTERVAL_SECONDS = 5
+# Кампания в статусе running без heartbeat дольше этого считается прерванной (рестарт бота)
+STALE_HEARTBEAT_SECONDS = 120
+# Heartbeat пишется отдельной задачей: порция из BROADCAST_CHUNK_SIZE при темпе рассылок и паузах RetryAfter
+# может идти дольше STALE_HEARTBEAT_SECONDS, и лидер другого экземпляра счёл бы кампанию прерванной
+HEARTBEAT_INTERVAL_SECONDS = 30
+
+_BLOCKED_MARKERS = ("bot was blocked", "user is deactivated", "chat not found", "bot can't initiate", "peer_id_invalid")
+
+_tasks: dict[int, asyncio.Task] = {}
+_cancel_events: dict[int, asyncio.Event] = {}
+
+
+def is_running(campaign_id: int) -> bool:
+    task = _tasks.get(campaign_id)
+    return bool(task and not task.done())
+
+
+def start_campaign(bot: Bot, campaign_id: int) -> bool:
+    """Запускает (или возобновляет) кампанию в текущем цикле событий."""
+    if is_running(campaign_id):
+        return False
+    _cancel_events[campaign_id] = asyncio.Event()
+    task = asyncio.create_task(_run_campaign(bot, campaign_id))
+    _tasks[campaign_id] = task
+
+    def _cleanup(_t: asyncio.Task):
+        _tasks.pop(campaign_id, None)
+        _cancel_events.pop(campaign_id, None)
+
+    task.add_done_callback(_cleanup)
+    return True
+
+
+def cancel_campaign(campaign_id: int) -> bool:
+    """Останавливает кампанию: новые отправки не ставятся, неотправленные остаются pending."""
+    campaign = database.get_broadcast_campaign(campaign_id)
+    if not campaign or campaign.get('status') not in ('pending', 'running'):
+        return False
+    database.set_broadcast_campaign_status(campaign_id, 'cancelled')
+    event = _cancel_events.get(campaign_id)
+    if event:
+        event.set()
+    return True
+
+
+def resume_interrupted_campaigns(bot: Bot) -> int:
+    """Возобновляет кампании, прерванные рестартом (running без свежего heartbeat)."""
+    resumed = 0
+    for campaign_id in database.get_stale_running_broadcasts(STALE_HEARTBEAT_SECONDS):
+        if start_campaign(bot, campaign_id):
+            resumed += 1
+            logger.info(f"Рассылка #{campaign_id}: возобновлена после перезапуска.")
+    return resumed
+
+
+def render_progress(campaign: dict) -> str:
+    total = int(campaign.get('total') or 0)
+    sent = int(campaign.get('sent') or 0)
+    failed = int(campaign.get('failed') or 0)
+    blocked = int(campaign.get('blocked') or 0)
+    done = sent + failed + blocked
+    pct = int(done * 100 / total) if total else 100
+    status_titles = {
+        'pending': '⏳ Подготовка',
+        'running': '📤 Идёт рассылка',
+        'completed': '✅ Рассылка завершена',
+        'cancelled': '⏹ Рассылка остановлена',
+        'failed': '❌ Рассылка прервана с ошибкой',
+    }
+    title = status_titles.get(campaign.get('status'), campaign.get('status') or '')
+    return (
+        f"{title} #{campaign.get('campaign_id')}\n\n"
+        f"Прогресс: {done}/{total} ({pct}%)\n"
+        f"👍 Отправлено: {sent}\n"
+        f"👎 Не удалось отправить: {failed}\n"
+        f"🚫 Заблокировали бота: {blocked}"
+    )
+
+
+def create_progress_keyboard(campaign_id: int, running: bool = True) -> InlineKeyboardMarkup | None:
+    if not running:
+        return None
+    builder = InlineKeyboardBuilder()
+    builder.button(text="🔄 Обновить", callback_data=f"bcast_refresh:{campaign_id}")
+    builder.button(text="⏹ Остановить", callback_data=f"bcast_stop:{campaign_id}")
+    builder.adjust(2)
+    return builder.as_markup()
+
+
+async def update_progress_message(bot: Bot, campaign_id: int) -> None:
+    campaign = database.get_broadcast_campaign(campaign_id)
+    if not campaign or not campaign.get('progress_chat_id') or not campaign.get('progress_message_id'):
+        return
+    running = campaign.get('status') in ('pending', 'running')
+    try:
+        await message_dispatcher.edit_message_text(
+            bot,
+            int(campaign['progress_chat_id']),
+            int(campaign['progress_message_id']),
+            render_progress(campaign),
+            reply_markup=create_progress_keyboard(campaign_id, running),
+        )
+    except TelegramBadRequest:
+        # "message is not modified" и подобное — не критично
+        pass
+    except Exception as e:
+        logger.debug(f"Рассылка #{campaign_id}: не удалось обновить прогресс: {e}")
+
+
+def _classify_error(exc: Exception) -> str:
+    if isinstance(exc, TelegramForbiddenError):
+        return 'blocked'
+    text = str(exc).lower()
+    if isinstance(exc, TelegramBadRequest) and any(m in text for m in _BLOCKED_MARKERS):
+        return 'blocked'
+    return 'failed'
+
+
+async def _run_campaign(bot: Bot, campaign_id: int) -> None:
+    campaign = database.get_broadcast_campaign(campaign_id)
+    if not campaign or campaign.get('status') not in ('pending', 'running'):
+        return
+    database.set_broadcast_campaign_status(campaign_id, 'running')
+
+    reply_markup = None
+    if campaign.get('button_text') and campaign.get('button_url'):
+        builder = InlineKeyboardBuilder()
+        builder.button(text=campaign['button_text'], url=campaign['button_url'])
+        reply_markup = builder.as_markup()
+
+    cancel_event = _cancel_events.get(campaign_id) or asyncio.Event()
+    semaphore = asyncio.Semaphore(BROADCAST_MAX_IN_FLIGHT)
+    had_dispatcher = message_dispatcher.get_dispatcher(bot) is not None
+    interrupted = False
+    cursor = 0
+    last_progress_at = 0.0
+    from_chat_id = int(campaign['from_chat_id'])
+    message_id = int(campaign['message_id'])
+
+    async def _send_one(user_id: int) -> tuple[int, str, str | None]:
+        nonlocal interrupted
+        async with semaphore:
+            if cancel_event.is_set() or interrupted:
+                return user_id, 'pending', None
+            try:
+                await message_dispatcher.copy_message(
+                    bot, user_id, from_chat_id, message_id,
+                    priority=message_dispatcher.PRIORITY_MARKETING,
+                    reply_markup=reply_markup,
+                )
+                return user_id, 'sent', None
+            except Exception as e:
+                if had_dispatcher and message_dispatcher.get_dispatcher(bot) is None:
+                    # Бот останавливается — оставляем получателя в очереди до возобновления
+                    interrupted = True
+                    return user_id, 'pending', None
+                return user_id, _classify_error(e), f"{type(e).__name__}: {e}"
+
+    async def _heartbeat() -> None:
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL_SECONDS)
+            await asyncio.to_thread(database.touch_broadcast_campaign, campaign_id)
+
+    logger.info(f"Рассылка #{campaign_id}: старт, получателей {campaign.get('total')}.")
+    heartbeat_task = asyncio.create_task(_heartbeat())
+    try:
+        while not cancel_event.is_set() and not interrupted:
+            chunk = database.get_pending_broadcast_recipients(campaign_id, cursor, BROADCAST_CHUNK_SIZE)
+            if not chunk:
+                break
+            cursor = chunk[-1]
+            results = await asyncio.gather(*(_send_one(uid) for uid in chunk))
+            database.record_broadcast_results(campaign_id, [r for r in results if r[1] != 'pending'])
+
+            # Отмена могла прийти из другого процесса (веб-панель) — проверяем статус в БД
+            current = database.get_broadcast_campaign(campaign_id) or {}
+            if current.get('status') == 'cancelled':
+                cancel_event.set()
+
+            if time.monotonic() - last_progress_at >= PROGRESS_EDIT_INTERVAL_SECONDS:
+                last_progress_at = time.monotonic()
+                await update_progress_message(bot, campaign_id)
+    except asyncio.CancelledError:
+        logger.info(f"Рассылка #{campaign_id}: задача отменена, кампания будет возобновлена позже.")
+        raise
+    except Exception as e:
+        logger.error(f"Рассылка #{campaign_id}: ошибка выполнения: {e}", exc_info=True)
+        database.set_broadcast_campaign_status(campaign_id, 'failed')
+        await update_progress_message(bot, campaign_id)
+        return
+    finally:
+        heartbeat_task.cancel()
+
+    if interrupted:
+        logger.info(f"Рассылка #{campaign_id}: приостановлена (бот остановлен), будет возобновлена.")
+        return
+    if not cancel_event.is_set():
+        database.set_broadcast_campaign_status(campaign_id, 'completed')
+    final = database.get_broadcast_campaign(campaign_id) or {}
+    logger.info(
+        f"Рассылка #{campaign_id}: {final.get('status')}. Отправлено {final.get('sent')}, "
+        f"ошибок {final.get('failed')}, заблокировали {final.get('blocked')}."
+    )
+    await update_progress_message(bot, campaign_id)
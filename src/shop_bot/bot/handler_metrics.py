@@ -0,0 +1,145 @@
+import re
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from shop_bot.data_manager import metrics_registry
+
+# Метрики обработки апдейтов по «кнопкам»: число вызовов, гистограмма задержки,
+# обращения к БД и к панелям 3x-ui. Пишутся только из цикла событий ботов (без блокировок),
+# читаются веб-панелью снимком.
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+MAX_LABELS = 500
+
+_stats: dict[tuple[str, str], dict] = {}
+_started_at = time.time()
+
+def _normalize(value: str) -> str:
+    return re.sub(r"\d+", "#", value)[:48]
+
+
+def get_update_label(update: Update) -> str:
+    if update.callback_query is not None:
+        data = update.callback_query.data or ""
+        # Для callback_data вида "prefix:..." считаем по префиксу, числа (id) схлопываем
+        return "cb:" + _normalize(data.split(":", 1)[0] if ":" in data else data)
+    message = update.message or update.edited_message
+    if message is not None:
+        text = message.text or ""
+        if text.startswith("/"):
+            return "cmd:" + text.split()[0].split("@")[0][:32]
+        return "msg:" + str(message.content_type or "unknown")
+    return "upd:" + str(update.event_type)
+
+
+def _record(bot_name: str, label: str, duration_ms: float, db_calls: int, panel_calls: int, failed: bool) -> None:
+    key = (bot_name, label)
+    stat = _stats.get(key)
+    if stat is None:
+        if len(_stats) >= MAX_LABELS:
+            key = (bot_name, "other")
+            stat = _stats.get(key)
+        if stat is None:
+            stat = {
+                "count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0,
+                "db_calls": 0, "panel_calls": 0,
+                "buckets": [0] * (len(LATENCY_BUCKETS_MS) + 1),
+            }
+            _stats[key] = stat
+    stat["count"] += 1
+    stat["total_ms"] += duration_ms
+    if duration_ms > stat["max_ms"]:
+        stat["max_ms"] = duration_ms
+    stat["db_calls"] += db_calls
+    stat["panel_calls"] += panel_calls
+    if failed:
+        stat["errors"] += 1
+    idx = len(LATENCY_BUCKETS_MS)
+    for i, bound in enumerate(LATENCY_BUCKETS_MS):
+        if duration_ms <= bound:
+            idx = i
+            break
+    stat["buckets"][idx] += 1
+
+
+def _bucket_quantile(buckets: list[int], count: int, q: float) -> int | None:
+    """Оценка квантиля по гистограмме (верхняя граница корзины)."""
+    if not count:
+        return None
+    target = q * count
+    seen = 0
+    for i, n in enumerate(buckets):
+        seen += n
+        if seen >= target:
+            return LATENCY_BUCKETS_MS[i] if i < len(LATENCY_BUCKETS_MS) else None
+    return None
+
+
+def get_snapshot() -> dict:
+    rows = []
+    for (bot_name, label), stat in list(_stats.items()):
+        count = stat["count"]
+        buckets = list(stat["buckets"])
+        rows.append({
+            "bot": bot_name,
+            "label": label,
+            "count": count,
+            "errors": stat["errors"],
+            "avg_ms": round(stat["total_ms"] / count, 1) if count else None,
+            "p50_ms": _bucket_quantile(buckets, count, 0.5),
+            "p95_ms": _bucket_quantile(buckets, count, 0.95),
+            "max_ms": round(stat["max_ms"], 1),
+            "total_ms": round(stat["total_ms"], 1),
+            "db_per_call": round(stat["db_calls"] / count, 2) if count else 0,
+            "panel_per_call": round(stat["panel_calls"] / count, 2) if count else 0,
+            "buckets": buckets,
+        })
+    rows.sort(key=lambda r: r["total_ms"], reverse=True)
+    return {
+        "since": _started_at,
+        "uptime_sec": int(time.time() - _started_at),
+        "bucket_bounds_ms": list(LATENCY_BUCKETS_MS),
+        "handlers": rows,
+    }
+
+
+def reset() -> None:
+    global _started_at
+    _stats.clear()
+    _started_at = time.time()
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Внешний middleware на уровне Update: замеряет весь путь обработки апдейта."""
+
+    def __init__(self, bot_name: str):
+        self.bot_name = bot_name
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        if not isinstance(event, Update):
+            return await handler(event, data)
+        # Обращения к БД и панелям отмечают сами database.py и xui_api.py в области подсчёта апдейта
+        started = time.perf_counter()
+        failed = False
+        with metrics_registry.counting_scope() as calls:
+            try:
+                return await handler(event, data)
+            except Exception:
+                failed = True
+                raise
+            finally:
+                try:
+                    _record(
+                        self.bot_name, get_update_label(event),
+                        (time.perf_counter() - started) * 1000.0,
+                        calls.get("db", 0), calls.get("panel", 0), failed,
+                    )
+                except Exception:
+                    pass
@@ -1,4 +1,6 @@
+import asyncio
 import logging
+import time
 import uuid
 import hashlib
 import json
@@ -19,11 +21,14 @@ from shop_bot.data_manager.database import (
     get_promo_code, use_promo_code, create_user_key, get_user_keys,
     get_transaction_by_payment_id, get_host_by_name, get_key_by_id, update_key_expiry,
     register_user_if_not_exists, get_all_hosts, get_plans_for_host, mark_trial_used,
-    get_latest_speedtest
+    set_key_connection_string,
+    get_latest_speedtests_per_host, get_speedtest_version,
+    claim_payment, finish_payment_claim, PAYMENT_CLAIM_DONE, PAYMENT_CLAIM_BUSY
 )
 from shop_bot.data_manager import speedtest_runner
 from shop_bot.modules import xui_api
 from shop_bot.bot import keyboards
+from shop_bot.bot import message_dispatcher
 from shop_bot.bot.states import PaymentProcess, TopUpProcess
 
 
@@ -454,8 +459,84 @@ async def show_user_keys(callback: types.CallbackQuery):
         logger.error(f"Error in show_user_keys: {e}", exc_info=True)
         await callback.answer("Произошла ошибка при загрузке ключей", show_alert=True)
 
+# --- Просмотр ключа: stale-while-revalidate ---
+# Ключ показывается сразу из БД (срок и последняя известная ссылка), а панель опрашивается в фоне.
+# Сообщение перерисовывается, только если ссылка изменилась и пользователь ещё на этом экране.
+KEY_VIEW_REVALIDATE_SECONDS = 600
+
+_key_view_tokens: dict[tuple[int, int], int] = {}
+_key_view_counter = 0
+_key_revalidating: set[int] = set()
+
+
+@user_router.callback_query.outer_middleware()
+async def _key_view_navigation_middleware(handler, event: types.CallbackQuery, data):
+    # Любое нажатие на сообщении означает уход с экрана ключа: фоновое обновление его больше не трогает
+    if event.message:
+        _key_view_tokens.pop((event.message.chat.id, event.message.message_id), None)
+    return await handler(event, data)
+
+
+def _format_key_expiry(key: dict) -> str:
+    raw = key.get('expiry_date')
+    if not raw:
+        return "Бессрочно"
+    try:
+        value = raw if isinstance(raw, datetime) else datetime.fromisoformat(str(raw))
+        return value.strftime('%Y-%m-%d %H:%M')
+    except Exception as e:
+        logger.warning(f"Error parsing expiry for key {key.get('key_id')}: {e}")
+        return "Неизвестно"
+
+
+def _render_key_view(key: dict, connection_display: str | None, loading: bool = False):
+    if connection_display:
+        link_line = f"🔗 <code>{connection_display}</code>"
+    else:
+        link_line = "🔗 <i>Загружаю ссылку…</i>" if loading else "🔗 <code>Ссылка недоступна</code>"
+    text = (
+        f"🔑 <b>Ключ:</b> {key.get('key_email', 'Unknown')}\n"
+        f"🌍 <b>Сервер:</b> {key.get('host_name', 'Unknown')}\n"
+        f"⏳ <b>Истекает:</b> {_format_key_expiry(key)}\n"
+        f"{link_line}"
+    )
+    builder = InlineKeyboardBuilder()
+    builder.button(text="📅 Продлить", callback_data=f"renew_key:{key['key_id']}")
+    builder.button(text="🔙 К списку ключей", callback_data="manage_keys")
+    builder.button(text="🏠 Главное меню", callback_data="main_menu")
+    builder.adjust(1)
+    return text, builder.as_markup()
+
+
+async def _revalidate_key_view(bot: Bot, chat_id: int, message_id: int, key: dict, shown: str | None, view_token: int):
+    key_id = key['key_id']
+    fresh = None
+    try:
+        # Вход в панель синхронный — выполняем в потоке, чтобы не блокировать цикл событий
+        details = await asyncio.to_thread(xui_api.get_key_details_from_host, key)
+        fresh = (details or {}).get('connection_string')
+        await asyncio.to_thread(set_key_connection_string, key_id, fresh)
+    except Exception as e:
+        logger.warning(f"Failed to refresh key details for key {key_id}: {e}")
+    try:
+        # Без свежей ссылки оставляем показанную; заглушку «Загружаю ссылку…» заменяем на «недоступна»
+        if (fresh or None) == shown or (not fresh and shown):
+            return
+        if _key_view_tokens.get((chat_id, message_id)) != view_token:
+            return
+        text, markup = _render_key_view(key, fresh)
+        await message_dispatcher.edit_message_text(bot, chat_id, message_id, text, reply_markup=markup, parse_mode="HTML")
+    except Exception as e:
+        logger.warning(f"Failed to update key view for key {key_id}: {e}")
+    finally:
+        _key_revalidating.discard(key_id)
+        if _key_view_tokens.get((chat_id, message_id)) == view_token:
+            _key_view_tokens.pop((chat_id, message_id), None)
+
+
 @user_router.callback_query(F.data.startswith("view_key:"))
 async def view_key_handler(callback: types.CallbackQuery):
+    global _key_view_counter
     try:
         key_id = int(callback.data.split(":")[1])
         key = get_key_by_id(key_id)
@@ -466,49 +547,23 @@ async def view_key_handler(callback: types.CallbackQuery):
             await show_user_keys(callback)
             return
 
-        # Show loading status while fetching details
-        try:
-            await callback.message.edit_text("⏳ Загрузка данных ключа...", reply_markup=None)
-        except Exception:
-            pass
+        # Мгновенный ответ из локальных данных; без сохранённой ссылки показываем заглушку до ответа панели
+        # (ссылку нельзя собрать локально: для подписки нужен sub_token клиента из панели)
+        connection_display = key.get('connection_string')
 
-        try:
-            expiry_ts = key.get('expiry_time')
-            if expiry_ts and isinstance(expiry_ts, (int, float)) and expiry_ts > 0:
-                expiry = datetime.fromtimestamp(expiry_ts/1000).strftime('%Y-%m-%d %H:%M')
-            else:
-                expiry = "Бессрочно"
-        except Exception as e:
-            logger.warning(f"Error parsing expiry for key {key.get('key_id')}: {e}")
-            expiry = "Неизвестно"
-        
-        key_email = key.get('key_email', 'Unknown')
-        host_name = key.get('host_name', 'Unknown')
-        
-        connection_display = key.get('access_url')
-        if not connection_display:
-            try:
-                details = await xui_api.get_key_details_from_host(key)
-                if details and details.get('connection_string'):
-                    connection_display = details['connection_string']
-            except Exception as e:
-                logger.warning(f"Failed to get key details for key {key.get('key_id')}: {e}")
-                connection_display = None
-        
-        text = (
-            f"🔑 <b>Ключ:</b> {key_email}\n"
-            f"🌍 <b>Сервер:</b> {host_name}\n"
-            f"⏳ <b>Истекает:</b> {expiry}\n"
-            f"🔗 <code>{connection_display or 'Ссылка недоступна'}</code>"
-        )
-        
-        builder = InlineKeyboardBuilder()
-        builder.button(text="📅 Продлить", callback_data=f"renew_key:{key['key_id']}")
-        builder.button(text="🔙 К списку ключей", callback_data="manage_keys")
-        builder.button(text="🏠 Главное меню", callback_data="main_menu")
-        builder.adjust(1)
-        
-        await callback.message.edit_text(text, reply_markup=builder.as_markup(), parse_mode="HTML")
+        text, markup = _render_key_view(key, connection_display, loading=not connection_display)
+        await callback.message.edit_text(text, reply_markup=markup, parse_mode="HTML")
+
+        checked_at = key.get('connection_checked_at') or 0
+        # Заглушку нужно заменить в любом случае, поэтому без сохранённой ссылки проверяем всегда
+        if connection_display and (key_id in _key_revalidating or time.time() - float(checked_at) < KEY_VIEW_REVALIDATE_SECONDS):
+            return
+        _key_view_counter += 1
+        view_token = _key_view_counter
+        chat_id, message_id = callback.message.chat.id, callback.message.message_id
+        _key_view_tokens[(chat_id, message_id)] = view_token
+        _key_revalidating.add(key_id)
+        asyncio.create_task(_revalidate_key_view(callback.bot, chat_id, message_id, key, connection_display, view_token))
 
     except Exception as e:
         logger.error(f"Error in view_key_handler: {e}", exc_info=True)
@@ -591,57 +646,74 @@ async def show_referral_program(callback: types.CallbackQuery):
     builder.button(text="🔙 Назад", callback_data="main_menu")
     await callback.message.edit_text(text, reply_markup=builder.as_markup(), parse_mode="HTML")
 
+# Готовый текст сводки спидтестов: пересобирается при новой записи (версия) или раз в минуту (правки хостов)
+SPEEDTEST_SUMMARY_TTL_SECONDS = 60
+_speedtest_summary_cache: dict = {}
+
+
+def _format_speedtest_time(created_at) -> str:
+    try:
+        if created_at:
+            if isinstance(created_at, str):
+                dt = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
+            else:
+                dt = created_at
+            return dt.strftime('%d.%m %H:%M')
+        return '—'
+    except Exception:
+        return str(created_at)
+
+
+def _build_speedtest_summary_text() -> str | None:
+    rows = get_latest_speedtests_per_host()
+    if not rows:
+        return None
+    parts = [
+        "⚡️ <b>Результаты Speedtest</b>\n",
+        "<i>Нажмите кнопку «Обновить», чтобы запустить новый тест (это может занять время).</i>\n\n",
+    ]
+    for row in rows:
+        host_name = row.get('host_name') or 'Неизвестный хост'
+        if row.get('created_at') is None:
+            parts.append(f"• 🌏 <b>{host_name}</b> — Нет данных\n\n")
+            continue
+        ping = row.get('ping_ms')
+        download = row.get('download_mbps')
+        upload = row.get('upload_mbps')
+        method = (row.get('method') or 'unknown').upper()
+        ping_str = f"{ping:.2f}" if ping is not None else "—"
+        download_str = f"{download:.0f}" if download is not None else "—"
+        upload_str = f"{upload:.0f}" if upload is not None else "—"
+        parts.append(
+            f"• 🌏 <b>{host_name}</b> ({method})\n"
+            f"   ✅ Ping: {ping_str} ms\n"
+            f"   ⬇️ Download: {download_str} Mbps\n"
+            f"   ⬆️ Upload: {upload_str} Mbps\n"
+            f"   🕒 {_format_speedtest_time(row.get('created_at'))}\n\n"
+        )
+    return "".join(parts)
+
+
+def get_speedtest_summary_text() -> str | None:
+    version = get_speedtest_version()
+    now = time.monotonic()
+    cached = _speedtest_summary_cache
+    if cached and cached.get('version') == version and now - cached.get('built_at', 0) < SPEEDTEST_SUMMARY_TTL_SECONDS:
+        return cached.get('text')
+    text = _build_speedtest_summary_text()
+    _speedtest_summary_cache.update(version=version, built_at=now, text=text)
+    return text
+
+
 @user_router.callback_query(F.data == "user_speedtest")
 async def run_user_speedtest(callback: types.CallbackQuery):
     logger.info(f"SPEEDTEST: Handler called by user {callback.from_user.id}")
     try:
-        # Получаем список хостов
-        hosts = get_all_hosts() or []
-        if not hosts:
+        text = get_speedtest_summary_text()
+        if not text:
             await callback.answer("⚠️ Хосты не найдены в настройках.", show_alert=True)
             return
         
-        # Показываем последние результаты тестов скорости для всех хостов
-        text = "⚡️ <b>Результаты Speedtest</b>\n"
-        text += "<i>Нажмите кнопку «Обновить», чтобы запустить новый тест (это может занять время).</i>\n\n"
-        
-        for host in hosts:
-            host_name = host.get('host_name', 'Неизвестный хост')
-            latest_test = get_latest_speedtest(host_name)
-            
-            if latest_test:
-                ping = latest_test.get('ping_ms')
-                download = latest_test.get('download_mbps')
-                upload = latest_test.get('upload_mbps')
-                method = latest_test.get('method', 'unknown').upper()
-                created_at = latest_test.get('created_at', '—')
-                
-                # Форматируем время
-                try:
-                    if created_at and created_at != '—':
-                        if isinstance(created_at, str):
-                            dt = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
-                        else:
-                            dt = created_at
-                        time_str = dt.strftime('%d.%m %H:%M')
-                    else:
-                        time_str = '—'
-                except Exception:
-                    time_str = str(created_at)
-                
-                # Форматируем значения
-                ping_str = f"{ping:.2f}" if ping is not None else "—"
-                download_str = f"{download:.0f}" if download is not None else "—"
-                upload_str = f"{upload:.0f}" if upload is not None else "—"
-                
-                text += f"• 🌏 <b>{host_name}</b> ({method})\n"
-                text += f"   ✅ Ping: {ping_str} ms\n"
-                text += f"   ⬇️ Download: {download_str} Mbps\n"
-                text += f"   ⬆️ Upload: {upload_str} Mbps\n"
-                text += f"   🕒 {time_str}\n\n"
-            else:
-                text += f"• 🌏 <b>{host_name}</b> — Нет данных\n\n"
-        
         builder = InlineKeyboardBuilder()
         builder.button(text="🔄 Обновить", callback_data="refresh_speedtest")
         builder.button(text="🔙 Назад", callback_data="main_menu")
@@ -672,19 +744,11 @@ async def refresh_speedtest_handler(callback: types.CallbackQuery):
         if not hosts:
             return
 
-        # Запускаем тесты для всех хостов
-        # Лучше делать это асинхронно, но здесь мы просто подождем
-        # В идеале нужно использовать background task, но для простоты сделаем await
-        for host in hosts:
-            host_name = host.get('host_name')
-            if host_name:
-                try:
-                    # Используем run_both_for_host из speedtest_runner
-                    # Оборачиваем в timeout чтобы не висело вечно
-                    async with asyncio.timeout(60):
-                        await speedtest_runner.run_both_for_host(host_name)
-                except Exception as e:
-                    logger.error(f"Manual speedtest failed for {host_name}: {e}")
+        # Запускаем тесты для всех хостов параллельно (с ограничением по числу одновременных)
+        await speedtest_runner.run_speedtests_for_hosts(
+            [host.get('host_name') for host in hosts],
+            timeout=60,
+        )
         
         # После завершения вызываем отображение результатов
         await run_user_speedtest(callback)
@@ -699,102 +763,176 @@ PAYMENT_METHODS = {}
 
 
 # --- Successful Payment Processor ---
+class PaymentInProgressError(RuntimeError):
+    """Платёж сейчас обрабатывается другим воркером (или его захват ещё не признан брошенным)."""
+
+
+class PaymentDeliveryError(RuntimeError):
+    """Панель не создала и не продлила клиента (нет входа, не найден inbound, ошибка API) — изменений не было,
+    платёж можно повторить. user_message отправляется пользователю, когда повторов больше не будет."""
+
+    def __init__(self, message: str, user_message: str):
+        super().__init__(message)
+        self.user_message = user_message
+
+
 async def process_successful_payment(bot: Bot, metadata: dict):
     """
     Обработка успешного платежа.
     metadata: словарь с данными платежа (user_id, action, amount, payment_id, etc.)
     """
     try:
-        payment_id = metadata.get('payment_id')
-        user_id = int(metadata.get('user_id'))
-        action = metadata.get('action')
-        amount = float(metadata.get('price', 0))
-        
-        logger.info(f"Processing payment {payment_id} for user {user_id}, action: {action}, amount: {amount}")
+        await apply_successful_payment(bot, metadata)
+    except PaymentInProgressError as e:
+        logger.warning(f"Payment {metadata.get('payment_id')}: {e}")
+    except PaymentDeliveryError as e:
+        logger.error(f"Payment {metadata.get('payment_id')}: {e}")
+        await notify_payment_delivery_failed(bot, metadata, e)
+    except Exception as e:
+        logger.error(f"Error processing payment {metadata}: {e}", exc_info=True)
+
+
+async def apply_successful_payment(bot: Bot, metadata: dict):
+    """То же, что process_successful_payment, но ошибки пробрасываются (для повторов из очереди платежей).
+    Повторное уведомление по уже обработанному payment_id пропускается без обращения к панели,
+    а по платежу, который ещё обрабатывается, — PaymentInProgressError: очередь повторит позже."""
+    payment_id = metadata.get('payment_id')
+    if payment_id:
+        claim = claim_payment(str(payment_id))
+        if claim == PAYMENT_CLAIM_DONE:
+            logger.info(f"Payment {payment_id} already processed, duplicate skipped")
+            return
+        if claim == PAYMENT_CLAIM_BUSY:
+            raise PaymentInProgressError(f"платёж {payment_id} уже обрабатывается")
+    # applied выставляется перед зачислением на баланс и сразу после того, как панель создала/продлила клиента:
+    # неудачный вызов панели ничего не меняет, поэтому такой платёж повторяется
+    progress = {'applied': False}
+    try:
+        await _deliver_successful_payment(bot, metadata, progress)
+    except Exception as e:
+        if not progress['applied']:
+            if payment_id:
+                finish_payment_claim(str(payment_id), success=False)
+            raise
+        # Повтор начислил бы баланс или выдал ключ ещё раз — фиксируем платёж как обработанный
+        logger.error(f"Payment {payment_id}: error after the payment was applied, not retrying, manual check required: {e}", exc_info=True)
+    except BaseException:
+        # CancelledError при остановке бота: до применения захват снимается и платёж можно повторить
+        if payment_id:
+            finish_payment_claim(str(payment_id), success=progress['applied'])
+        raise
+    if payment_id:
+        finish_payment_claim(str(payment_id), success=True)
+
+
+async def _notify_payment_user(bot: Bot, user_id: int, text: str, **kwargs) -> None:
+    """Уведомление об оплате без гарантии доставки: платёж к этому моменту уже применён,
+    и ошибка отправки (например, бот заблокирован) не должна приводить к его повтору."""
+    try:
+        await message_dispatcher.send_message(bot, user_id, text=text, priority=message_dispatcher.PRIORITY_PAYMENT, **kwargs)
+    except Exception as e:
+        logger.warning(f"Payment notification to user {user_id} failed: {e}")
+
+
+async def notify_payment_delivery_failed(bot: Bot, metadata: dict, error: PaymentDeliveryError) -> None:
+    await _notify_payment_user(bot, int(metadata.get('user_id')), text=error.user_message)
+
+
+async def _deliver_successful_payment(bot: Bot, metadata: dict, progress: dict):
+    payment_id = metadata.get('payment_id')
+    user_id = int(metadata.get('user_id'))
+    action = metadata.get('action')
+    amount = float(metadata.get('price', 0))
+    
+    logger.info(f"Processing payment {payment_id} for user {user_id}, action: {action}, amount: {amount}")
+    
+    # Обновляем статус транзакции
+    update_transaction_status(payment_id, 'paid')
+    
+    if action == 'top_up':
+        # Пополнение баланса
+        progress['applied'] = True
+        new_balance = update_user_balance(user_id, amount)
+        await _notify_payment_user(
+            bot, user_id,
+            text=f"✅ Баланс успешно пополнен на {amount} RUB.\nТекущий баланс: {new_balance} RUB"
+        )
         
-        # Обновляем статус транзакции
-        update_transaction_status(payment_id, 'paid')
+    else:
+        # Покупка или продление ключа
+        plan_id = metadata.get('plan_id')
+        months = int(metadata.get('months', 1))
+        host_name = metadata.get('host_name')
+        email = metadata.get('customer_email')
+        key_id = metadata.get('key_id')
         
-        if action == 'top_up':
-            # Пополнение баланса
-            new_balance = update_user_balance(user_id, amount)
-            await bot.send_message(
-                chat_id=user_id,
-                text=f"✅ Баланс успешно пополнен на {amount} RUB.\nТекущий баланс: {new_balance} RUB"
-            )
-            
-        else:
-            # Покупка или продление ключа
-            plan_id = metadata.get('plan_id')
-            months = int(metadata.get('months', 1))
-            host_name = metadata.get('host_name')
-            email = metadata.get('customer_email')
-            key_id = metadata.get('key_id')
-            
-            if key_id:
-                # Продление существующего ключа
-                key_data = get_key_by_id(key_id)
-                if key_data:
-                    # Используем create_or_update_key_on_host для продления
-                    # days_to_add = months * 30 (примерно)
-                    days = months * 30
-                    result = await xui_api.create_or_update_key_on_host(
-                        key_data['host_name'], 
-                        key_data['key_email'], 
-                        days_to_add=days
-                    )
-                    
-                    if result:
-                        update_key_expiry(key_id, result['expiry_timestamp_ms'])
-                        await bot.send_message(
-                            chat_id=user_id, 
-                            text=f"✅ Ключ успешно продлен на {months} мес.\nНовая дата окончания: {datetime.fromtimestamp(result['expiry_timestamp_ms']/1000).strftime('%Y-%m-%d %H:%M')}"
-                        )
-                    else:
-                        await bot.send_message(chat_id=user_id, text="❌ Ошибка при продлении ключа на сервере. Обратитесь в поддержку.")
-                else:
-                    await bot.send_message(chat_id=user_id, text="❌ Ключ не найден в базе данных.")
-            else:
-                # Создание нового ключа
-                # Генерируем email если нет
-                if not email:
-                    import random
-                    import string
-                    suffix = ''.join(random.choices(string.ascii_lowercase + string.digits, k=6))
-                    email = f"user_{user_id}_{suffix}"
-                
-                # Создаем ключ в панели
-                # Используем create_or_update_key_on_host для создания
+        if key_id:
+            # Продление существующего ключа
+            key_data = get_key_by_id(key_id)
+            if key_data:
+                # Используем create_or_update_key_on_host для продления
+                # days_to_add = months * 30 (примерно)
                 days = months * 30
-                client = await xui_api.create_or_update_key_on_host(
-                    host_name, 
-                    email, 
+                result = await xui_api.create_or_update_key_on_host(
+                    key_data['host_name'], 
+                    key_data['key_email'], 
                     days_to_add=days
                 )
-                
-                if client:
-                    # Сохраняем в БД
-                    # create_or_update_key_on_host возвращает dict с client_uuid и expiry_timestamp_ms
-                    create_user_key(user_id, host_name, client['client_uuid'], email, client['expiry_timestamp_ms'])
-                    
-                    # Отправляем ключ пользователю
-                    msg = (
-                        f"✅ Оплата прошла успешно!\n\n"
-                        f"Ваш ключ доступа:\n<code>{client['connection_string']}</code>\n\n"
-                        f"Инструкции по настройке доступны в главном меню."
+                if not result:
+                    raise PaymentDeliveryError(
+                        f"panel did not extend key {key_data['key_email']} on host {key_data['host_name']}",
+                        "❌ Ошибка при продлении ключа на сервере. Обратитесь в поддержку.",
                     )
-                    await bot.send_message(chat_id=user_id, text=msg, parse_mode="HTML")
-                else:
-                    await bot.send_message(chat_id=user_id, text="✅ Оплата прошла, но возникла ошибка при создании ключа. Обратитесь в поддержку.")
-                    logger.error(f"Failed to create client for payment {payment_id}")
+                progress['applied'] = True
+                
+                update_key_expiry(key_id, result['expiry_timestamp_ms'])
+                await _notify_payment_user(
+                    bot, user_id,
+                    text=f"✅ Ключ успешно продлен на {months} мес.\nНовая дата окончания: {datetime.fromtimestamp(result['expiry_timestamp_ms']/1000).strftime('%Y-%m-%d %H:%M')}"
+                )
+            else:
+                await _notify_payment_user(bot, user_id, text="❌ Ключ не найден в базе данных.")
+        else:
+            # Создание нового ключа
+            # Генерируем email если нет
+            if not email:
+                import random
+                import string
+                suffix = ''.join(random.choices(string.ascii_lowercase + string.digits, k=6))
+                email = f"user_{user_id}_{suffix}"
+            
+            # Создаем ключ в панели
+            # Используем create_or_update_key_on_host для создания
+            days = months * 30
+            client = await xui_api.create_or_update_key_on_host(
+                host_name, 
+                email, 
+                days_to_add=days
+            )
+            if not client:
+                raise PaymentDeliveryError(
+                    f"panel did not create client {email} on host {host_name}",
+                    "✅ Оплата прошла, но возникла ошибка при создании ключа. Обратитесь в поддержку.",
+                )
+            progress['applied'] = True
+            
+            # Сохраняем в БД
+            # create_or_update_key_on_host возвращает dict с client_uuid и expiry_timestamp_ms
+            create_user_key(user_id, host_name, client['client_uuid'], email, client['expiry_timestamp_ms'])
+            
+            # Отправляем ключ пользователю
+            msg = (
+                f"✅ Оплата прошла успешно!\n\n"
+                f"Ваш ключ доступа:\n<code>{client['connection_string']}</code>\n\n"
+                f"Инструкции по настройке доступны в главном меню."
+            )
+            await _notify_payment_user(bot, user_id, text=msg, parse_mode="HTML")
 
-            # Применяем промокод если был
-            promo_code = metadata.get('promo_code')
-            if promo_code:
-                use_promo_code(promo_code, user_id)
+        # Применяем промокод если был
+        promo_code = metadata.get('promo_code')
+        if promo_code:
+            use_promo_code(promo_code, user_id)
 
-    except Exception as e:
-        logger.error(f"Error processing payment {metadata}: {e}", exc_info=True)
 
 
 # --- YooMoney Handlers ---
@@ -1,6 +1,7 @@
 import logging
 import hashlib
 import re
+import time
 
 from datetime import datetime
 from typing import Callable
@@ -55,31 +56,18 @@ def find_host_by_callback_token(hosts: list[dict], token: str) -> dict | None:
 
 
 # --- Generic builder from DB configs ---
-def _build_keyboard_from_db(
-    menu_type: str,
-    text_replacements: dict[str, str] | None = None,
+def _layout_db_rows(
+    configs: list[dict],
     filter_func: Callable[[dict], bool] | None = None,
-) -> InlineKeyboardMarkup | None:
-    """Build InlineKeyboardMarkup from button configs for a given menu_type.
-    Returns None if configs are missing or on error.
+) -> list[list[dict]] | None:
+    """Раскладывает конфиги кнопок по строкам клавиатуры с учётом позиций и ширины.
+    Возвращает список строк (каждая — список {'text', 'callback_data', 'url'}) или None.
     """
-    try:
-        from shop_bot.data_manager.database import get_button_configs
-        configs = get_button_configs(menu_type)
-    except Exception as e:
-        logger.warning(f"DB configs for {menu_type} not available: {e}")
-        return None
-
-    if not configs:
-        return None
-
-    builder = InlineKeyboardBuilder()
-
     # Group by row, keep positions and widths
     rows: dict[int, list[dict]] = {}
     added: set[str] = set()
 
-    for cfg in configs:
+    for cfg in configs or []:
         if not cfg.get('is_active', True):
             continue
         if filter_func and not filter_func(cfg):
@@ -99,14 +87,6 @@ def _build_keyboard_from_db(
                 continue
             added.add(button_id)
 
-        # Apply text replacements (e.g., counts)
-        if text_replacements:
-            try:
-                for k, v in text_replacements.items():
-                    text = text.replace(k, str(v))
-            except Exception:
-                pass
-
         row_pos = int(cfg.get('row_position', 0) or 0)
         col_pos = int(cfg.get('column_position', 0) or 0)
         sort_order = int(cfg.get('sort_order', 0) or 0)
@@ -124,234 +104,154 @@ def _build_keyboard_from_db(
     if not rows:
         return None
 
-    # Build keyboard respecting row positions and button widths
-    # In Telegram: width 1 = half row, width 2+ = full row
+    # In Telegram: width 1 = half row (pairs with the next width-1 button), width 2+ = full row
+    result: list[list[dict]] = []
     for row_idx in sorted(rows.keys()):
         row_buttons = sorted(rows[row_idx], key=lambda b: (b['col'], b['sort']))
-        
-        # Process buttons for this row position
         i = 0
         while i < len(row_buttons):
             btn = row_buttons[i]
-            button_width = btn['width']
-            
-            # Width 2+ means full row
-            if button_width >= 2:
-                # Add as single button in row
-                if btn['callback_data']:
-                    builder.row(InlineKeyboardButton(text=btn['text'], callback_data=btn['callback_data']))
-                elif btn['url']:
-                    builder.row(InlineKeyboardButton(text=btn['text'], url=btn['url']))
-                i += 1
+            if btn['width'] == 1 and i + 1 < len(row_buttons) and row_buttons[i + 1]['width'] == 1:
+                result.append([btn, row_buttons[i + 1]])
+                i += 2
             else:
-                # Width 1 - try to pair with next button if it also has width 1
-                if i + 1 < len(row_buttons) and row_buttons[i + 1]['width'] == 1:
-                    # Add two buttons in one row
-                    btn2 = row_buttons[i + 1]
-                    buttons = []
-                    
-                    if btn['callback_data']:
-                        buttons.append(InlineKeyboardButton(text=btn['text'], callback_data=btn['callback_data']))
-                    elif btn['url']:
-                        buttons.append(InlineKeyboardButton(text=btn['text'], url=btn['url']))
-                    
-                    if btn2['callback_data']:
-                        buttons.append(InlineKeyboardButton(text=btn2['text'], callback_data=btn2['callback_data']))
-                    elif btn2['url']:
-                        buttons.append(InlineKeyboardButton(text=btn2['text'], url=btn2['url']))
-                    
-                    builder.row(*buttons)
-                    i += 2
-                else:
-                    # Single button with width 1 - add alone
-                    if btn['callback_data']:
-                        builder.row(InlineKeyboardButton(text=btn['text'], callback_data=btn['callback_data']))
-                    elif btn['url']:
-                        builder.row(InlineKeyboardButton(text=btn['text'], url=btn['url']))
-                    i += 1
+                result.append([btn])
+                i += 1
+    return result
 
-    return builder.as_markup()
 
+def _make_button(text: str, callback_data: str | None, url: str | None) -> InlineKeyboardButton:
+    if callback_data:
+        return InlineKeyboardButton(text=text, callback_data=callback_data)
+    return InlineKeyboardButton(text=text, url=url)
+
+
+def _build_keyboard_from_db(
+    menu_type: str,
+    text_replacements: dict[str, str] | None = None,
+    filter_func: Callable[[dict], bool] | None = None,
+) -> InlineKeyboardMarkup | None:
+    """Build InlineKeyboardMarkup from button configs for a given menu_type.
+    Returns None if configs are missing or on error.
+    """
+    try:
+        from shop_bot.data_manager.database import get_button_configs
+        configs = get_button_configs(menu_type)
+    except Exception as e:
+        logger.warning(f"DB configs for {menu_type} not available: {e}")
+        return None
+
+    rows = _layout_db_rows(configs, filter_func)
+    if not rows:
+        return None
+
+    inline_keyboard = []
+    for row in rows:
+        buttons = []
+        for btn in row:
+            text = btn['text']
+            # Apply text replacements (e.g., counts)
+            if text_replacements:
+                for k, v in text_replacements.items():
+                    text = text.replace(k, str(v))
+            buttons.append(_make_button(text, btn['callback_data'], btn['url']))
+        inline_keyboard.append(buttons)
+    return InlineKeyboardMarkup(inline_keyboard=inline_keyboard)
+
+
+# --- Скомпилированные шаблоны главного меню ---
+# Шаблон — неизменяемый кортеж строк кнопок (text, callback_data, url, has_count) на вариант
+# (is_admin, trial_available). Сбрасывается при смене версии UI-конфигурации (кнопки/настройки)
+# и по TTL — на случай правок из другого процесса.
+MAIN_MENU_TEMPLATE_TTL_SECONDS = 300
+
+_main_menu_templates: dict[tuple[bool, bool], tuple[tuple[tuple[str, str | None, str | None, bool], ...], ...]] = {}
+_main_menu_templates_version: int | None = None
+_main_menu_templates_built_at = 0.0
+
+
+def invalidate_main_menu_templates():
+    global _main_menu_templates_version
+    _main_menu_templates.clear()
+    _main_menu_templates_version = None
+
+
+def _fallback_main_menu_rows(trial_visible: bool, is_admin: bool) -> list[list[dict]]:
+    def _btn(setting_key: str, default: str, callback_data: str) -> dict:
+        return {'text': get_setting(setting_key) or default, 'callback_data': callback_data, 'url': None}
+
+    rows = []
+    if trial_visible:
+        rows.append([_btn("btn_try", "🎁 Попробовать бесплатно", "get_trial")])
+    rows.append([_btn("btn_profile", "👤 Мой профиль", "show_profile"), _btn("btn_my_keys", "🔑 Мои ключи ({count})", "manage_keys")])
+    rows.append([_btn("btn_buy_key", "💳 Купить ключ", "buy_new_key"), _btn("btn_top_up", "➕ Пополнить баланс", "top_up_start")])
+    rows.append([_btn("btn_referral", "🤝 Реферальная программа", "show_referral_program")])
+    rows.append([_btn("btn_support", "🆘 Поддержка", "show_help"), _btn("btn_about", "ℹ️ О проекте", "show_about")])
+    rows.append([_btn("btn_howto", "❓ Как использовать", "howto_vless"), _btn("btn_speed", "⚡ Тест скорости", "user_speedtest")])
+    if is_admin:
+        rows.append([_btn("btn_admin", "⚙️ Админка", "admin_menu")])
+    return rows
+
+
+def _compile_main_menu_template(trial_available: bool, is_admin: bool):
+    trial_visible = bool(trial_available) and get_setting("trial_enabled") == "true"
 
-def create_main_menu_keyboard(user_keys: list, trial_available: bool, is_admin: bool) -> InlineKeyboardMarkup:
-    # Prepare filters and replacements for main menu
     def _filter(cfg: dict) -> bool:
         button_id = (cfg.get('button_id') or '').strip()
-        # Filter trial button
-        if button_id == 'btn_try':
-            if not trial_available or get_setting("trial_enabled") != "true":
-                return False
-        # Filter admin button
+        if button_id == 'btn_try' and not trial_visible:
+            return False
         if button_id == 'btn_admin' and not is_admin:
             return False
         return True
-    
-    # Text replacements for key count
-    replacements = {
-        '{count}': str(len(user_keys)),
-        '((count))': f'({len(user_keys)})'
-    }
-    
-    # Try DB-driven keyboard first
-    kb = _build_keyboard_from_db('main_menu', text_replacements=replacements, filter_func=_filter)
-    if kb:
-        return kb
-    
-    # Fallback to original implementation if DB config not available
-    builder = InlineKeyboardBuilder()
-    
-    # Try to get button configurations from database first
+
+    rows = None
     try:
         from shop_bot.data_manager.database import get_button_configs
-        button_configs = get_button_configs('main_menu')
-
-        logger.info(f"Loaded {len(button_configs)} button configs from database")
-
-        if button_configs:
-            # Группируем по строкам с учётом позиций
-            rows: dict[int, list[dict]] = {}
-            added_buttons: set[str] = set()
-
-            for cfg in button_configs:
-                if not cfg.get('is_active', True):
-                    continue
-
-                text = cfg.get('text', '') or ''
-                callback_data = cfg.get('callback_data')
-                url = cfg.get('url')
-                button_id = cfg.get('button_id', '') or ''
-
-                # Пропускаем пустые действия
-                if not callback_data and not url:
-                    continue
-
-                # Фильтры по условиям (trial/admin)
-                if button_id == 'btn_try':
-                    if not trial_available or get_setting("trial_enabled") != "true":
-                        continue
-                if button_id == 'btn_admin' and not is_admin:
-                    continue
-
-                # Подстановка счётчика ключей
-                if button_id == 'btn_my_keys':
-                    try:
-                        text = text.replace('{count}', str(len(user_keys))).replace('((count))', f'({len(user_keys)})')
-                    except Exception:
-                        pass
-                
-                # Исключаем дубликаты по button_id
-                if button_id:
-                    if button_id in added_buttons:
-                        logger.warning(f"Duplicate button detected: {button_id}, skipping")
-                        continue
-                    added_buttons.add(button_id)
-
-                row_pos = int(cfg.get('row_position', 0) or 0)
-                col_pos = int(cfg.get('column_position', 0) or 0)
-                sort_order = int(cfg.get('sort_order', 0) or 0)
-                width = int(cfg.get('button_width', 1) or 1)
-
-                rows.setdefault(row_pos, []).append({
-                    'text': text,
-                    'callback_data': callback_data,
-                    'url': url,
-                    'width': max(1, min(int(width), 3)),
-                    'col': col_pos,
-                    'sort': sort_order,
-                })
-
-            # Функция добавления кнопки в билдер
-            def _add(btn: dict):
-                if btn['callback_data']:
-                    builder.button(text=btn['text'], callback_data=btn['callback_data'])
-                elif btn['url']:
-                    builder.button(text=btn['text'], url=btn['url'])
-
-            # Build keyboard respecting row positions and button widths
-            # In Telegram: width 1 = half row, width 2+ = full row
-            for row_idx in sorted(rows.keys()):
-                row_buttons = sorted(rows[row_idx], key=lambda b: (b['col'], b['sort']))
-                
-                # Process buttons for this row position
-                i = 0
-                while i < len(row_buttons):
-                    btn = row_buttons[i]
-                    button_width = btn['width']
-                    
-                    # Width 2+ means full row
-                    if button_width >= 2:
-                        # Add as single button in row
-                        if btn['callback_data']:
-                            builder.row(InlineKeyboardButton(text=btn['text'], callback_data=btn['callback_data']))
-                        elif btn['url']:
-                            builder.row(InlineKeyboardButton(text=btn['text'], url=btn['url']))
-                        i += 1
-                    else:
-                        # Width 1 - try to pair with next button if it also has width 1
-                        if i + 1 < len(row_buttons) and row_buttons[i + 1]['width'] == 1:
-                            # Add two buttons in one row
-                            btn2 = row_buttons[i + 1]
-                            buttons = []
-                            
-                            if btn['callback_data']:
-                                buttons.append(InlineKeyboardButton(text=btn['text'], callback_data=btn['callback_data']))
-                            elif btn['url']:
-                                buttons.append(InlineKeyboardButton(text=btn['text'], url=btn['url']))
-                            
-                            if btn2['callback_data']:
-                                buttons.append(InlineKeyboardButton(text=btn2['text'], callback_data=btn2['callback_data']))
-                            elif btn2['url']:
-                                buttons.append(InlineKeyboardButton(text=btn2['text'], url=btn2['url']))
-                            
-                            builder.row(*buttons)
-                            i += 2
-                        else:
-                            # Single button with width 1 - add alone
-                            if btn['callback_data']:
-                                builder.row(InlineKeyboardButton(text=btn['text'], callback_data=btn['callback_data']))
-                            elif btn['url']:
-                                builder.row(InlineKeyboardButton(text=btn['text'], url=btn['url']))
-                            i += 1
-
-
-            return builder.as_markup()
+        rows = _layout_db_rows(get_button_configs('main_menu'), _filter)
     except Exception as e:
         logger.warning(f"Failed to load button configs from database: {e}, falling back to settings")
-    
-    # Fallback to original hardcoded logic
-    logger.info("Using fallback hardcoded button logic")
-    if trial_available and get_setting("trial_enabled") == "true":
-        builder.button(text=(get_setting("btn_try") or "🎁 Попробовать бесплатно"), callback_data="get_trial")
-
-    builder.button(text=(get_setting("btn_profile") or "👤 Мой профиль"), callback_data="show_profile")
-    keys_label_tpl = (get_setting("btn_my_keys") or "🔑 Мои ключи ({count})")
-    builder.button(text=keys_label_tpl.replace("{count}", str(len(user_keys))), callback_data="manage_keys")
-    builder.button(text=(get_setting("btn_buy_key") or "💳 Купить ключ"), callback_data="buy_new_key")
-    builder.button(text=(get_setting("btn_top_up") or "➕ Пополнить баланс"), callback_data="top_up_start")
-    builder.button(text=(get_setting("btn_referral") or "🤝 Реферальная программа"), callback_data="show_referral_program")
-    builder.button(text=(get_setting("btn_support") or "🆘 Поддержка"), callback_data="show_help")
-    builder.button(text=(get_setting("btn_about") or "ℹ️ О проекте"), callback_data="show_about")
-    builder.button(text=(get_setting("btn_howto") or "❓ Как использовать"), callback_data="howto_vless")
-    
-    speed_text = get_setting("btn_speed") or "⚡ Тест скорости"
-    builder.button(text=speed_text, callback_data="user_speedtest")
+    if not rows:
+        logger.info("Using fallback hardcoded button logic")
+        rows = _fallback_main_menu_rows(trial_visible, is_admin)
+
+    return tuple(
+        tuple(
+            (btn['text'], btn['callback_data'], btn['url'], '{count}' in btn['text'] or '((count))' in btn['text'])
+            for btn in row
+        )
+        for row in rows
+    )
+
+
+def _get_main_menu_template(trial_available: bool, is_admin: bool):
+    global _main_menu_templates_version, _main_menu_templates_built_at
+    from shop_bot.data_manager.database import get_ui_config_version
+    version = get_ui_config_version()
+    now = time.monotonic()
+    if version != _main_menu_templates_version or now - _main_menu_templates_built_at > MAIN_MENU_TEMPLATE_TTL_SECONDS:
+        _main_menu_templates.clear()
+        _main_menu_templates_version = version
+        _main_menu_templates_built_at = now
+    key = (bool(is_admin), bool(trial_available))
+    template = _main_menu_templates.get(key)
+    if template is None:
+        template = _compile_main_menu_template(trial_available, is_admin)
+        _main_menu_templates[key] = template
+    return template
 
-    if is_admin:
-        builder.button(text=(get_setting("btn_admin") or "⚙️ Админка"), callback_data="admin_menu")
-
-    layout = [
-        1 if trial_available and get_setting("trial_enabled") == "true" else 0,  # триал
-        2,  # профиль + мои ключи
-        2,  # купить ключ + пополнить баланс
-        1,  # рефералка
-        2,  # поддержка + о проекте
-        2,  # как использовать + тест скорости
-        1 if is_admin else 0,  # админка
-    ]
-    actual_layout = [size for size in layout if size > 0]
-    builder.adjust(*actual_layout)
-    
-    return builder.as_markup()
+
+def create_main_menu_keyboard(user_keys: list, trial_available: bool, is_admin: bool) -> InlineKeyboardMarkup:
+    template = _get_main_menu_template(trial_available, is_admin)
+    count = str(len(user_keys))
+    inline_keyboard = []
+    for row in template:
+        buttons = []
+        for text, callback_data, url, has_count in row:
+            if has_count:
+                text = text.replace('((count))', f'({count})').replace('{count}', count)
+            buttons.append(_make_button(text, callback_data, url))
+        inline_keyboard.append(buttons)
+    return InlineKeyboardMarkup(inline_keyboard=inline_keyboard)
 
 def create_admin_menu_keyboard() -> InlineKeyboardMarkup:
     # Try DB-driven keyboard first
@@ -392,31 +292,34 @@ def create_admin_monitor_keyboard() -> InlineKeyboardMarkup:
     builder.adjust(1, 1)
     return builder.as_markup()
 
-def create_admin_users_keyboard(users: list[dict], page: int = 0, page_size: int = 10) -> InlineKeyboardMarkup:
-    builder = InlineKeyboardBuilder()
-    start = page * page_size
-    end = start + page_size
-    for u in users[start:end]:
+def _add_users_pager(builder: InlineKeyboardBuilder, users: list[dict], prev_cursor: str | None, next_cursor: str | None,
+                     page_prefix: str, search_scope: str, query_active: bool, pick_prefix: str):
+    for u in users:
         user_id = u.get('telegram_id') or u.get('user_id') or u.get('id')
         username = u.get('username') or '—'
         title = f"{user_id} • @{username}" if username != '—' else f"{user_id}"
-        builder.button(text=title, callback_data=f"admin_view_user_{user_id}")
-    # pagination
-    total = len(users)
-    have_prev = page > 0
-    have_next = end < total
-    if have_prev:
-        builder.button(text="⬅️ Назад", callback_data=f"admin_users_page_{page-1}")
-    if have_next:
-        builder.button(text="Вперёд ➡️", callback_data=f"admin_users_page_{page+1}")
+        builder.button(text=title, callback_data=f"{pick_prefix}{user_id}")
+    # pagination: курсоры n{id}/p{id}, "0" — первая страница без поиска
+    if prev_cursor:
+        builder.button(text="⬅️ Назад", callback_data=f"{page_prefix}{prev_cursor}")
+    if next_cursor:
+        builder.button(text="Вперёд ➡️", callback_data=f"{page_prefix}{next_cursor}")
+    builder.button(text="🔍 Поиск", callback_data=f"admin_find_user:{search_scope}")
+    if query_active:
+        builder.button(text="✖️ Сбросить поиск", callback_data=f"{page_prefix}0")
     builder.button(text="⬅️ В админ-меню", callback_data="admin_menu")
-    # layout: list (1 per row), then pagination/buttons (2), then back (1)
-    rows = [1] * len(users[start:end])
-    tail = []
-    if have_prev or have_next:
-        tail.append(2 if (have_prev and have_next) else 1)
-    tail.append(1)
-    builder.adjust(*(rows + tail if rows else ([2] if (have_prev or have_next) else []) + [1]))
+    # layout: list (1 per row), then pagination (2), search row, back (1)
+    rows = [1] * len(users)
+    if prev_cursor or next_cursor:
+        rows.append(2 if (prev_cursor and next_cursor) else 1)
+    rows.append(2 if query_active else 1)
+    rows.append(1)
+    builder.adjust(*rows)
+
+def create_admin_users_keyboard(users: list[dict], prev_cursor: str | None = None, next_cursor: str | None = None,
+                                query_active: bool = False) -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    _add_users_pager(builder, users, prev_cursor, next_cursor, "admin_users_page_", "list", query_active, "admin_view_user_")
     return builder.as_markup()
 
 def create_admin_user_actions_keyboard(user_id: int, is_banned: bool | None = None) -> InlineKeyboardMarkup:
@@ -483,6 +386,23 @@ def create_admin_promo_code_keyboard() -> InlineKeyboardMarkup:
     builder.adjust(1)
     return builder.as_markup()
 
+def create_broadcast_segment_keyboard(segments: dict[str, str]) -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    for name, title in segments.items():
+        builder.button(text=title, callback_data=f"bcast_seg:{name}")
+    builder.button(text="❌ Отмена", callback_data="cancel_broadcast")
+    builder.adjust(1)
+    return builder.as_markup()
+
+def create_broadcast_host_keyboard(hosts: list[dict]) -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    # Индекс вместо имени: имя хоста может не поместиться в 64 байта callback_data
+    for idx, host in enumerate(hosts):
+        builder.button(text=host.get('host_name') or f"#{idx}", callback_data=f"bcast_seg_host:{idx}")
+    builder.button(text="❌ Отмена", callback_data="cancel_broadcast")
+    builder.adjust(1)
+    return builder.as_markup()
+
 def create_broadcast_options_keyboard() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.button(text="➕ Добавить кнопку", callback_data="broadcast_add_button")
@@ -493,7 +413,7 @@ def create_broadcast_options_keyboard() -> InlineKeyboardMarkup:
 
 def create_broadcast_confirmation_keyboard() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
-    builder.button(text="✅ Отправить всем", callback_data="confirm_broadcast")
+    builder.button(text="✅ Отправить", callback_data="confirm_broadcast")
     builder.button(text="❌ Отмена", callback_data="cancel_broadcast")
     builder.adjust(2)
     return builder.as_markup()
@@ -934,29 +854,11 @@ def get_buy_button() -> InlineKeyboardButton:
     return InlineKeyboardButton(text="💳 Купить подписку", callback_data="buy_vpn")
 
 
-def create_admin_users_pick_keyboard(users: list[dict], page: int = 0, page_size: int = 10, action: str = "gift") -> InlineKeyboardMarkup:
+def create_admin_users_pick_keyboard(users: list[dict], prev_cursor: str | None = None, next_cursor: str | None = None,
+                                     action: str = "gift", query_active: bool = False) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
-    start = page * page_size
-    end = start + page_size
-    for u in users[start:end]:
-        user_id = u.get('telegram_id') or u.get('user_id') or u.get('id')
-        username = u.get('username') or '—'
-        title = f"{user_id} • @{username}" if username != '—' else f"{user_id}"
-        builder.button(text=title, callback_data=f"admin_{action}_pick_user_{user_id}")
-    total = len(users)
-    have_prev = page > 0
-    have_next = end < total
-    if have_prev:
-        builder.button(text="⬅️ Назад", callback_data=f"admin_{action}_pick_user_page_{page-1}")
-    if have_next:
-        builder.button(text="Вперёд ➡️", callback_data=f"admin_{action}_pick_user_page_{page+1}")
-    builder.button(text="⬅️ В админ-меню", callback_data="admin_menu")
-    rows = [1] * len(users[start:end])
-    tail = []
-    if have_prev or have_next:
-        tail.append(2 if (have_prev and have_next) else 1)
-    tail.append(1)
-    builder.adjust(*(rows + tail if rows else ([2] if (have_prev or have_next) else []) + [1]))
+    _add_users_pager(builder, users, prev_cursor, next_cursor, f"admin_{action}_pick_user_page_", action, query_active,
+                     f"admin_{action}_pick_user_")
     return builder.as_markup()
 
 def create_admin_hosts_pick_keyboard(hosts: list[dict], action: str = "gift") -> InlineKeyboardMarkup:
@@ -0,0 +1,362 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from typing import Any
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты исходящих сообщений (меньше — важнее)
+PRIORITY_PAYMENT = 0      # чеки об оплате, выдача ключей
+PRIORITY_ALERT = 10       # уведомления о бане, алерты администраторам
+PRIORITY_NOTIFY = 20      # напоминания о подписке, бэкапы, сервисные сообщения
+PRIORITY_MARKETING = 30   # рассылки
+
+# Лимиты Telegram: ~30 сообщений/сек на бота и ~1 сообщение/сек в один чат
+GLOBAL_RATE_PER_SECOND = 30.0
+PER_CHAT_INTERVAL_SECONDS = 1.0
+MAX_RETRIES = 3
+MAX_QUEUE_SIZE = 50000
+NETWORK_BACKOFF_MAX_SECONDS = 30.0
+
+_dispatchers: dict[int, "MessageDispatcher"] = {}
+
+
+class _OutboundJob:
+    __slots__ = ("priority", "seq", "method", "chat_id", "kwargs", "future", "attempts", "not_before", "enqueued_at")
+
+    def __init__(self, priority: int, seq: int, method: str, chat_id: int | str, kwargs: dict, future: asyncio.Future):
+        self.priority = priority
+        self.seq = seq
+        self.method = method
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.future = future
+        self.attempts = 0
+        self.not_before = 0.0
+        self.enqueued_at = time.monotonic()
+
+    def __lt__(self, other: "_OutboundJob") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class MessageDispatcher:
+    """
+    Очередь исходящих сообщений одного бота: глобальный token bucket,
+    пауза между сообщениями в один чат, приоритеты и повтор при TelegramRetryAfter.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        name: str = "main",
+        rate_per_second: float = GLOBAL_RATE_PER_SECOND,
+        per_chat_interval: float = PER_CHAT_INTERVAL_SECONDS,
+        max_retries: int = MAX_RETRIES,
+        max_queue_size: int = MAX_QUEUE_SIZE,
+    ):
+        self.bot = bot
+        self.name = name
+        self._rate = max(0.1, float(rate_per_second))
+        self._capacity = max(1.0, float(rate_per_second))
+        self._tokens = self._capacity
+        self._last_refill = time.monotonic()
+        self._per_chat_interval = max(0.0, float(per_chat_interval))
+        self._max_retries = max(0, int(max_retries))
+        self._max_queue_size = max(1, int(max_queue_size))
+
+        self._heap: list[_OutboundJob] = []
+        self._seq = itertools.count()
+        self._chat_next_at: dict[Any, float] = {}
+        self._chat_busy: set = set()
+        self._in_flight: set[asyncio.Task] = set()
+        self._paused_until = 0.0
+
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+
+        self._metrics = {
+            "enqueued": 0,
+            "sent": 0,
+            "failed": 0,
+            "retried": 0,
+            "retry_after": 0,
+            "dropped": 0,
+            "sent_by_priority": {},
+            "queue_wait_total_ms": 0.0,
+            "queue_wait_max_ms": 0.0,
+            "last_error": None,
+        }
+
+    # --- Жизненный цикл ---
+
+    def start(self) -> None:
+        """Запускает воркер в текущем цикле событий и регистрирует диспетчер для бота."""
+        if self._task and not self._task.done():
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = self._loop.create_task(self._run())
+        _dispatchers[id(self.bot)] = self
+        logger.info(f"Очередь отправки ({self.name}): запущена, лимит {self._rate:g} сообщ./сек.")
+
+    async def stop(self, drain_timeout: float = 5.0) -> None:
+        """Дожидается отправки очереди (не дольше drain_timeout) и останавливает воркер."""
+        if _dispatchers.get(id(self.bot)) is self:
+            _dispatchers.pop(id(self.bot), None)
+        deadline = time.monotonic() + max(0.0, drain_timeout)
+        while (self._heap or self._in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+        for task in list(self._in_flight):
+            task.cancel()
+        left = len(self._heap)
+        while self._heap:
+            job = heapq.heappop(self._heap)
+            if not job.future.done():
+                job.future.set_exception(RuntimeError("Очередь отправки остановлена"))
+        if left:
+            logger.warning(f"Очередь отправки ({self.name}): остановлена, не отправлено {left} сообщений.")
+        else:
+            logger.info(f"Очередь отправки ({self.name}): остановлена.")
+
+    def is_running(self) -> bool:
+        return bool(self._task and not self._task.done())
+
+    def accepts_current_loop(self) -> bool:
+        """True, если вызов идёт из цикла событий, в котором работает воркер."""
+        if not self.is_running():
+            return False
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    # --- Постановка в очередь ---
+
+    def submit(self, method: str, chat_id: int | str, priority: int = PRIORITY_NOTIFY, **kwargs) -> asyncio.Future:
+        """
+        Ставит вызов метода бота (send_message, send_document, copy_message, ...) в очередь.
+        Возвращает future с результатом вызова или исключением.
+        """
+        future = self._loop.create_future()
+        if len(self._heap) >= self._max_queue_size:
+            self._metrics["dropped"] += 1
+            future.set_exception(RuntimeError("Очередь отправки переполнена"))
+            return future
+        job = _OutboundJob(int(priority), next(self._seq), method, chat_id, kwargs, future)
+        heapq.heappush(self._heap, job)
+        self._metrics["enqueued"] += 1
+        self._wakeup.set()
+        return future
+
+    # --- Метрики ---
+
+    def get_metrics(self) -> dict:
+        m = self._metrics
+        delivered = m["sent"] + m["failed"]
+        now = time.monotonic()
+        return {
+            "name": self.name,
+            "running": self.is_running(),
+            "queue_depth": len(self._heap),
+            "in_flight": len(self._in_flight),
+            "enqueued": m["enqueued"],
+            "sent": m["sent"],
+            "failed": m["failed"],
+            "retried": m["retried"],
+            "retry_after": m["retry_after"],
+            "dropped": m["dropped"],
+            "sent_by_priority": dict(m["sent_by_priority"]),
+            "avg_queue_wait_ms": round(m["queue_wait_total_ms"] / delivered, 1) if delivered else 0.0,
+            "max_queue_wait_ms": round(m["queue_wait_max_ms"], 1),
+            "paused_for_seconds": round(max(0.0, self._paused_until - now), 1),
+            "last_error": m["last_error"],
+        }
+
+    # --- Воркер ---
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._last_refill
+        if elapsed > 0:
+            self._tokens = min(self._capacity, self._tokens + elapsed * self._rate)
+            self._last_refill = now
+
+    def _pick(self, now: float) -> tuple[_OutboundJob | None, float | None]:
+        """Достаёт самое приоритетное задание, чей чат уже можно беспокоить."""
+        deferred: list[_OutboundJob] = []
+        picked = None
+        wait: float | None = None
+        while self._heap:
+            job = heapq.heappop(self._heap)
+            if job.future.done():
+                continue
+            if job.chat_id in self._chat_busy:
+                deferred.append(job)
+                continue
+            ready_at = max(job.not_before, self._chat_next_at.get(job.chat_id, 0.0))
+            if ready_at > now:
+                deferred.append(job)
+                delay = ready_at - now
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            picked = job
+            break
+        for job in deferred:
+            heapq.heappush(self._heap, job)
+        return picked, wait
+
+    async def _sleep(self, timeout: float | None) -> None:
+        self._wakeup.clear()
+        try:
+            if timeout is None:
+                await self._wakeup.wait()
+            else:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.01, timeout))
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self) -> None:
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+
+            self._refill(now)
+            if self._tokens < 1.0:
+                await asyncio.sleep((1.0 - self._tokens) / self._rate)
+                continue
+
+            job, wait = self._pick(now)
+            if job is None:
+                await self._sleep(wait)
+                continue
+
+            self._tokens -= 1.0
+            self._chat_busy.add(job.chat_id)
+            self._chat_next_at[job.chat_id] = now + self._per_chat_interval
+            task = asyncio.create_task(self._deliver(job))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+            if len(self._chat_next_at) > 10000:
+                self._chat_next_at = {k: v for k, v in self._chat_next_at.items() if v > now}
+
+    def _requeue(self, job: _OutboundJob, delay: float) -> bool:
+        if job.attempts >= self._max_retries:
+            return False
+        job.attempts += 1
+        job.not_before = time.monotonic() + max(0.0, delay)
+        heapq.heappush(self._heap, job)
+        self._metrics["retried"] += 1
+        return True
+
+    def _fail(self, job: _OutboundJob, exc: BaseException) -> None:
+        self._metrics["failed"] += 1
+        self._metrics["last_error"] = f"{type(exc).__name__}: {exc}"
+        self._record_wait(job)
+        if not job.future.done():
+            job.future.set_exception(exc)
+
+    def _record_wait(self, job: _OutboundJob) -> None:
+        wait_ms = (time.monotonic() - job.enqueued_at) * 1000.0
+        self._metrics["queue_wait_total_ms"] += wait_ms
+        if wait_ms > self._metrics["queue_wait_max_ms"]:
+            self._metrics["queue_wait_max_ms"] = wait_ms
+
+    async def _deliver(self, job: _OutboundJob) -> None:
+        try:
+            method = getattr(self.bot, job.method)
+            result = await method(chat_id=job.chat_id, **job.kwargs)
+        except TelegramRetryAfter as e:
+            delay = float(getattr(e, "retry_after", 1) or 1)
+            self._metrics["retry_after"] += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            logger.warning(f"Очередь отправки ({self.name}): RetryAfter {delay:g} сек. (чат {job.chat_id})")
+            if not self._requeue(job, delay):
+                self._fail(job, e)
+        except (TelegramNetworkError, TelegramServerError) as e:
+            backoff = min(NETWORK_BACKOFF_MAX_SECONDS, 2.0 ** (job.attempts + 1))
+            if not self._requeue(job, backoff):
+                self._fail(job, e)
+        except asyncio.CancelledError:
+            if not job.future.done():
+                job.future.cancel()
+            raise
+        except Exception as e:
+            self._fail(job, e)
+        else:
+            self._metrics["sent"] += 1
+            by_prio = self._metrics["sent_by_priority"]
+            by_prio[job.priority] = by_prio.get(job.priority, 0) + 1
+            self._record_wait(job)
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._chat_busy.discard(job.chat_id)
+            if self._wakeup:
+                self._wakeup.set()
+
+
+def get_dispatcher(bot: Bot | None) -> MessageDispatcher | None:
+    if bot is None:
+        return None
+    return _dispatchers.get(id(bot))
+
+
+def get_all_metrics() -> dict[str, dict]:
+    """Метрики всех запущенных очередей отправки (по имени бота)."""
+    return {d.name: d.get_metrics() for d in list(_dispatchers.values())}
+
+
+async def _send(bot: Bot, method: str, chat_id: int | str, priority: int, **kwargs) -> Any:
+    dispatcher = get_dispatcher(bot)
+    if dispatcher is not None and dispatcher.accepts_current_loop():
+        return await dispatcher.submit(method, chat_id, priority=priority, **kwargs)
+    # Очередь не запущена или вызов из другого цикла событий — отправляем напрямую
+    return await getattr(bot, method)(chat_id=chat_id, **kwargs)
+
+
+async def send_message(bot: Bot, chat_id: int | str, text: str, *, priority: int = PRIORITY_NOTIFY, **kwargs) -> Any:
+    return await _send(bot, "send_message", chat_id, priority, text=text, **kwargs)
+
+
+async def send_document(bot: Bot, chat_id: int | str, document: Any, *, priority: int = PRIORITY_NOTIFY, **kwargs) -> Any:
+    return await _send(bot, "send_document", chat_id, priority, document=document, **kwargs)
+
+
+async def copy_message(
+    bot: Bot,
+    chat_id: int | str,
+    from_chat_id: int | str,
+    message_id: int,
+    *,
+    priority: int = PRIORITY_MARKETING,
+    **kwargs,
+) -> Any:
+    return await _send(bot, "copy_message", chat_id, priority, from_chat_id=from_chat_id, message_id=message_id, **kwargs)
+
+
+async def edit_message_text(
+    bot: Bot,
+    chat_id: int | str,
+    message_id: int,
+    text: str,
+    *,
+    priority: int = PRIORITY_ALERT,
+    **kwargs,
+) -> Any:
+    return await _send(bot, "edit_message_text", chat_id, priority, message_id=message_id, text=text, **kwargs)
@@ -2,7 +2,8 @@ from typing import Callable, Dict, Any, Awaitable
 from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject, Message, CallbackQuery, Chat
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from shop_bot.data_manager.database import get_user, get_setting
+from shop_bot.data_manager.database import is_user_banned, get_setting
+from shop_bot.bot import message_dispatcher
 
 class BanMiddleware(BaseMiddleware):
     async def __call__(
@@ -15,8 +16,8 @@ class BanMiddleware(BaseMiddleware):
         if not user:
             return await handler(event, data)
 
-        user_data = get_user(user.id)
-        if user_data and user_data.get('is_banned'):
+        # Проверка по кэшу в памяти: для незабаненных — без обращения к БД
+        if is_user_banned(user.id):
             ban_message_text = "🚫 Вы заблокированы и не можете использовать этого бота."
             # Соберём клавиатуру поддержки без кнопки "Назад в меню"
             try:
@@ -49,9 +50,9 @@ class BanMiddleware(BaseMiddleware):
                 # Показать алерт и дополнительно отправить сообщение с кнопкой поддержки
                 await event.answer(ban_message_text, show_alert=True)
                 try:
-                    await event.bot.send_message(
-                        chat_id=event.from_user.id,
-                        text=ban_message_text,
+                    await message_dispatcher.send_message(
+                        event.bot, event.from_user.id, ban_message_text,
+                        priority=message_dispatcher.PRIORITY_ALERT,
                         reply_markup=ban_kb
                     )
                 except Exception:
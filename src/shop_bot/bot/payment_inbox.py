@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import time
+
+from aiogram import Bot
+
+from shop_bot.data_manager import database
+
+logger = logging.getLogger(__name__)
+
+# Воркер очереди входящих платежей: веб-сервер только сохраняет уведомление и отвечает провайдеру,
+# а выдача ключа / зачисление выполняются здесь, с повторами при ошибках и после перезапуска бота.
+INBOX_WORKERS = 4
+INBOX_BATCH_SIZE = 20
+POLL_INTERVAL_SECONDS = 5
+# Сколько запись «принадлежит» воркеру; если процесс упал, по истечении её заберёт другой.
+# Аренда длиннее окна брошенного захвата платежа: к повторной выдаче записи захват уже можно перехватить
+LEASE_SECONDS = database.PAYMENT_CLAIM_STALE_SECONDS + 300
+# Платёж ещё обрабатывается (захват не снят) — проверяем снова через это время, без учёта как ошибки
+BUSY_RETRY_SECONDS = 60
+MAX_ATTEMPTS = 8
+RETRY_BASE_SECONDS = 15
+RETRY_MAX_SECONDS = 3600
+
+_task: asyncio.Task | None = None
+_wake_event: asyncio.Event | None = None
+
+
+def retry_delay(attempts: int) -> float:
+    return min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** max(0, attempts - 1))
+
+
+def wake() -> None:
+    """Будит воркер после нового уведомления. Вызывать в цикле событий (call_soon_threadsafe)."""
+    if _wake_event is not None:
+        _wake_event.set()
+
+
+def start(bot: Bot) -> None:
+    global _task, _wake_event
+    if _task and not _task.done():
+        return
+    _wake_event = asyncio.Event()
+    _task = asyncio.create_task(_run(bot))
+
+
+async def stop() -> None:
+    global _task, _wake_event
+    task, _task = _task, None
+    _wake_event = None
+    if task and not task.done():
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+
+async def _process_event(bot: Bot, event: dict) -> None:
+    from shop_bot.bot import handlers
+
+    inbox_id = event['inbox_id']
+    label = f"{event['provider']}/{event['external_id']}"
+    metadata = event['metadata']
+    # Ключ идемпотентности: payment_id из метаданных, иначе идентификатор уведомления провайдера
+    metadata.setdefault('payment_id', f"{event['provider']}:{event['external_id']}")
+    try:
+        await handlers.apply_successful_payment(bot, metadata)
+    except handlers.PaymentInProgressError as e:
+        logger.info(f"Платёж {label}: {e}, повтор через {BUSY_RETRY_SECONDS} с")
+        await asyncio.to_thread(database.defer_payment_event, inbox_id, time.time() + BUSY_RETRY_SECONDS)
+        return
+    except Exception as e:
+        attempts = event['attempts']
+        if attempts >= MAX_ATTEMPTS:
+            logger.error(f"Платёж {label}: не обработан после {attempts} попыток, нужна ручная проверка: {e}", exc_info=True)
+            await asyncio.to_thread(database.fail_payment_event, inbox_id, f"{type(e).__name__}: {e}", None)
+            if isinstance(e, handlers.PaymentDeliveryError):
+                await handlers.notify_payment_delivery_failed(bot, metadata, e)
+        else:
+            delay = retry_delay(attempts)
+            logger.warning(f"Платёж {label}: ошибка обработки (попытка {attempts}), повтор через {int(delay)} с: {e}")
+            await asyncio.to_thread(database.fail_payment_event, inbox_id, f"{type(e).__name__}: {e}", time.time() + delay)
+        return
+    await asyncio.to_thread(database.complete_payment_event, inbox_id)
+
+
+async def _run(bot: Bot) -> None:
+    semaphore = asyncio.Semaphore(INBOX_WORKERS)
+
+    async def _guarded(event: dict) -> None:
+        async with semaphore:
+            await _process_event(bot, event)
+
+    logger.info("Очередь платежей: воркер запущен.")
+    while True:
+        try:
+            events = await asyncio.to_thread(database.claim_payment_events, INBOX_BATCH_SIZE, LEASE_SECONDS)
+            if events:
+                await asyncio.gather(*(_guarded(ev) for ev in events))
+                if len(events) >= INBOX_BATCH_SIZE:
+                    continue
+            event = _wake_event
+            if event is None:
+                return
+            try:
+                await asyncio.wait_for(event.wait(), timeout=POLL_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            event.clear()
+        except asyncio.CancelledError:
+            logger.info("Очередь платежей: воркер остановлен.")
+            raise
+        except Exception as e:
+            logger.error(f"Очередь платежей: ошибка цикла воркера: {e}", exc_info=True)
+            await asyncio.sleep(POLL_INTERVAL_SECONDS)
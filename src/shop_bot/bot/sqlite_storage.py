@@ -0,0 +1,54 @@
+import asyncio
+import json
+import logging
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from shop_bot.data_manager import database
+
+logger = logging.getLogger(__name__)
+
+# Состояния, которые не менялись дольше суток, считаются брошенными и удаляются планировщиком
+FSM_STATE_TTL_SECONDS = 24 * 3600
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище aiogram в общей БД: состояние диалога видно всем процессам и переживает рестарт."""
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        parts = [str(key.bot_id), str(key.chat_id), str(key.user_id)]
+        if key.thread_id:
+            parts.append(f"t{key.thread_id}")
+        if key.business_connection_id:
+            parts.append(f"b{key.business_connection_id}")
+        parts.append(key.destiny)
+        return ":".join(parts)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        await asyncio.to_thread(database.fsm_set_state, self._key(key), value)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = await asyncio.to_thread(database.fsm_get_record, self._key(key))
+        return record[0] if record else None
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        payload = json.dumps(dict(data), ensure_ascii=False, default=str) if data else None
+        await asyncio.to_thread(database.fsm_set_data, self._key(key), payload)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = await asyncio.to_thread(database.fsm_get_record, self._key(key))
+        if not record or not record[1]:
+            return {}
+        try:
+            data = json.loads(record[1])
+        except (TypeError, ValueError):
+            logger.warning(f"FSM: повреждённые данные для {self._key(key)}, сбрасываю.")
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    async def close(self) -> None:
+        pass
@@ -0,0 +1,197 @@
+import asyncio
+import hmac
+import logging
+import secrets
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+from shop_bot.data_manager import database
+
+logger = logging.getLogger(__name__)
+
+# Приём обновлений Telegram через вебхук (альтернатива long polling).
+# Один aiohttp-сервер на процесс, боты регистрируются как эндпоинты /tg/<name>.
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+DEFAULT_LISTEN_HOST = "127.0.0.1"
+DEFAULT_LISTEN_PORT = 8443
+DEFAULT_CONCURRENCY = 32
+MAX_CONCURRENCY = 256
+# Сколько обновлений может ждать обработки на каждый воркер, прежде чем отвечать 503 (Telegram повторит позже)
+BACKLOG_PER_WORKER = 10
+DRAIN_TIMEOUT_SECONDS = 10
+
+_endpoints: dict[str, "WebhookEndpoint"] = {}
+_runner: web.AppRunner | None = None
+_server_lock: asyncio.Lock | None = None
+
+
+def is_webhook_mode() -> bool:
+    return (database.get_setting("bot_update_mode") or "polling").strip().lower() == "webhook"
+
+
+def get_webhook_secret() -> str:
+    """Секрет для заголовка X-Telegram-Bot-Api-Secret-Token; генерируется при первом запуске."""
+    secret = (database.get_setting("bot_webhook_secret") or "").strip()
+    if not secret:
+        secret = secrets.token_urlsafe(32)
+        database.update_setting("bot_webhook_secret", secret)
+    return secret
+
+
+def get_webhook_config() -> dict:
+    base_url = (database.get_setting("bot_webhook_base_url") or "").strip()
+    if not base_url:
+        domain = (database.get_setting("domain") or "").strip()
+        if domain:
+            base_url = domain if domain.startswith(("http://", "https://")) else f"https://{domain}"
+    try:
+        port = int(database.get_setting("bot_webhook_port") or DEFAULT_LISTEN_PORT)
+    except (TypeError, ValueError):
+        port = DEFAULT_LISTEN_PORT
+    try:
+        concurrency = int(database.get_setting("bot_webhook_concurrency") or DEFAULT_CONCURRENCY)
+    except (TypeError, ValueError):
+        concurrency = DEFAULT_CONCURRENCY
+    return {
+        "base_url": base_url.rstrip("/"),
+        "listen_host": (database.get_setting("bot_webhook_listen_host") or DEFAULT_LISTEN_HOST).strip(),
+        "listen_port": port,
+        "concurrency": max(1, min(MAX_CONCURRENCY, concurrency)),
+    }
+
+
+class WebhookEndpoint:
+    def __init__(self, name: str, dp: Dispatcher, bot: Bot, secret: str, concurrency: int):
+        self.name = name
+        self.dp = dp
+        self.bot = bot
+        self.secret = secret
+        self.concurrency = concurrency
+        self.max_pending = concurrency * BACKLOG_PER_WORKER
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._tasks: set[asyncio.Task] = set()
+        self.received = 0
+        self.rejected = 0
+
+    @property
+    def pending(self) -> int:
+        return len(self._tasks)
+
+    def check_secret(self, value: str | None) -> bool:
+        return bool(value) and hmac.compare_digest(value, self.secret)
+
+    def spawn(self, update: Update) -> None:
+        self.received += 1
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _process(self, update: Update) -> None:
+        async with self._semaphore:
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                logger.error(f"Вебхук [{self.name}]: ошибка обработки обновления {update.update_id}: {e}", exc_info=True)
+
+    async def drain(self, timeout: float = DRAIN_TIMEOUT_SECONDS) -> None:
+        if not self._tasks:
+            return
+        done, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning(f"Вебхук [{self.name}]: прервано {len(pending)} незавершённых обновлений при остановке.")
+
+
+async def _handle_update(request: web.Request) -> web.Response:
+    endpoint = _endpoints.get(request.match_info.get("name", ""))
+    if endpoint is None:
+        return web.Response(status=404)
+    if not endpoint.check_secret(request.headers.get(SECRET_HEADER)):
+        logger.warning(f"Вебхук [{endpoint.name}]: запрос с неверным секретом от {request.remote}")
+        return web.Response(status=401)
+    if endpoint.pending >= endpoint.max_pending:
+        endpoint.rejected += 1
+        return web.Response(status=503)
+    try:
+        payload = await request.json()
+        update = Update.model_validate(payload, context={"bot": endpoint.bot})
+    except Exception as e:
+        logger.warning(f"Вебхук [{endpoint.name}]: не удалось разобрать обновление: {e}")
+        return web.Response(status=400)
+    # Отвечаем сразу: обработка идёт в фоне с ограничением параллельности
+    endpoint.spawn(update)
+    return web.Response(status=200)
+
+
+async def _ensure_server(listen_host: str, listen_port: int) -> None:
+    global _runner
+    if _runner is not None:
+        return
+    app = web.Application()
+    app.router.add_post("/tg/{name}", _handle_update)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, listen_host, listen_port)
+    await site.start()
+    _runner = runner
+    logger.info(f"Вебхук-сервер Telegram слушает http://{listen_host}:{listen_port}/tg/<bot>")
+
+
+def _get_lock() -> asyncio.Lock:
+    global _server_lock
+    if _server_lock is None:
+        _server_lock = asyncio.Lock()
+    return _server_lock
+
+
+async def start_webhook(name: str, dp: Dispatcher, bot: Bot) -> WebhookEndpoint:
+    """Поднимает приёмник (если ещё не запущен), регистрирует бота и вызывает set_webhook."""
+    config = get_webhook_config()
+    if not config["base_url"]:
+        raise RuntimeError("Не задан публичный адрес вебхука (bot_webhook_base_url или domain).")
+    secret = get_webhook_secret()
+    endpoint = WebhookEndpoint(name, dp, bot, secret, config["concurrency"])
+    async with _get_lock():
+        await _ensure_server(config["listen_host"], config["listen_port"])
+        _endpoints[name] = endpoint
+    url = f"{config['base_url']}/tg/{name}"
+    await bot.set_webhook(
+        url=url,
+        secret_token=secret,
+        max_connections=min(100, config["concurrency"]),
+        allowed_updates=dp.resolve_used_update_types(),
+        drop_pending_updates=False,
+    )
+    logger.info(f"Вебхук [{name}]: установлен {url} (параллельно до {config['concurrency']} обновлений).")
+    return endpoint
+
+
+async def stop_webhook(name: str) -> None:
+    """Снимает вебхук у Telegram, дожидается обработки принятых обновлений и гасит сервер, если он больше не нужен."""
+    global _runner
+    endpoint = _endpoints.get(name)
+    if endpoint is None:
+        return
+    try:
+        await endpoint.bot.delete_webhook(drop_pending_updates=False)
+        logger.info(f"Вебхук [{name}]: снят.")
+    except Exception as e:
+        logger.warning(f"Вебхук [{name}]: не удалось снять вебхук: {e}")
+    async with _get_lock():
+        _endpoints.pop(name, None)
+    await endpoint.drain()
+    async with _get_lock():
+        if not _endpoints and _runner is not None:
+            runner, _runner = _runner, None
+            await runner.cleanup()
+            logger.info("Вебхук-сервер Telegram остановлен.")
+
+
+def get_stats() -> dict:
+    return {
+        name: {"pending": ep.pending, "received": ep.received, "rejected": ep.rejected, "concurrency": ep.concurrency}
+        for name, ep in _endpoints.items()
+    }
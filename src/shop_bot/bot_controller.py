@@ -10,17 +10,26 @@ from shop_bot.data_manager import database
 from shop_bot.bot.handlers import get_user_router
 from shop_bot.bot.admin_handlers import get_admin_router
 from shop_bot.bot.middlewares import BanMiddleware
+from shop_bot.bot.handler_metrics import HandlerMetricsMiddleware
+from shop_bot.bot.message_dispatcher import MessageDispatcher
+from shop_bot.bot import payment_inbox
+from shop_bot.bot import update_webhook
+from shop_bot.bot.sqlite_storage import SQLiteStorage
 from shop_bot.bot import handlers
 
 logger = logging.getLogger(__name__)
 
 class BotController:
     def __init__(self):
-        self._dp = Dispatcher()
+        # FSM в общей БД: состояния не теряются при рестарте и доступны нескольким воркерам
+        self._dp = Dispatcher(storage=SQLiteStorage())
         self._bot = None
         self._task = None
         self._is_running = False
         self._loop = None
+        self._outbox: MessageDispatcher | None = None
+        # Событие остановки для режима вебхука (в режиме опроса не используется)
+        self._webhook_stop: asyncio.Event | None = None
 
         # Инициализация роутеров и middleware один раз при создании контроллера
         self._setup_dispatcher()
@@ -28,6 +37,8 @@ class BotController:
     def _setup_dispatcher(self):
         """Настройка диспетчера: middleware и роутеры"""
         # Вешаем BanMiddleware на уровни событий, где доступен event_from_user
+        # Замер задержки по обработчикам (кнопки/команды) — снаружи, чтобы учесть весь путь апдейта
+        self._dp.update.outer_middleware(HandlerMetricsMiddleware("main"))
         self._dp.message.middleware(BanMiddleware())
         self._dp.callback_query.middleware(BanMiddleware())
         
@@ -53,8 +64,17 @@ class BotController:
     async def _start_polling(self):
         self._is_running = True
         logger.info("Запущен опрос Telegram (Основной-бот).")
+        self._outbox = MessageDispatcher(self._bot, name="main")
+        self._outbox.start()
+        # Множество забаненных для BanMiddleware загружаем заранее, а не на первом апдейте
+        await asyncio.to_thread(database.load_banned_users)
+        # Платежи, принятые вебхуками (в том числе пока бот был остановлен), обрабатываются воркером очереди
+        payment_inbox.start(self._bot)
         try:
-            await self._dp.start_polling(self._bot)
+            if await asyncio.to_thread(update_webhook.is_webhook_mode):
+                await self._run_webhook()
+            else:
+                await self._dp.start_polling(self._bot)
         except asyncio.CancelledError:
             logger.info("Опрос остановлен (задача отменена).")
         except Exception as e:
@@ -63,11 +83,24 @@ class BotController:
             logger.info("Опрос корректно остановлен.")
             self._is_running = False
             self._task = None
+            await payment_inbox.stop()
+            if self._outbox:
+                await self._outbox.stop()
+                self._outbox = None
             if self._bot:
                 await self._bot.close()
             self._bot = None
             # self._dp = None  <-- Диспетчер не удаляем, чтобы не ломать привязку роутеров
 
+    async def _run_webhook(self):
+        self._webhook_stop = asyncio.Event()
+        try:
+            await update_webhook.start_webhook("main", self._dp, self._bot)
+            await self._webhook_stop.wait()
+        finally:
+            self._webhook_stop = None
+            await update_webhook.stop_webhook("main")
+
     def start(self):
         if self._is_running:
             return {"status": "error", "message": "Бот уже запущен."}
@@ -88,10 +121,12 @@ class BotController:
         try:
             self._bot = Bot(token=token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
             
-            try:
-                asyncio.run_coroutine_threadsafe(self._bot.delete_webhook(drop_pending_updates=True), self._loop)
-            except Exception as e:
-                logger.warning(f"Не удалось удалить вебхук перед запуском опроса: {e}")
+            # В режиме опроса снимаем вебхук; в режиме вебхука он будет установлен при старте
+            if not update_webhook.is_webhook_mode():
+                try:
+                    asyncio.run_coroutine_threadsafe(self._bot.delete_webhook(drop_pending_updates=True), self._loop)
+                except Exception as e:
+                    logger.warning(f"Не удалось удалить вебхук перед запуском опроса: {e}")
 
             yookassa_shop_id = database.get_setting("yookassa_shop_id")
             yookassa_secret_key = database.get_setting("yookassa_secret_key")
@@ -167,9 +202,15 @@ class BotController:
             return {"status": "error", "message": "Критическая ошибка: компоненты бота недоступны."}
 
         logger.info("Отправляю сигнал на корректную остановку...")
-        asyncio.run_coroutine_threadsafe(self._dp.stop_polling(), self._loop)
+        if self._webhook_stop is not None:
+            self._loop.call_soon_threadsafe(self._webhook_stop.set)
+        else:
+            asyncio.run_coroutine_threadsafe(self._dp.stop_polling(), self._loop)
         
         return {"status": "success", "message": "Команда на остановку бота отправлена."}
 
+    def get_outbox(self) -> MessageDispatcher | None:
+        return self._outbox
+
     def get_status(self):
         return {"is_running": self._is_running}
\ No newline at end of file
@@ -9,6 +9,7 @@ from aiogram import Bot
 from aiogram.types import FSInputFile
 
 from . import database
+from shop_bot.bot import message_dispatcher
 
 from .database import PROJECT_ROOT
 
@@ -118,7 +119,10 @@ async def send_backup_to_admins(bot: Bot, zip_path: Path) -> int:
         file = FSInputFile(str(zip_path))
         for uid in admin_ids:
             try:
-                await bot.send_document(chat_id=int(uid), document=file, caption=caption)
+                await message_dispatcher.send_document(
+                    bot, int(uid), file, caption=caption,
+                    priority=message_dispatcher.PRIORITY_NOTIFY,
+                )
                 cnt += 1
             except Exception as e:
                 logger.error(f"Бэкап: не удалось отправить администратору {uid}: {e}")
@@ -209,6 +213,8 @@ def restore_from_file(uploaded_path: Path) -> bool:
             database.run_migration()
         except Exception:
             pass
+        database.invalidate_banned_cache()
+        database.bump_ui_config_version()
 
         logger.info("Восстановление: база данных успешно заменена")
         return True
@@ -1,15 +1,71 @@
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timedelta
+import hashlib
 import logging
+import math
 from pathlib import Path
 import json
 import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from shop_bot.data_manager import metrics_registry
 
 logger = logging.getLogger(__name__)
 
 PROJECT_ROOT = Path(__file__).resolve().parent.parent.parent.parent
 DB_FILE = PROJECT_ROOT / "users.db"
 
+
+_DB_CALL_SECONDS = metrics_registry.histogram(
+    "shopbot_db_call_duration_seconds", "Длительность обращений к БД (от открытия соединения до выхода из with)",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+_DB_CALLS = metrics_registry.counter("shopbot_db_calls_total", "Число обращений к БД", ("function",))
+_DB_CALL_SECONDS_BY_FUNCTION = metrics_registry.counter(
+    "shopbot_db_call_seconds_total", "Суммарное время обращений к БД", ("function",)
+)
+
+
+class _MeteredConnection(sqlite3.Connection):
+    """Соединение с базой бота: каждое открытие учитывается как одно обращение к БД,
+    а время до выхода из with (или до close) — как его длительность."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.function = "unknown"
+        self._started = time.perf_counter()
+        metrics_registry.count_in_scope("db")
+
+    def __exit__(self, *exc_info):
+        try:
+            return super().__exit__(*exc_info)
+        finally:
+            self._observe()
+
+    def close(self):
+        self._observe()
+        super().close()
+
+    def _observe(self):
+        if self._started is None:
+            return
+        elapsed = time.perf_counter() - self._started
+        self._started = None
+        _DB_CALL_SECONDS.observe(elapsed)
+        _DB_CALLS.inc(function=self.function)
+        _DB_CALL_SECONDS_BY_FUNCTION.inc(elapsed, function=self.function)
+
+
+def _connect(**kwargs) -> sqlite3.Connection:
+    conn = sqlite3.connect(DB_FILE, factory=_MeteredConnection, **kwargs)
+    # В метках — функция database.py, открывшая соединение
+    conn.function = sys._getframe(1).f_code.co_name
+    return conn
+
+
 def normalize_host_name(name: str | None) -> str:
     """Normalize host name by trimming and removing invisible/unicode spaces.
     Removes: NBSP(\u00A0), ZERO WIDTH SPACE(\u200B), ZWNJ(\u200C), ZWJ(\u200D), BOM(\uFEFF).
@@ -26,7 +82,7 @@ def fix_database():
         if not DB_FILE.exists():
             return
 
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             
             # 1. Check vpn_keys schema
@@ -61,7 +117,7 @@ def fix_database():
 
 def mark_trial_used(user_id: int) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET trial_used = 1 WHERE telegram_id = ?", (user_id,))
             conn.commit()
@@ -73,7 +129,7 @@ def mark_trial_used(user_id: int) -> bool:
 
 def initialize_db():
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS users (
@@ -86,7 +142,8 @@ def initialize_db():
                     referred_by INTEGER,
                     referral_balance REAL DEFAULT 0,
                     referral_balance_all REAL DEFAULT 0,
-                    referral_start_bonus_received BOOLEAN DEFAULT 0
+                    referral_start_bonus_received BOOLEAN DEFAULT 0,
+                    bot_blocked BOOLEAN DEFAULT 0
                 )
             ''')
 
@@ -100,7 +157,9 @@ def initialize_db():
                     expiry_date TIMESTAMP,
                     created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     comment TEXT,
-                    is_gift BOOLEAN DEFAULT 0
+                    is_gift BOOLEAN DEFAULT 0,
+                    connection_string TEXT,
+                    connection_checked_at REAL
                 )
             ''')
             cursor.execute('''
@@ -311,6 +370,23 @@ def initialize_db():
                 "referral_on_start_referrer_amount": "20",
                 # Backups
                 "backup_interval_days": "1",
+                # Сколько хостов тестировать скоростью одновременно
+                "speedtest_concurrency": "4",
+                # Получение обновлений ботами: polling | webhook
+                "bot_update_mode": "polling",
+                "bot_webhook_base_url": None,
+                "bot_webhook_listen_host": "127.0.0.1",
+                "bot_webhook_port": "8443",
+                "bot_webhook_concurrency": "32",
+                "bot_webhook_secret": None,
+                # Встроенный HTTP-сервер панели: production | development
+                "http_server_mode": "production",
+                "http_admin_workers": "8",
+                "http_webhook_workers": "8",
+                "http_request_timeout": "30",
+                "http_max_connections": "200",
+                # Токен для /metrics (Prometheus); пусто — эндпоинт выключен
+                "metrics_token": None,
                 # Telegram Stars payments
                 "stars_enabled": "false",
                 # Сколько звёзд списывать за 1 RUB (напр., 1.5 звезды за 1 рубль)
@@ -352,6 +428,13 @@ def initialize_db():
                 if 'xui_client_uuid' not in columns:
                     cursor.execute("ALTER TABLE vpn_keys ADD COLUMN xui_client_uuid TEXT")
                     logging.info("Добавлена колонка xui_client_uuid в таблицу vpn_keys")
+                # Последняя известная ссылка подключения (для мгновенного показа ключа без похода в панель)
+                if 'connection_string' not in columns:
+                    cursor.execute("ALTER TABLE vpn_keys ADD COLUMN connection_string TEXT")
+                    logging.info("Добавлена колонка connection_string в таблицу vpn_keys")
+                if 'connection_checked_at' not in columns:
+                    cursor.execute("ALTER TABLE vpn_keys ADD COLUMN connection_checked_at REAL")
+                    logging.info("Добавлена колонка connection_checked_at в таблицу vpn_keys")
             except Exception as e:
                 logging.warning(f"Ошибка при добавлении колонок в таблицу vpn_keys: {e}")
             
@@ -387,7 +470,7 @@ def create_promo_code(
     if (discount_percent or 0) <= 0 and (discount_amount or 0) <= 0:
         raise ValueError("discount must be positive")
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cols = _promo_columns(conn)
             # prefer valid_to in this project; migration didn't add valid_until
@@ -427,7 +510,7 @@ def get_promo_code(code: str) -> dict | None:
     if not code_s:
         return None
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM promo_codes WHERE code = ?", (code_s,))
@@ -445,7 +528,7 @@ def list_promo_codes(include_inactive: bool = True) -> list[dict]:
         query += " WHERE COALESCE(is_active, active, 1) = 1"
     query += " ORDER BY created_at DESC"
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute(query)
@@ -461,7 +544,7 @@ def check_promo_code_available(code: str, user_id: int) -> tuple[dict | None, st
         return None, "empty_code"
     user_id_i = int(user_id)
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cols = _promo_columns(conn)
@@ -555,7 +638,7 @@ def update_promo_code_status(code: str, *, is_active: bool | None = None) -> boo
         return False
     params.append(code_s)
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(f"UPDATE promo_codes SET {', '.join(sets)} WHERE code = ?", params)
             conn.commit()
@@ -578,7 +661,7 @@ def redeem_promo_code(
     user_id_i = int(user_id)
     applied_amount_f = float(applied_amount)
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cols = _promo_columns(conn)
@@ -670,7 +753,7 @@ def run_migration():
     logging.info(f"Начинаю миграцию базы данных: {DB_FILE}")
 
     try:
-        conn = sqlite3.connect(DB_FILE)
+        conn = _connect()
         cursor = conn.cursor()
 
         logging.info("Миграция таблицы 'users' ...")
@@ -707,6 +790,12 @@ def run_migration():
             logging.info(" -> Столбец 'referral_start_bonus_received' успешно добавлен.")
         else:
             logging.info(" -> Столбец 'referral_start_bonus_received' уже существует.")
+
+        if 'bot_blocked' not in columns:
+            cursor.execute("ALTER TABLE users ADD COLUMN bot_blocked BOOLEAN DEFAULT 0")
+            logging.info(" -> Столбец 'bot_blocked' успешно добавлен.")
+        else:
+            logging.info(" -> Столбец 'bot_blocked' уже существует.")
         
         logging.info("Таблица 'users' успешно обновлена.")
 
@@ -994,6 +1083,237 @@ def run_migration():
         except sqlite3.Error as e:
             logging.error(f"Не удалось подготовить таблицы промокодов: {e}")
 
+        # Аренда лидерства для фоновых задач (несколько инстансов на одной БД)
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS scheduler_leases (
+                    name TEXT PRIMARY KEY,
+                    holder TEXT NOT NULL,
+                    acquired_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    heartbeat_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    expires_at REAL NOT NULL
+                )
+            ''')
+            conn.commit()
+            logging.info("Таблица 'scheduler_leases' готова к использованию.")
+        except sqlite3.Error as e:
+            logging.error(f"Не удалось подготовить таблицу scheduler_leases: {e}")
+
+        # Телеметрия фаз планировщика (длительность, объём, ошибки, перерасход интервала)
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS scheduler_runs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    phase TEXT NOT NULL,
+                    object_name TEXT,
+                    started_at TIMESTAMP NOT NULL,
+                    duration_ms INTEGER NOT NULL,
+                    items INTEGER DEFAULT 0,
+                    errors INTEGER DEFAULT 0,
+                    interval_sec INTEGER,
+                    overrun INTEGER DEFAULT 0,
+                    error TEXT
+                )
+            ''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_scheduler_runs_phase_time ON scheduler_runs(phase, started_at)")
+            conn.commit()
+            logging.info("Таблица 'scheduler_runs' готова к использованию.")
+        except sqlite3.Error as e:
+            logging.error(f"Не удалось подготовить таблицу scheduler_runs: {e}")
+
+        # Рассылки: кампании и статус доставки по каждому получателю (для возобновления после рестарта)
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS broadcast_campaigns (
+                    campaign_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    created_by INTEGER,
+                    from_chat_id INTEGER NOT NULL,
+                    message_id INTEGER NOT NULL,
+                    button_text TEXT,
+                    button_url TEXT,
+                    segment TEXT DEFAULT 'all',
+                    segment_params TEXT,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    total INTEGER DEFAULT 0,
+                    sent INTEGER DEFAULT 0,
+                    failed INTEGER DEFAULT 0,
+                    blocked INTEGER DEFAULT 0,
+                    progress_chat_id INTEGER,
+                    progress_message_id INTEGER,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    started_at TIMESTAMP,
+                    finished_at TIMESTAMP,
+                    heartbeat_at TIMESTAMP
+                )
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS broadcast_recipients (
+                    campaign_id INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    error TEXT,
+                    updated_at TIMESTAMP,
+                    PRIMARY KEY (campaign_id, user_id)
+                )
+            ''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_status ON broadcast_recipients(campaign_id, status, user_id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_campaigns_status ON broadcast_campaigns(status)")
+            conn.commit()
+            logging.info("Таблицы 'broadcast_campaigns' и 'broadcast_recipients' готовы к использованию.")
+        except sqlite3.Error as e:
+            logging.error(f"Не удалось подготовить таблицы рассылок: {e}")
+
+        # Общее хранилище FSM aiogram (состояния диалогов переживают рестарт и доступны всем воркерам)
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS fsm_storage (
+                    storage_key TEXT PRIMARY KEY,
+                    state TEXT,
+                    data TEXT,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_fsm_storage_updated ON fsm_storage(updated_at)")
+            conn.commit()
+            logging.info("Таблица 'fsm_storage' готова к использованию.")
+        except sqlite3.Error as e:
+            logging.error(f"Не удалось подготовить таблицу fsm_storage: {e}")
+
+        # Кэш ссылки подключения ключа (показ ключа без ожидания панели)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("PRAGMA table_info(vpn_keys)")
+            key_columns = {row[1] for row in cursor.fetchall()}
+            if 'connection_string' not in key_columns:
+                cursor.execute("ALTER TABLE vpn_keys ADD COLUMN connection_string TEXT")
+                logging.info(" -> Столбец 'connection_string' успешно добавлен.")
+            if 'connection_checked_at' not in key_columns:
+                cursor.execute("ALTER TABLE vpn_keys ADD COLUMN connection_checked_at REAL")
+                logging.info(" -> Столбец 'connection_checked_at' успешно добавлен.")
+            # Продление, смена хоста или клиента делают кэш ссылки недействительным, кто бы ни менял ключ
+            cursor.execute(
+                """
+                CREATE TRIGGER IF NOT EXISTS trg_vpn_keys_connection_invalidate
+                AFTER UPDATE OF host_name, xui_client_uuid, key_email, expiry_date ON vpn_keys
+                WHEN NEW.host_name IS NOT OLD.host_name OR NEW.xui_client_uuid IS NOT OLD.xui_client_uuid
+                  OR NEW.key_email IS NOT OLD.key_email OR NEW.expiry_date IS NOT OLD.expiry_date
+                BEGIN
+                    UPDATE vpn_keys SET connection_string = NULL, connection_checked_at = NULL WHERE key_id = NEW.key_id;
+                END
+                """
+            )
+            conn.commit()
+        except sqlite3.Error as e:
+            logging.error(f"Не удалось добавить кэш ссылки подключения в vpn_keys: {e}")
+
+        # Входящие уведомления платёжных систем: сохраняются до ответа провайдеру, обрабатываются воркером
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS payment_inbox (
+                    inbox_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    provider TEXT NOT NULL,
+                    external_id TEXT NOT NULL,
+                    metadata TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    last_error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    UNIQUE(provider, external_id)
+                )
+            ''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_payment_inbox_due ON payment_inbox(status, next_attempt_at)")
+            conn.commit()
+            logging.info("Таблица 'payment_inbox' готова к использованию.")
+        except sqlite3.Error as e:
+            logging.error(f"Не удалось подготовить таблицу payment_inbox: {e}")
+
+        # Захват платежей: один payment_id обрабатывается ровно один раз, даже при повторных уведомлениях
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS payment_claims (
+                    payment_id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    claimed_at REAL NOT NULL,
+                    finished_at REAL
+                )
+            ''')
+            conn.commit()
+            logging.info("Таблица 'payment_claims' готова к использованию.")
+        except sqlite3.Error as e:
+            logging.error(f"Не удалось подготовить таблицу payment_claims: {e}")
+
+        # Версии данных для кэша ответов веб-панели: триггеры увеличивают счётчик домена при любом изменении таблицы,
+        # поэтому изменения из любого процесса (бот, планировщик, панель) видны без опроса самих таблиц
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS data_versions (
+                    domain TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            for table, domain in DATA_VERSION_TABLES.items():
+                try:
+                    for op in ("INSERT", "UPDATE", "DELETE"):
+                        cursor.execute(
+                            f"CREATE TRIGGER IF NOT EXISTS trg_{table}_{op.lower()}_version AFTER {op} ON {table} "
+                            f"BEGIN UPDATE data_versions SET version = version + 1 WHERE domain = '{domain}'; END"
+                        )
+                    cursor.execute("INSERT OR IGNORE INTO data_versions (domain, version) VALUES (?, 0)", (domain,))
+                except sqlite3.Error as e:
+                    logging.warning(f"Триггеры версий для таблицы {table} не созданы: {e}")
+            conn.commit()
+            logging.info("Таблица 'data_versions' и триггеры версий готовы к использованию.")
+        except sqlite3.Error as e:
+            logging.error(f"Не удалось подготовить версии данных для кэша панели: {e}")
+
+        # Индексы для фильтрованной постраничной выдачи ключей в админке
+        try:
+            cursor = conn.cursor()
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_user ON vpn_keys(user_id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_host ON vpn_keys(host_name)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_expiry ON vpn_keys(COALESCE(expiry_date, ''), key_id)")
+            conn.commit()
+            logging.info("Индексы таблицы 'vpn_keys' готовы к использованию.")
+        except sqlite3.Error as e:
+            logging.error(f"Не удалось создать индексы vpn_keys: {e}")
+
+        # Ежедневные сводки для графиков панели: поддерживаются триггерами при записи, сверяются планировщиком
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS daily_rollups (
+                    day TEXT NOT NULL,
+                    metric TEXT NOT NULL,
+                    dimension TEXT NOT NULL DEFAULT '',
+                    value REAL NOT NULL DEFAULT 0,
+                    PRIMARY KEY (day, metric, dimension)
+                )
+            ''')
+            try:
+                cursor.execute("SELECT json_valid('{}')")
+                for statement in _rollup_trigger_statements():
+                    cursor.execute(statement)
+            except sqlite3.Error as e:
+                # Без JSON1 триггеры сломали бы запись транзакций — сводки обновит только ночная сверка
+                logging.warning(f"Триггеры ежедневных сводок не созданы: {e}")
+            cursor.execute("SELECT 1 FROM daily_rollups LIMIT 1")
+            if cursor.fetchone() is None:
+                today = datetime.now().date()
+                _reconcile_rollups(cursor, (today - timedelta(days=ROLLUP_BACKFILL_DAYS - 1)).isoformat(), today.isoformat())
+            conn.commit()
+            logging.info("Таблица 'daily_rollups' готова к использованию.")
+        except sqlite3.Error as e:
+            logging.error(f"Не удалось подготовить ежедневные сводки: {e}")
+
         conn.close()
         
         logging.info("--- Миграция базы данных успешно завершена! ---")
@@ -1030,7 +1350,7 @@ def create_host(name: str, url: str, user: str, passwd: str, inbound: int, subsc
             pass
         subscription_url = (subscription_url or None)
 
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             try:
                 cursor.execute(
@@ -1050,7 +1370,7 @@ def create_host(name: str, url: str, user: str, passwd: str, inbound: int, subsc
 def update_host_subscription_url(host_name: str, subscription_url: str | None) -> bool:
     try:
         host_name = normalize_host_name(host_name)
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT 1 FROM xui_hosts WHERE TRIM(host_name) = TRIM(?)", (host_name,))
             exists = cursor.fetchone() is not None
@@ -1071,7 +1391,7 @@ def update_host_subscription_url(host_name: str, subscription_url: str | None) -
 def set_referral_start_bonus_received(user_id: int) -> bool:
     """Пометить, что пользователь получил стартовый бонус за реферальную регистрацию."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "UPDATE users SET referral_start_bonus_received = 1 WHERE telegram_id = ?",
@@ -1088,7 +1408,7 @@ def update_host_url(host_name: str, new_url: str) -> bool:
     try:
         host_name = normalize_host_name(host_name)
         new_url = (new_url or "").strip()
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT 1 FROM xui_hosts WHERE TRIM(host_name) = TRIM(?)", (host_name,))
             if cursor.fetchone() is None:
@@ -1113,7 +1433,7 @@ def update_host_name(old_name: str, new_name: str) -> bool:
         if not new_name_n:
             logging.warning("update_host_name: новое имя хоста пустое после нормализации")
             return False
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT 1 FROM xui_hosts WHERE TRIM(host_name) = TRIM(?)", (old_name_n,))
             if cursor.fetchone() is None:
@@ -1146,7 +1466,7 @@ def update_host_name(old_name: str, new_name: str) -> bool:
 def delete_host(host_name: str):
     try:
         host_name = normalize_host_name(host_name)
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM plans WHERE TRIM(host_name) = TRIM(?)", (host_name,))
             cursor.execute("DELETE FROM xui_hosts WHERE TRIM(host_name) = TRIM(?)", (host_name,))
@@ -1158,7 +1478,7 @@ def delete_host(host_name: str):
 def get_host(host_name: str) -> dict | None:
     try:
         host_name = normalize_host_name(host_name)
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM xui_hosts WHERE TRIM(host_name) = TRIM(?)", (host_name,))
@@ -1181,7 +1501,7 @@ def update_host_ssh_settings(
     """
     try:
         host_name_n = normalize_host_name(host_name)
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT 1 FROM xui_hosts WHERE TRIM(host_name) = TRIM(?)", (host_name_n,))
             if cursor.fetchone() is None:
@@ -1211,7 +1531,7 @@ def update_host_ssh_settings(
 
 def delete_key_by_id(key_id: int) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM vpn_keys WHERE key_id = ?", (key_id,))
             affected = cursor.rowcount
@@ -1223,7 +1543,7 @@ def delete_key_by_id(key_id: int) -> bool:
 
 def get_key_by_id(key_id: int) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys WHERE key_id = ?", (key_id,))
@@ -1237,7 +1557,7 @@ def update_key_expiry(key_id: int, expiry_timestamp_ms: int) -> bool:
     try:
         # Convert ms timestamp to datetime string
         expiry_date = datetime.fromtimestamp(expiry_timestamp_ms / 1000)
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE vpn_keys SET expiry_date = ? WHERE key_id = ?", (expiry_date, key_id))
             conn.commit()
@@ -1248,7 +1568,7 @@ def update_key_expiry(key_id: int, expiry_timestamp_ms: int) -> bool:
 
 def update_key_comment(key_id: int, comment: str) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE vpn_keys SET comment = ? WHERE key_id = ?", (comment, key_id))
             conn.commit()
@@ -1259,7 +1579,7 @@ def update_key_comment(key_id: int, comment: str) -> bool:
 
 def get_all_hosts() -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM xui_hosts")
@@ -1279,7 +1599,7 @@ def get_speedtests(host_name: str, limit: int = 20) -> list[dict]:
     """Получить последние результаты спидтестов по хосту (ssh/net), новые сверху."""
     try:
         host_name_n = normalize_host_name(host_name)
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             try:
@@ -1307,7 +1627,7 @@ def get_latest_speedtest(host_name: str) -> dict | None:
     """Получить последний по времени спидтест для хоста."""
     try:
         host_name_n = normalize_host_name(host_name)
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute(
@@ -1333,9 +1653,14 @@ def find_and_complete_pending_transaction(
     payment_method: str,
     currency_name: str | None = None,
     amount_currency: float | None = None,
+    enqueue_as: str | None = None,
+    external_id: str | None = None,
 ) -> dict | None:
+    """Помечает ожидающую транзакцию оплаченной и возвращает её метаданные (None — не найдена).
+    С enqueue_as в той же транзакции SQLite платёж ставится в payment_inbox: статус paid без записи
+    в очереди невозможен. Ошибка БД в этом случае пробрасывается — провайдеру нужно ответить ошибкой."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
 
@@ -1357,7 +1682,6 @@ def find_and_complete_pending_transaction(
                 """,
                 (amount_rub, amount_currency, currency_name, payment_method, payment_id)
             )
-            conn.commit()
 
             try:
                 raw_md = None
@@ -1368,15 +1692,20 @@ def find_and_complete_pending_transaction(
                 md = json.loads(raw_md) if raw_md else {}
             except Exception:
                 md = {}
+            if enqueue_as:
+                _insert_payment_event(cursor, enqueue_as, external_id or payment_id, md)
+            conn.commit()
             return md
     except sqlite3.Error as e:
         logging.error(f"Не удалось завершить ожидающую транзакцию {payment_id}: {e}")
+        if enqueue_as:
+            raise
         return None
 
 def update_transaction_status(payment_id: str, status: str, amount_rub: float = None, payment_method: str = None) -> bool:
     """Обновить статус транзакции (например, на 'paid' или 'failed')."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             
             # Строим динамический запрос
@@ -1404,7 +1733,7 @@ def update_transaction_status(payment_id: str, status: str, amount_rub: float =
 def update_user_balance(user_id: int, amount: float) -> float:
     """Обновляет баланс пользователя и возвращает новое значение."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET balance = balance + ? WHERE telegram_id = ?", (amount, user_id))
             conn.commit()
@@ -1417,6 +1746,45 @@ def update_user_balance(user_id: int, amount: float) -> float:
         logging.error(f"Ошибка обновления баланса пользователя {user_id}: {e}")
         return 0.0
 
+# Версия результатов спидтестов: растёт при каждой записи, по ней сбрасывается кэш сводки для пользователей
+_speedtest_version = 0
+
+def get_speedtest_version() -> int:
+    return _speedtest_version
+
+def bump_speedtest_version():
+    global _speedtest_version
+    _speedtest_version += 1
+
+def get_latest_speedtests_per_host() -> list[dict]:
+    """Все хосты с последним спидтестом каждого — одним запросом (ROW_NUMBER по хосту)."""
+    try:
+        with _connect() as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT h.host_name AS host_name,
+                       t.method, t.ping_ms, t.jitter_ms, t.download_mbps, t.upload_mbps, t.ok, t.created_at
+                FROM xui_hosts h
+                LEFT JOIN (
+                    SELECT TRIM(host_name) AS host_key, method, ping_ms, jitter_ms, download_mbps, upload_mbps, ok, created_at,
+                           ROW_NUMBER() OVER (PARTITION BY TRIM(host_name) ORDER BY created_at DESC, id DESC) AS rn
+                    FROM host_speedtests
+                ) t ON t.host_key = TRIM(h.host_name) AND t.rn = 1
+                ORDER BY h.rowid
+                """
+            )
+            result = []
+            for row in cursor.fetchall():
+                d = dict(row)
+                d['host_name'] = normalize_host_name(d.get('host_name'))
+                result.append(d)
+            return result
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось получить сводку последних спидтестов: {e}")
+        return []
+
 def insert_host_speedtest(
     host_name: str,
     method: str,
@@ -1435,7 +1803,7 @@ def insert_host_speedtest(
         method_s = (method or '').strip().lower()
         if method_s not in ('ssh', 'net'):
             method_s = 'ssh'
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 '''
@@ -1457,7 +1825,8 @@ def insert_host_speedtest(
                 )
             )
             conn.commit()
-            return True
+        bump_speedtest_version()
+        return True
     except sqlite3.Error as e:
         logging.error(f"Не удалось сохранить запись speedtest для '{host_name}': {e}")
         return False
@@ -1481,7 +1850,7 @@ def get_admin_stats() -> dict:
         "today_issued_keys": 0,
     }
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             # users
             cursor.execute("SELECT COUNT(*) FROM users")
@@ -1538,7 +1907,7 @@ def get_admin_stats() -> dict:
 
 def get_all_keys() -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys")
@@ -1549,7 +1918,7 @@ def get_all_keys() -> list[dict]:
 
 def get_keys_for_user(user_id: int) -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys WHERE user_id = ? ORDER BY created_date DESC", (user_id,))
@@ -1562,7 +1931,7 @@ def create_user_key(user_id: int, host_name: str, xui_client_uuid: str, key_emai
     try:
         host_name = normalize_host_name(host_name)
         expiry_date = datetime.fromtimestamp(expiry_timestamp_ms / 1000).isoformat()
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "INSERT INTO vpn_keys (user_id, host_name, xui_client_uuid, key_email, expiry_date) VALUES (?, ?, ?, ?, ?)",
@@ -1580,7 +1949,7 @@ def create_user_key(user_id: int, host_name: str, xui_client_uuid: str, key_emai
 
 def get_key_by_id(key_id: int) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys WHERE key_id = ?", (key_id,))
@@ -1592,7 +1961,7 @@ def get_key_by_id(key_id: int) -> dict | None:
 
 def update_key_email(key_id: int, new_email: str) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE vpn_keys SET key_email = ? WHERE key_id = ?", (new_email, key_id))
             conn.commit()
@@ -1606,7 +1975,7 @@ def update_key_email(key_id: int, new_email: str) -> bool:
 
 def update_key_host(key_id: int, new_host_name: str) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE vpn_keys SET host_name = ? WHERE key_id = ?", (normalize_host_name(new_host_name), key_id))
             conn.commit()
@@ -1622,7 +1991,7 @@ def create_gift_key(user_id: int, host_name: str, key_email: str, months: int, x
         host_name = normalize_host_name(host_name)
         from datetime import timedelta
         expiry = datetime.now() + timedelta(days=30 * int(months or 1))
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "INSERT INTO vpn_keys (user_id, host_name, xui_client_uuid, key_email, expiry_date) VALUES (?, ?, ?, ?, ?)",
@@ -1639,7 +2008,7 @@ def create_gift_key(user_id: int, host_name: str, key_email: str, months: int, x
 
 def get_setting(key: str) -> str | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT value FROM bot_settings WHERE key = ?", (key,))
             result = cursor.fetchone()
@@ -1699,7 +2068,7 @@ def get_referrals_for_user(user_id: int) -> list[dict]:
     Поля: telegram_id, username, registration_date, total_spent.
     """
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute(
@@ -1720,7 +2089,7 @@ def get_referrals_for_user(user_id: int) -> list[dict]:
 def get_all_settings() -> dict:
     settings = {}
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT key, value FROM bot_settings")
@@ -1731,12 +2100,23 @@ def get_all_settings() -> dict:
         logging.error(f"Не удалось получить все настройки: {e}")
     return settings
 
+# Версия UI-конфигурации (кнопки и настройки): по ней keyboards инвалидирует скомпилированные шаблоны меню
+_ui_config_version = 0
+
+def get_ui_config_version() -> int:
+    return _ui_config_version
+
+def bump_ui_config_version():
+    global _ui_config_version
+    _ui_config_version += 1
+
 def update_setting(key: str, value: str):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("INSERT OR REPLACE INTO bot_settings (key, value) VALUES (?, ?)", (key, value))
             conn.commit()
+            bump_ui_config_version()
             logging.info(f"Настройка '{key}' обновлена.")
     except sqlite3.Error as e:
         logging.error(f"Не удалось обновить настройку '{key}': {e}")
@@ -1744,7 +2124,7 @@ def update_setting(key: str, value: str):
 def create_plan(host_name: str, plan_name: str, months: int, price: float):
     try:
         host_name = normalize_host_name(host_name)
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "INSERT INTO plans (host_name, plan_name, months, price) VALUES (?, ?, ?, ?)",
@@ -1758,7 +2138,7 @@ def create_plan(host_name: str, plan_name: str, months: int, price: float):
 def get_plans_for_host(host_name: str) -> list[dict]:
     try:
         host_name = normalize_host_name(host_name)
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM plans WHERE TRIM(host_name) = TRIM(?) ORDER BY months", (host_name,))
@@ -1770,7 +2150,7 @@ def get_plans_for_host(host_name: str) -> list[dict]:
 
 def get_plan_by_id(plan_id: int) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM plans WHERE plan_id = ?", (plan_id,))
@@ -1782,7 +2162,7 @@ def get_plan_by_id(plan_id: int) -> dict | None:
 
 def delete_plan(plan_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM plans WHERE plan_id = ?", (plan_id,))
             conn.commit()
@@ -1792,7 +2172,7 @@ def delete_plan(plan_id: int):
 
 def update_plan(plan_id: int, plan_name: str, months: int, price: float) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "UPDATE plans SET plan_name = ?, months = ?, price = ? WHERE plan_id = ?",
@@ -1810,7 +2190,7 @@ def update_plan(plan_id: int, plan_name: str, months: int, price: float) -> bool
 
 def register_user_if_not_exists(telegram_id: int, username: str, referrer_id):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT referred_by FROM users WHERE telegram_id = ?", (telegram_id,))
             row = cursor.fetchone()
@@ -1822,7 +2202,8 @@ def register_user_if_not_exists(telegram_id: int, username: str, referrer_id):
                 )
             else:
                 # Пользователь уже есть — обновим username, и если есть реферер и поле пустое, допишем
-                cursor.execute("UPDATE users SET username = ? WHERE telegram_id = ?", (username, telegram_id))
+                # Пользователь снова пишет боту — значит, бот у него не заблокирован
+                cursor.execute("UPDATE users SET username = ?, bot_blocked = 0 WHERE telegram_id = ?", (username, telegram_id))
                 current_ref = row[0]
                 if referrer_id and (current_ref is None or str(current_ref).strip() == "") and int(referrer_id) != int(telegram_id):
                     try:
@@ -1836,7 +2217,7 @@ def register_user_if_not_exists(telegram_id: int, username: str, referrer_id):
 
 def add_to_referral_balance(user_id: int, amount: float):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET referral_balance = referral_balance + ? WHERE telegram_id = ?", (amount, user_id))
             conn.commit()
@@ -1845,7 +2226,7 @@ def add_to_referral_balance(user_id: int, amount: float):
 
 def set_referral_balance(user_id: int, value: float):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET referral_balance = ? WHERE telegram_id = ?", (value, user_id))
             conn.commit()
@@ -1854,7 +2235,7 @@ def set_referral_balance(user_id: int, value: float):
 
 def set_referral_balance_all(user_id: int, value: float):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET referral_balance_all = ? WHERE telegram_id = ?", (value, user_id))
             conn.commit()
@@ -1863,7 +2244,7 @@ def set_referral_balance_all(user_id: int, value: float):
 
 def add_to_referral_balance_all(user_id: int, amount: float):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "UPDATE users SET referral_balance_all = referral_balance_all + ? WHERE telegram_id = ?",
@@ -1875,7 +2256,7 @@ def add_to_referral_balance_all(user_id: int, amount: float):
 
 def get_referral_balance_all(user_id: int) -> float:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT referral_balance_all FROM users WHERE telegram_id = ?", (user_id,))
             row = cursor.fetchone()
@@ -1886,7 +2267,7 @@ def get_referral_balance_all(user_id: int) -> float:
 
 def get_referral_balance(user_id: int) -> float:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT referral_balance FROM users WHERE telegram_id = ?", (user_id,))
             result = cursor.fetchone()
@@ -1897,7 +2278,7 @@ def get_referral_balance(user_id: int) -> float:
 
 def get_balance(user_id: int) -> float:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT balance FROM users WHERE telegram_id = ?", (user_id,))
             result = cursor.fetchone()
@@ -1909,7 +2290,7 @@ def get_balance(user_id: int) -> float:
 def adjust_user_balance(user_id: int, delta: float) -> bool:
     """Скорректировать баланс пользователя на указанную дельту (может быть отрицательной)."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET balance = COALESCE(balance, 0) + ? WHERE telegram_id = ?", (float(delta), user_id))
             conn.commit()
@@ -1920,7 +2301,7 @@ def adjust_user_balance(user_id: int, delta: float) -> bool:
 
 def set_balance(user_id: int, value: float) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET balance = ? WHERE telegram_id = ?", (value, user_id))
             conn.commit()
@@ -1931,7 +2312,7 @@ def set_balance(user_id: int, value: float) -> bool:
 
 def add_to_balance(user_id: int, amount: float) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET balance = balance + ? WHERE telegram_id = ?", (amount, user_id))
             conn.commit()
@@ -1945,7 +2326,7 @@ def deduct_from_balance(user_id: int, amount: float) -> bool:
     if amount <= 0:
         return True
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("BEGIN IMMEDIATE")
             cursor.execute("SELECT balance FROM users WHERE telegram_id = ?", (user_id,))
@@ -1966,7 +2347,7 @@ def deduct_from_referral_balance(user_id: int, amount: float) -> bool:
     if amount <= 0:
         return True
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("BEGIN IMMEDIATE")
             cursor.execute("SELECT referral_balance FROM users WHERE telegram_id = ?", (user_id,))
@@ -1984,7 +2365,7 @@ def deduct_from_referral_balance(user_id: int, amount: float) -> bool:
 
 def get_referral_count(user_id: int) -> int:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT COUNT(*) FROM users WHERE referred_by = ?", (user_id,))
             return cursor.fetchone()[0] or 0
@@ -1994,7 +2375,7 @@ def get_referral_count(user_id: int) -> int:
 
 def get_user(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
@@ -2006,7 +2387,7 @@ def get_user(telegram_id: int):
 
 def set_terms_agreed(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET agreed_to_terms = 1 WHERE telegram_id = ?", (telegram_id,))
             conn.commit()
@@ -2016,7 +2397,7 @@ def set_terms_agreed(telegram_id: int):
 
 def update_user_stats(telegram_id: int, amount_spent: float, months_purchased: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET total_spent = total_spent + ?, total_months = total_months + ? WHERE telegram_id = ?", (amount_spent, months_purchased, telegram_id))
             conn.commit()
@@ -2025,7 +2406,7 @@ def update_user_stats(telegram_id: int, amount_spent: float, months_purchased: i
 
 def get_user_count() -> int:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT COUNT(*) FROM users")
             return cursor.fetchone()[0] or 0
@@ -2035,7 +2416,7 @@ def get_user_count() -> int:
 
 def get_total_keys_count() -> int:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT COUNT(*) FROM vpn_keys")
             return cursor.fetchone()[0] or 0
@@ -2045,7 +2426,7 @@ def get_total_keys_count() -> int:
 
 def get_total_spent_sum() -> float:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             # Consider only completed/paid transactions when summing total spent
             cursor.execute(
@@ -2064,7 +2445,7 @@ def get_total_spent_sum() -> float:
 
 def create_pending_transaction(payment_id: str, user_id: int, amount_rub: float, metadata: dict) -> int:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "INSERT INTO transactions (payment_id, user_id, status, amount_rub, metadata) VALUES (?, ?, ?, ?, ?)",
@@ -2076,9 +2457,10 @@ def create_pending_transaction(payment_id: str, user_id: int, amount_rub: float,
         logging.error(f"Не удалось create pending transaction: {e}")
         return 0
 
-def find_and_complete_ton_transaction(payment_id: str, amount_ton: float) -> dict | None:
+def find_and_complete_ton_transaction(payment_id: str, amount_ton: float, enqueue_as: str | None = None) -> dict | None:
+    """Как find_and_complete_pending_transaction, но для оплаты в TON."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             
@@ -2093,16 +2475,21 @@ def find_and_complete_ton_transaction(payment_id: str, amount_ton: float) -> dic
                 "UPDATE transactions SET status = 'paid', amount_currency = ?, currency_name = 'TON', payment_method = 'TON' WHERE payment_id = ?",
                 (amount_ton, payment_id)
             )
+            metadata = json.loads(transaction['metadata'])
+            if enqueue_as:
+                _insert_payment_event(cursor, enqueue_as, payment_id, metadata)
             conn.commit()
             
-            return json.loads(transaction['metadata'])
+            return metadata
     except sqlite3.Error as e:
         logging.error(f"Не удалось complete TON transaction {payment_id}: {e}")
+        if enqueue_as:
+            raise
         return None
 
 def log_transaction(username: str, transaction_id: str | None, payment_id: str | None, user_id: int, status: str, amount_rub: float, amount_currency: float | None, currency_name: str | None, payment_method: str, metadata: str):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """INSERT INTO transactions
@@ -2119,7 +2506,7 @@ def get_paginated_transactions(page: int = 1, per_page: int = 15) -> tuple[list[
     transactions = []
     total = 0
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             
@@ -2154,7 +2541,7 @@ def get_paginated_transactions(page: int = 1, per_page: int = 15) -> tuple[list[
 
 def set_trial_used(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET trial_used = 1 WHERE telegram_id = ?", (telegram_id,))
             conn.commit()
@@ -2164,7 +2551,7 @@ def set_trial_used(telegram_id: int):
 
 def add_new_key(user_id: int, host_name: str, xui_client_uuid: str, key_email: str, expiry_timestamp_ms: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             expiry_date = datetime.fromtimestamp(expiry_timestamp_ms / 1000)
             cursor.execute(
@@ -2180,7 +2567,7 @@ def add_new_key(user_id: int, host_name: str, xui_client_uuid: str, key_email: s
 
 def delete_key_by_email(email: str) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM vpn_keys WHERE key_email = ?", (email,))
             affected = cursor.rowcount
@@ -2193,7 +2580,7 @@ def delete_key_by_email(email: str) -> bool:
 
 def get_user_keys(user_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys WHERE user_id = ? ORDER BY key_id", (user_id,))
@@ -2205,7 +2592,7 @@ def get_user_keys(user_id: int):
 
 def get_key_by_id(key_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys WHERE key_id = ?", (key_id,))
@@ -2217,7 +2604,7 @@ def get_key_by_id(key_id: int):
 
 def get_key_by_email(key_email: str):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys WHERE key_email = ?", (key_email,))
@@ -2229,7 +2616,7 @@ def get_key_by_email(key_email: str):
 
 def update_key_info(key_id: int, new_xui_uuid: str, new_expiry_ms: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             expiry_date = datetime.fromtimestamp(new_expiry_ms / 1000)
             cursor.execute("UPDATE vpn_keys SET xui_client_uuid = ?, expiry_date = ? WHERE key_id = ?", (new_xui_uuid, expiry_date, key_id))
@@ -2241,7 +2628,7 @@ def update_key_host_and_info(key_id: int, new_host_name: str, new_xui_uuid: str,
     """Update key's host, UUID and expiry in a single transaction."""
     try:
         new_host_name = normalize_host_name(new_host_name)
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             expiry_date = datetime.fromtimestamp(new_expiry_ms / 1000)
             cursor.execute(
@@ -2259,7 +2646,7 @@ def get_next_key_number(user_id: int) -> int:
 def get_keys_for_host(host_name: str) -> list[dict]:
     try:
         host_name = normalize_host_name(host_name)
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys WHERE TRIM(host_name) = TRIM(?)", (host_name,))
@@ -2271,7 +2658,7 @@ def get_keys_for_host(host_name: str) -> list[dict]:
 
 def get_all_vpn_users():
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT DISTINCT user_id FROM vpn_keys")
@@ -2283,7 +2670,7 @@ def get_all_vpn_users():
 
 def update_key_status_from_server(key_email: str, xui_client_data):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             if xui_client_data:
                 expiry_date = datetime.fromtimestamp(xui_client_data.expiry_time / 1000)
@@ -2294,41 +2681,10 @@ def update_key_status_from_server(key_email: str, xui_client_data):
     except sqlite3.Error as e:
         logging.error(f"Не удалось update key status for {key_email}: {e}")
 
-def get_daily_stats_for_charts(days: int = 30) -> dict:
-    stats = {'users': {}, 'keys': {}}
-    try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            query_users = """
-                SELECT date(registration_date) as day, COUNT(*)
-                FROM users
-                WHERE registration_date >= date('now', ?)
-                GROUP BY day
-                ORDER BY day;
-            """
-            cursor.execute(query_users, (f'-{days} days',))
-            for row in cursor.fetchall():
-                stats['users'][row[0]] = row[1]
-            
-            query_keys = """
-                SELECT date(created_date) as day, COUNT(*)
-                FROM vpn_keys
-                WHERE created_date >= date('now', ?)
-                GROUP BY day
-                ORDER BY day;
-            """
-            cursor.execute(query_keys, (f'-{days} days',))
-            for row in cursor.fetchall():
-                stats['keys'][row[0]] = row[1]
-    except sqlite3.Error as e:
-        logging.error(f"Не удалось get daily stats for charts: {e}")
-    return stats
-
-
 def get_recent_transactions(limit: int = 15) -> list[dict]:
     transactions = []
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             query = """
@@ -2352,7 +2708,7 @@ def get_recent_transactions(limit: int = 15) -> list[dict]:
 
 def get_all_users() -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM users ORDER BY registration_date DESC")
@@ -2376,7 +2732,7 @@ def get_users_paginated(page: int = 1, per_page: int = 20, q: str | None = None)
     users: list[dict] = []
     total = 0
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             if q:
@@ -2419,27 +2775,158 @@ def get_users_paginated(page: int = 1, per_page: int = 20, q: str | None = None)
         return [], 0
     return users, total
 
+def get_users_keyset(cursor: str | None = None, limit: int = 10, q: str | None = None) -> tuple[list[dict], str | None, str | None]:
+    """Страница пользователей для инлайн-списков админки (новые сверху) по курсору, без OFFSET.
+    cursor: None — первая страница, 'n{telegram_id}' — после указанного, 'p{telegram_id}' — перед ним.
+    Возвращает (users, prev_cursor, next_cursor).
+    """
+    limit = max(1, min(50, int(limit or 10)))
+    direction, anchor_id = None, None
+    if cursor and cursor[0] in ('n', 'p'):
+        try:
+            direction, anchor_id = cursor[0], int(cursor[1:])
+        except ValueError:
+            direction, anchor_id = None, None
+
+    try:
+        with _connect() as conn:
+            conn.row_factory = sqlite3.Row
+            db = conn.cursor()
+            where = []
+            args: list = []
+            if q:
+                like = f"%{q.strip()}%"
+                where.append("(CAST(telegram_id AS TEXT) LIKE ? OR username LIKE ? COLLATE NOCASE)")
+                args.extend([like, like])
+
+            anchor = None
+            if anchor_id is not None:
+                db.execute("SELECT registration_date, telegram_id FROM users WHERE telegram_id = ?", (anchor_id,))
+                anchor = db.fetchone()
+            if anchor is not None:
+                if direction == 'n':
+                    where.append("(registration_date < ? OR (registration_date = ? AND telegram_id < ?))")
+                    order = "registration_date DESC, telegram_id DESC"
+                else:
+                    where.append("(registration_date > ? OR (registration_date = ? AND telegram_id > ?))")
+                    order = "registration_date ASC, telegram_id ASC"
+                args.extend([anchor[0], anchor[0], anchor[1]])
+            else:
+                direction = None
+                order = "registration_date DESC, telegram_id DESC"
+
+            sql = "SELECT * FROM users"
+            if where:
+                sql += " WHERE " + " AND ".join(where)
+            sql += f" ORDER BY {order} LIMIT ?"
+            db.execute(sql, [*args, limit + 1])
+            rows = [dict(r) for r in db.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось получить страницу пользователей: {e}")
+        return [], None, None
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == 'p':
+        rows.reverse()
+    if not rows:
+        return [], None, None
+    first_id, last_id = rows[0]['telegram_id'], rows[-1]['telegram_id']
+    if direction is None:
+        prev_cursor, next_cursor = None, (f"n{last_id}" if has_more else None)
+    elif direction == 'n':
+        prev_cursor, next_cursor = f"p{first_id}", (f"n{last_id}" if has_more else None)
+    else:
+        prev_cursor, next_cursor = (f"p{first_id}" if has_more else None), f"n{last_id}"
+    return rows, prev_cursor, next_cursor
+
+def get_user_by_username(username: str) -> dict | None:
+    """Поиск пользователя по username без учёта регистра и ведущего @."""
+    uname = (username or '').strip().lstrip('@')
+    if not uname:
+        return None
+    try:
+        with _connect() as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT * FROM users WHERE username = ? OR username = ? OR LOWER(LTRIM(username, '@')) = LOWER(?) LIMIT 1",
+                (uname, f"@{uname}", uname)
+            )
+            row = cursor.fetchone()
+            return dict(row) if row else None
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось найти пользователя по username '{uname}': {e}")
+        return None
+
+# --- Кэш забаненных пользователей (для BanMiddleware) ---
+# Обычный случай (пользователь не забанен) проверяется по множеству в памяти без запроса к БД.
+# Периодическая перезагрузка подхватывает баны, сделанные другим процессом/инстансом.
+BANNED_CACHE_TTL_SECONDS = 60
+
+_banned_ids: set[int] | None = None
+_banned_loaded_at = 0.0
+_banned_lock = threading.Lock()
+
+def load_banned_users() -> set[int]:
+    """Перечитывает множество забаненных telegram_id из БД."""
+    global _banned_ids, _banned_loaded_at
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT telegram_id FROM users WHERE is_banned = 1")
+            ids = {int(r[0]) for r in cursor.fetchall()}
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось загрузить список забаненных пользователей: {e}")
+        ids = set(_banned_ids or ())
+    with _banned_lock:
+        _banned_ids = ids
+        _banned_loaded_at = time.monotonic()
+    return ids
+
+def invalidate_banned_cache():
+    global _banned_loaded_at
+    with _banned_lock:
+        _banned_loaded_at = 0.0
+
+def is_user_banned(telegram_id: int) -> bool:
+    ids = _banned_ids
+    if ids is None or time.monotonic() - _banned_loaded_at > BANNED_CACHE_TTL_SECONDS:
+        ids = load_banned_users()
+    return int(telegram_id) in ids
+
+def _set_banned_cached(telegram_id: int, banned: bool):
+    with _banned_lock:
+        if _banned_ids is None:
+            return
+        if banned:
+            _banned_ids.add(int(telegram_id))
+        else:
+            _banned_ids.discard(int(telegram_id))
+
 def ban_user(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET is_banned = 1 WHERE telegram_id = ?", (telegram_id,))
             conn.commit()
+        _set_banned_cached(telegram_id, True)
     except sqlite3.Error as e:
         logging.error(f"Не удалось ban user {telegram_id}: {e}")
 
 def unban_user(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET is_banned = 0 WHERE telegram_id = ?", (telegram_id,))
             conn.commit()
+        _set_banned_cached(telegram_id, False)
     except sqlite3.Error as e:
         logging.error(f"Не удалось unban user {telegram_id}: {e}")
 
 def delete_user_keys(user_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM vpn_keys WHERE user_id = ?", (user_id,))
             conn.commit()
@@ -2448,7 +2935,7 @@ def delete_user_keys(user_id: int):
 
 def create_support_ticket(user_id: int, subject: str | None = None) -> int | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "INSERT INTO support_tickets (user_id, subject) VALUES (?, ?)",
@@ -2462,7 +2949,7 @@ def create_support_ticket(user_id: int, subject: str | None = None) -> int | Non
 
 def add_support_message(ticket_id: int, sender: str, content: str) -> int | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "INSERT INTO support_messages (ticket_id, sender, content) VALUES (?, ?, ?)",
@@ -2480,7 +2967,7 @@ def add_support_message(ticket_id: int, sender: str, content: str) -> int | None
 
 def update_ticket_thread_info(ticket_id: int, forum_chat_id: str | None, message_thread_id: int | None) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "UPDATE support_tickets SET forum_chat_id = ?, message_thread_id = ?, updated_at = CURRENT_TIMESTAMP WHERE ticket_id = ?",
@@ -2494,7 +2981,7 @@ def update_ticket_thread_info(ticket_id: int, forum_chat_id: str | None, message
 
 def get_ticket(ticket_id: int) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM support_tickets WHERE ticket_id = ?", (ticket_id,))
@@ -2506,7 +2993,7 @@ def get_ticket(ticket_id: int) -> dict | None:
 
 def get_ticket_by_thread(forum_chat_id: str, message_thread_id: int) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute(
@@ -2521,7 +3008,7 @@ def get_ticket_by_thread(forum_chat_id: str, message_thread_id: int) -> dict | N
 
 def get_user_tickets(user_id: int, status: str | None = None) -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             if status:
@@ -2541,7 +3028,7 @@ def get_user_tickets(user_id: int, status: str | None = None) -> list[dict]:
 
 def get_ticket_messages(ticket_id: int) -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute(
@@ -2555,7 +3042,7 @@ def get_ticket_messages(ticket_id: int) -> list[dict]:
 
 def set_ticket_status(ticket_id: int, status: str) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "UPDATE support_tickets SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE ticket_id = ?",
@@ -2569,7 +3056,7 @@ def set_ticket_status(ticket_id: int, status: str) -> bool:
 
 def update_ticket_subject(ticket_id: int, subject: str) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "UPDATE support_tickets SET subject = ?, updated_at = CURRENT_TIMESTAMP WHERE ticket_id = ?",
@@ -2583,7 +3070,7 @@ def update_ticket_subject(ticket_id: int, subject: str) -> bool:
 
 def delete_ticket(ticket_id: int) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "DELETE FROM support_messages WHERE ticket_id = ?",
@@ -2602,7 +3089,7 @@ def delete_ticket(ticket_id: int) -> bool:
 def get_tickets_paginated(page: int = 1, per_page: int = 20, status: str | None = None) -> tuple[list[dict], int]:
     offset = (page - 1) * per_page
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             if status:
@@ -2626,7 +3113,7 @@ def get_tickets_paginated(page: int = 1, per_page: int = 20, status: str | None
 
 def get_open_tickets_count() -> int:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT COUNT(*) FROM support_tickets WHERE status = 'open'")
             return cursor.fetchone()[0] or 0
@@ -2636,7 +3123,7 @@ def get_open_tickets_count() -> int:
 
 def get_closed_tickets_count() -> int:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT COUNT(*) FROM support_tickets WHERE status = 'closed'")
             return cursor.fetchone()[0] or 0
@@ -2646,7 +3133,7 @@ def get_closed_tickets_count() -> int:
 
 def get_all_tickets_count() -> int:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT COUNT(*) FROM support_tickets")
             return cursor.fetchone()[0] or 0
@@ -2660,7 +3147,7 @@ def insert_host_metrics(host_name: str, metrics: dict) -> bool:
         host_name_n = normalize_host_name(host_name)
         m = metrics or {}
         load = m.get('loadavg') or {}
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 '''
@@ -2697,7 +3184,7 @@ def insert_host_metrics(host_name: str, metrics: dict) -> bool:
 def get_host_metrics_recent(host_name: str, limit: int = 60) -> list[dict]:
     try:
         host_name_n = normalize_host_name(host_name)
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute(
@@ -2721,7 +3208,7 @@ def get_host_metrics_recent(host_name: str, limit: int = 60) -> list[dict]:
 def get_latest_host_metrics(host_name: str) -> dict | None:
     try:
         host_name_n = normalize_host_name(host_name)
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute(
@@ -2742,7 +3229,7 @@ def get_latest_host_metrics(host_name: str) -> dict | None:
 def get_button_configs(menu_type: str = None) -> list[dict]:
     """Get all button configurations, optionally filtered by menu_type."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             
@@ -2764,7 +3251,7 @@ def get_button_configs(menu_type: str = None) -> list[dict]:
 def get_button_config(button_id: int) -> dict | None:
     """Get a specific button configuration by ID."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM button_configs WHERE id = ?", (button_id,))
@@ -2777,7 +3264,7 @@ def get_button_config(button_id: int) -> dict | None:
 def create_button_config(config: dict) -> int | None:
     """Create a new button configuration. Returns the new ID or None on error."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 '''
@@ -2799,6 +3286,8 @@ def create_button_config(config: dict) -> int | None:
                     config.get('is_active', True)
                 )
             )
+            conn.commit()
+            bump_ui_config_version()
             return cursor.lastrowid
     except sqlite3.Error as e:
         logging.error(f"Не удалось create button config: {e}")
@@ -2807,7 +3296,7 @@ def create_button_config(config: dict) -> int | None:
 def update_button_config(button_id: int, config: dict) -> bool:
     """Update an existing button configuration."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 '''
@@ -2829,6 +3318,8 @@ def update_button_config(button_id: int, config: dict) -> bool:
                     button_id
                 )
             )
+            conn.commit()
+            bump_ui_config_version()
             return cursor.rowcount > 0
     except sqlite3.Error as e:
         logging.error(f"Не удалось update button config {button_id}: {e}")
@@ -2837,9 +3328,11 @@ def update_button_config(button_id: int, config: dict) -> bool:
 def delete_button_config(button_id: int) -> bool:
     """Delete a button configuration."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM button_configs WHERE id = ?", (button_id,))
+            conn.commit()
+            bump_ui_config_version()
             return cursor.rowcount > 0
     except sqlite3.Error as e:
         logging.error(f"Не удалось delete button config {button_id}: {e}")
@@ -2851,7 +3344,7 @@ def reorder_button_configs(menu_type: str, button_orders: list[dict]) -> bool:
     column_position, and button_width.
     """
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             for order_data in button_orders:
                 sort_order = int(order_data.get('sort_order', 0) or 0)
@@ -2883,6 +3376,7 @@ def reorder_button_configs(menu_type: str, button_orders: list[dict]) -> bool:
                     (sort_order, row_pos, col_pos, btn_width, btn_id, menu_type)
                 )
             conn.commit()
+            bump_ui_config_version()
             return True
     except sqlite3.Error as e:
         logging.error(f"Не удалось reorder button configs for {menu_type}: {e}")
@@ -2891,7 +3385,7 @@ def reorder_button_configs(menu_type: str, button_orders: list[dict]) -> bool:
 def migrate_existing_buttons() -> bool:
     """Migrate existing button configurations from settings to button_configs table."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             
             # Define button configurations for all menu types
@@ -2999,6 +3493,9 @@ def migrate_existing_buttons() -> bool:
                 )
             """)
             
+            conn.commit()
+            bump_ui_config_version()
+            
             return True
             
     except sqlite3.Error as e:
@@ -3008,7 +3505,7 @@ def migrate_existing_buttons() -> bool:
 def cleanup_duplicate_buttons() -> bool:
     """Remove duplicate button configurations."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             
             # Remove duplicates, keeping the first occurrence
@@ -3026,6 +3523,9 @@ def cleanup_duplicate_buttons() -> bool:
             if deleted_count > 0:
                 logging.info(f"Удалено {deleted_count} дублирующихся конфигураций кнопок")
             
+            conn.commit()
+            bump_ui_config_version()
+            
             return True
             
     except sqlite3.Error as e:
@@ -3035,7 +3535,7 @@ def cleanup_duplicate_buttons() -> bool:
 def reset_button_migration() -> bool:
     """Reset button migration to re-run with correct layout."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             
             # Only delete if explicitly requested (for force migration)
@@ -3059,7 +3559,7 @@ def force_button_migration() -> bool:
         logging.info("Начинаю принудительную миграцию кнопок...")
         
         # Force delete all existing button configs
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM button_configs")
             deleted_count = cursor.rowcount
@@ -3069,6 +3569,7 @@ def force_button_migration() -> bool:
         # Now migrate with fresh data
         migrate_existing_buttons()
         logging.info("Принудительная миграция кнопок успешно завершена")
+        bump_ui_config_version()
         return True
     except Exception as e:
         logging.error(f"Ошибка при принудительной миграции кнопок: {e}")
@@ -3090,7 +3591,7 @@ def insert_resource_metric(
 ) -> int | None:
     """Insert a resource metric record."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 '''
@@ -3116,7 +3617,7 @@ def insert_resource_metric(
 def get_latest_resource_metric(scope: str, object_name: str) -> dict | None:
     """Get the latest resource metric for a scope/object."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute(
@@ -3138,7 +3639,7 @@ def get_latest_resource_metric(scope: str, object_name: str) -> dict | None:
 def get_metrics_series(scope: str, object_name: str, *, since_hours: int = 24, limit: int = 500) -> list[dict]:
     """Get a series of resource metrics for a scope/object."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             
@@ -3176,7 +3677,7 @@ def get_metrics_series(scope: str, object_name: str, *, since_hours: int = 24, l
 
 def get_transaction_by_payment_id(payment_id: str) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM transactions WHERE payment_id = ?", (payment_id,))
@@ -3189,3 +3690,1027 @@ def get_transaction_by_payment_id(payment_id: str) -> dict | None:
 def get_host_by_name(host_name: str) -> dict | None:
     return get_host(host_name)
 
+
+# --- Аренда лидерства (scheduler_leases) ---
+
+def try_acquire_lease(name: str, holder: str, ttl_seconds: float) -> bool:
+    """Захватить или продлить аренду name для holder. True, если holder — текущий владелец.
+    Чужая аренда перехватывается только после истечения expires_at.
+    """
+    now = datetime.now().timestamp()
+    try:
+        with _connect(timeout=10) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                '''
+                INSERT INTO scheduler_leases (name, holder, acquired_at, heartbeat_at, expires_at)
+                VALUES (?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, ?)
+                ON CONFLICT(name) DO UPDATE SET
+                    acquired_at = CASE WHEN scheduler_leases.holder = excluded.holder
+                                       THEN scheduler_leases.acquired_at ELSE excluded.acquired_at END,
+                    holder = excluded.holder,
+                    heartbeat_at = excluded.heartbeat_at,
+                    expires_at = excluded.expires_at
+                WHERE scheduler_leases.holder = excluded.holder OR scheduler_leases.expires_at < ?
+                ''',
+                (name, holder, now + float(ttl_seconds), now)
+            )
+            conn.commit()
+            cursor.execute("SELECT holder FROM scheduler_leases WHERE name = ?", (name,))
+            row = cursor.fetchone()
+            return bool(row and row[0] == holder)
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось захватить аренду '{name}': {e}")
+        return False
+
+def release_lease(name: str, holder: str) -> bool:
+    try:
+        with _connect(timeout=10) as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM scheduler_leases WHERE name = ? AND holder = ?", (name, holder))
+            conn.commit()
+            return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось освободить аренду '{name}': {e}")
+        return False
+
+def get_lease(name: str) -> dict | None:
+    try:
+        with _connect() as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM scheduler_leases WHERE name = ?", (name,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось получить аренду '{name}': {e}")
+        return None
+
+# --- Телеметрия планировщика (scheduler_runs) ---
+
+def insert_scheduler_run(
+    phase: str,
+    object_name: str | None,
+    started_at: datetime,
+    duration_ms: int,
+    items: int = 0,
+    errors: int = 0,
+    interval_sec: int | None = None,
+    error: str | None = None,
+) -> None:
+    overrun = 1 if interval_sec and duration_ms > int(interval_sec) * 1000 else 0
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                '''
+                INSERT INTO scheduler_runs (phase, object_name, started_at, duration_ms, items, errors, interval_sec, overrun, error)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''',
+                (
+                    phase, object_name, started_at.strftime('%Y-%m-%d %H:%M:%S'), int(duration_ms),
+                    int(items or 0), int(errors or 0), int(interval_sec) if interval_sec else None, overrun,
+                    (error or None) and str(error)[:500],
+                )
+            )
+            conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось записать телеметрию планировщика ({phase}): {e}")
+
+def prune_scheduler_runs(keep_days: int = 14) -> int:
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM scheduler_runs WHERE started_at < datetime('now', 'localtime', ?)", (f'-{int(keep_days)} days',))
+            conn.commit()
+            return cursor.rowcount or 0
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось очистить телеметрию планировщика: {e}")
+        return 0
+
+def _percentile(values: list[int], pct: float) -> int | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    idx = max(0, min(len(ordered) - 1, math.ceil(pct / 100.0 * len(ordered)) - 1))
+    return ordered[idx]
+
+def get_scheduler_run_stats(since_hours: int = 24) -> list[dict]:
+    """Сводка по фазам планировщика за период: число запусков, p50/p95/max длительности, ошибки, перерасходы."""
+    try:
+        with _connect() as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute(
+                '''
+                SELECT phase, object_name, started_at, duration_ms, items, errors, interval_sec, overrun, error
+                FROM scheduler_runs
+                WHERE started_at >= datetime('now', 'localtime', ?)
+                ORDER BY started_at ASC
+                ''',
+                (f'-{int(since_hours)} hours',)
+            )
+            rows = [dict(r) for r in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось получить телеметрию планировщика: {e}")
+        return []
+
+    phases: dict[str, dict] = {}
+    for r in rows:
+        p = phases.setdefault(r['phase'], {
+            'phase': r['phase'], 'runs': 0, 'durations': [], 'items': 0, 'errors': 0,
+            'overruns': 0, 'interval_sec': r['interval_sec'], 'last': None,
+        })
+        p['runs'] += 1
+        p['durations'].append(int(r['duration_ms'] or 0))
+        p['items'] += int(r['items'] or 0)
+        p['errors'] += int(r['errors'] or 0)
+        p['overruns'] += int(r['overrun'] or 0)
+        p['interval_sec'] = r['interval_sec'] or p['interval_sec']
+        p['last'] = r
+
+    result = []
+    for p in phases.values():
+        durations = p.pop('durations')
+        p['avg_ms'] = int(sum(durations) / len(durations)) if durations else None
+        p['p50_ms'] = _percentile(durations, 50)
+        p['p95_ms'] = _percentile(durations, 95)
+        p['max_ms'] = max(durations) if durations else None
+        # Доля интервала, которую занимает p95 — сигнал, что фаза подбирается к своему периоду
+        p['p95_load_pct'] = round(p['p95_ms'] / (p['interval_sec'] * 1000) * 100, 1) if p['interval_sec'] and p['p95_ms'] is not None else None
+        result.append(p)
+    result.sort(key=lambda x: x['phase'])
+    return result
+
+def get_scheduler_run_series(phase: str, since_hours: int = 24, object_name: str | None = None) -> list[dict]:
+    """Ряд запусков фазы для графика трендов (для sync — по всем хостам, если object_name не задан)."""
+    try:
+        with _connect() as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            params: list = [phase, f'-{int(since_hours)} hours']
+            host_filter = ""
+            if object_name:
+                host_filter = " AND object_name = ?"
+                params.append(object_name)
+            cursor.execute(
+                f'''
+                SELECT started_at, object_name, duration_ms, items, errors, overrun
+                FROM scheduler_runs
+                WHERE phase = ? AND started_at >= datetime('now', 'localtime', ?){host_filter}
+                ORDER BY started_at ASC
+                LIMIT 2000
+                ''',
+                params
+            )
+            return [dict(r) for r in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось получить ряд телеметрии планировщика ({phase}): {e}")
+        return []
+
+# --- Рассылки (broadcast_campaigns / broadcast_recipients) ---
+
+def create_broadcast_campaign(
+    created_by: int | None,
+    from_chat_id: int,
+    message_id: int,
+    button_text: str | None = None,
+    button_url: str | None = None,
+    segment: str = 'all',
+    segment_params: dict | None = None,
+) -> int | None:
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                '''
+                INSERT INTO broadcast_campaigns (created_by, from_chat_id, message_id, button_text, button_url, segment, segment_params, status)
+                VALUES (?, ?, ?, ?, ?, ?, ?, 'pending')
+                ''',
+                (
+                    created_by, int(from_chat_id), int(message_id), button_text, button_url,
+                    segment or 'all', json.dumps(segment_params or {}, ensure_ascii=False),
+                )
+            )
+            conn.commit()
+            return cursor.lastrowid
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось создать кампанию рассылки: {e}")
+        return None
+
+def populate_broadcast_recipients(campaign_id: int) -> int:
+    """Заполняет получателей кампании одним INSERT ... SELECT по сегменту (без выгрузки пользователей в память)."""
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT segment, segment_params FROM broadcast_campaigns WHERE campaign_id = ?", (campaign_id,))
+            row = cursor.fetchone()
+            if not row:
+                return 0
+            try:
+                params = json.loads(row[1] or '{}')
+            except (TypeError, ValueError):
+                params = {}
+            where, args = _segment_where(row[0] or 'all', params)
+            cursor.execute(
+                f"INSERT OR IGNORE INTO broadcast_recipients (campaign_id, user_id) SELECT ?, u.telegram_id FROM users u WHERE {where}",
+                [campaign_id, *args]
+            )
+            cursor.execute("SELECT COUNT(*) FROM broadcast_recipients WHERE campaign_id = ?", (campaign_id,))
+            total = int(cursor.fetchone()[0] or 0)
+            cursor.execute("UPDATE broadcast_campaigns SET total = ? WHERE campaign_id = ?", (total, campaign_id))
+            conn.commit()
+            return total
+    except (sqlite3.Error, ValueError) as e:
+        logging.error(f"Не удалось сформировать список получателей кампании {campaign_id}: {e}")
+        return 0
+
+def get_broadcast_campaign(campaign_id: int) -> dict | None:
+    try:
+        with _connect() as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM broadcast_campaigns WHERE campaign_id = ?", (campaign_id,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось получить кампанию рассылки {campaign_id}: {e}")
+        return None
+
+def set_broadcast_campaign_status(campaign_id: int, status: str) -> bool:
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            if status == 'running':
+                cursor.execute(
+                    "UPDATE broadcast_campaigns SET status = ?, started_at = COALESCE(started_at, CURRENT_TIMESTAMP), heartbeat_at = CURRENT_TIMESTAMP WHERE campaign_id = ?",
+                    (status, campaign_id)
+                )
+            elif status in ('completed', 'cancelled', 'failed'):
+                cursor.execute(
+                    "UPDATE broadcast_campaigns SET status = ?, finished_at = CURRENT_TIMESTAMP WHERE campaign_id = ?",
+                    (status, campaign_id)
+                )
+            else:
+                cursor.execute("UPDATE broadcast_campaigns SET status = ? WHERE campaign_id = ?", (status, campaign_id))
+            conn.commit()
+            return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось обновить статус кампании {campaign_id}: {e}")
+        return False
+
+def set_broadcast_progress_message(campaign_id: int, chat_id: int, message_id: int) -> None:
+    try:
+        with _connect() as conn:
+            conn.execute(
+                "UPDATE broadcast_campaigns SET progress_chat_id = ?, progress_message_id = ? WHERE campaign_id = ?",
+                (chat_id, message_id, campaign_id)
+            )
+            conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось сохранить сообщение прогресса кампании {campaign_id}: {e}")
+
+def get_pending_broadcast_recipients(campaign_id: int, after_user_id: int = 0, limit: int = 500) -> list[int]:
+    """Следующая порция получателей по курсору user_id (keyset-пагинация по индексу)."""
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                '''
+                SELECT user_id FROM broadcast_recipients
+                WHERE campaign_id = ? AND status = 'pending' AND user_id > ?
+                ORDER BY user_id
+                LIMIT ?
+                ''',
+                (campaign_id, int(after_user_id), int(limit))
+            )
+            return [int(r[0]) for r in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось получить получателей кампании {campaign_id}: {e}")
+        return []
+
+def record_broadcast_results(campaign_id: int, results: list[tuple[int, str, str | None]]) -> None:
+    """Сохраняет статусы доставки порции (user_id, status, error) и обновляет счётчики кампании."""
+    if not results:
+        return
+    sent = sum(1 for _, st, _ in results if st == 'sent')
+    failed = sum(1 for _, st, _ in results if st == 'failed')
+    blocked = sum(1 for _, st, _ in results if st == 'blocked')
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(
+                "UPDATE broadcast_recipients SET status = ?, error = ?, updated_at = CURRENT_TIMESTAMP WHERE campaign_id = ? AND user_id = ?",
+                [(st, (err or None) and str(err)[:300], campaign_id, uid) for uid, st, err in results]
+            )
+            cursor.execute(
+                '''
+                UPDATE broadcast_campaigns
+                SET sent = sent + ?, failed = failed + ?, blocked = blocked + ?, heartbeat_at = CURRENT_TIMESTAMP
+                WHERE campaign_id = ?
+                ''',
+                (sent, failed, blocked, campaign_id)
+            )
+            if blocked:
+                cursor.executemany(
+                    "UPDATE users SET bot_blocked = 1 WHERE telegram_id = ?",
+                    [(uid,) for uid, st, _ in results if st == 'blocked']
+                )
+            conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось сохранить результаты рассылки {campaign_id}: {e}")
+
+def touch_broadcast_campaign(campaign_id: int) -> None:
+    try:
+        with _connect() as conn:
+            conn.execute("UPDATE broadcast_campaigns SET heartbeat_at = CURRENT_TIMESTAMP WHERE campaign_id = ?", (campaign_id,))
+            conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось обновить heartbeat кампании {campaign_id}: {e}")
+
+def get_stale_running_broadcasts(stale_seconds: int = 120) -> list[int]:
+    """Кампании в статусе running, чей исполнитель давно не отмечался (бот перезапускался)."""
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                '''
+                SELECT campaign_id FROM broadcast_campaigns
+                WHERE status = 'running'
+                  AND (heartbeat_at IS NULL OR heartbeat_at < datetime('now', ?))
+                ORDER BY campaign_id
+                ''',
+                (f'-{int(stale_seconds)} seconds',)
+            )
+            return [int(r[0]) for r in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось получить прерванные рассылки: {e}")
+        return []
+
+# --- Сегменты аудитории для рассылок (вычисляются в SQL) ---
+
+BROADCAST_SEGMENTS = {
+    'all': "Все пользователи",
+    'active_keys': "С активными ключами",
+    'expired_within': "Ключ истёк за N дней (нет активных)",
+    'host': "С активным ключом на хосте",
+    'trial_only': "Только пробный период (без оплат)",
+    'spent_above': "Потратили больше X RUB",
+    'referred': "Пришли по реферальной ссылке",
+}
+
+def _segment_where(segment: str, params: dict | None) -> tuple[str, list]:
+    """SQL-условие (по алиасу u = users) и параметры для сегмента аудитории."""
+    params = params or {}
+    now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    clauses = ["COALESCE(u.is_banned, 0) = 0", "COALESCE(u.bot_blocked, 0) = 0"]
+    args: list = []
+    # datetime(): expiry_date хранится и с пробелом, и с 'T' (isoformat), строковое сравнение их путает
+    active_key = "EXISTS (SELECT 1 FROM vpn_keys k WHERE k.user_id = u.telegram_id AND datetime(k.expiry_date) > ?)"
+
+    if segment in (None, '', 'all'):
+        pass
+    elif segment == 'active_keys':
+        clauses.append(active_key)
+        args.append(now_str)
+    elif segment == 'expired_within':
+        days = max(1, int(params.get('days') or 7))
+        since_str = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+        clauses.append(
+            "EXISTS (SELECT 1 FROM vpn_keys k WHERE k.user_id = u.telegram_id AND datetime(k.expiry_date) <= ? AND datetime(k.expiry_date) > ?)"
+        )
+        args.extend([now_str, since_str])
+        clauses.append("NOT " + active_key)
+        args.append(now_str)
+    elif segment == 'host':
+        host_name = normalize_host_name(params.get('host_name'))
+        if not host_name:
+            raise ValueError("Для сегмента 'host' нужен host_name")
+        clauses.append(
+            "EXISTS (SELECT 1 FROM vpn_keys k WHERE k.user_id = u.telegram_id AND TRIM(k.host_name) = ? AND datetime(k.expiry_date) > ?)"
+        )
+        args.extend([host_name, now_str])
+    elif segment == 'trial_only':
+        clauses.append("COALESCE(u.trial_used, 0) = 1 AND COALESCE(u.total_spent, 0) = 0")
+    elif segment == 'spent_above':
+        clauses.append("COALESCE(u.total_spent, 0) > ?")
+        args.append(float(params.get('amount') or 0))
+    elif segment == 'referred':
+        clauses.append("u.referred_by IS NOT NULL AND TRIM(CAST(u.referred_by AS TEXT)) != ''")
+    else:
+        raise ValueError(f"Неизвестный сегмент аудитории: {segment}")
+    return " AND ".join(clauses), args
+
+def count_segment_users(segment: str, params: dict | None = None) -> int:
+    try:
+        where, args = _segment_where(segment, params)
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT COUNT(*) FROM users u WHERE {where}", args)
+            return int(cursor.fetchone()[0] or 0)
+    except (sqlite3.Error, ValueError) as e:
+        logging.error(f"Не удалось посчитать сегмент '{segment}': {e}")
+        return 0
+
+# --- Хранилище FSM (fsm_storage) ---
+
+def fsm_get_record(storage_key: str) -> tuple[str | None, str | None] | None:
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT state, data FROM fsm_storage WHERE storage_key = ?", (storage_key,))
+            row = cursor.fetchone()
+            return (row[0], row[1]) if row else None
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось прочитать FSM '{storage_key}': {e}")
+        return None
+
+def fsm_set_state(storage_key: str, state: str | None) -> bool:
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                '''
+                INSERT INTO fsm_storage (storage_key, state, data, updated_at) VALUES (?, ?, NULL, ?)
+                ON CONFLICT(storage_key) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at
+                ''',
+                (storage_key, state, time.time())
+            )
+            # Пустые записи не храним
+            cursor.execute("DELETE FROM fsm_storage WHERE storage_key = ? AND state IS NULL AND (data IS NULL OR data = '{}')", (storage_key,))
+            conn.commit()
+            return True
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось сохранить состояние FSM '{storage_key}': {e}")
+        return False
+
+def fsm_set_data(storage_key: str, data_json: str | None) -> bool:
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                '''
+                INSERT INTO fsm_storage (storage_key, state, data, updated_at) VALUES (?, NULL, ?, ?)
+                ON CONFLICT(storage_key) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at
+                ''',
+                (storage_key, data_json, time.time())
+            )
+            cursor.execute("DELETE FROM fsm_storage WHERE storage_key = ? AND state IS NULL AND (data IS NULL OR data = '{}')", (storage_key,))
+            conn.commit()
+            return True
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось сохранить данные FSM '{storage_key}': {e}")
+        return False
+
+def fsm_cleanup(ttl_seconds: int) -> int:
+    """Удаляет брошенные состояния FSM, которые не менялись дольше ttl_seconds."""
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM fsm_storage WHERE updated_at < ?", (time.time() - int(ttl_seconds),))
+            conn.commit()
+            return cursor.rowcount or 0
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось очистить устаревшие состояния FSM: {e}")
+        return 0
+
+def set_key_connection_string(key_id: int, connection_string: str | None) -> bool:
+    """Сохраняет ссылку подключения, полученную из панели, и время проверки."""
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "UPDATE vpn_keys SET connection_string = COALESCE(?, connection_string), connection_checked_at = ? WHERE key_id = ?",
+                (connection_string, time.time(), key_id)
+            )
+            conn.commit()
+            return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось сохранить ссылку подключения для ключа {key_id}: {e}")
+        return False
+
+# --- Входящие уведомления об оплате (payment_inbox) ---
+
+def _insert_payment_event(cursor: sqlite3.Cursor, provider: str, external_id: str | None, metadata: dict) -> None:
+    """Вставка в payment_inbox в транзакции вызывающего. Повтор того же уведомления игнорируется."""
+    payload = json.dumps(metadata, ensure_ascii=False, sort_keys=True, default=str)
+    if not external_id:
+        external_id = "sha256:" + hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    now = time.time()
+    cursor.execute(
+        '''
+        INSERT OR IGNORE INTO payment_inbox (provider, external_id, metadata, status, attempts, next_attempt_at, created_at, updated_at)
+        VALUES (?, ?, ?, 'pending', 0, ?, ?, ?)
+        ''',
+        (provider, str(external_id), payload, now, now, now)
+    )
+    if cursor.rowcount:
+        logging.info(f"Платёж {provider}/{external_id} принят в очередь обработки.")
+    else:
+        logging.info(f"Платёж {provider}/{external_id} уже в очереди, повторное уведомление пропущено.")
+
+def enqueue_payment_event(provider: str, external_id: str | None, metadata: dict) -> bool:
+    """Сохраняет подтверждённое уведомление об оплате. Повтор того же уведомления игнорируется.
+    False — только если запись не удалась (провайдеру нужно ответить ошибкой, чтобы он повторил)."""
+    try:
+        with _connect() as conn:
+            _insert_payment_event(conn.cursor(), provider, external_id, metadata)
+            conn.commit()
+            return True
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось сохранить уведомление об оплате {provider}/{external_id}: {e}")
+        return False
+
+def claim_payment_events(limit: int, lease_seconds: int) -> list[dict]:
+    """Забирает готовые к обработке уведомления и продлевает им аренду, чтобы их не взял другой воркер.
+    Записи в статусе processing с истёкшей арендой (воркер упал) забираются повторно."""
+    now = time.time()
+    try:
+        with _connect(isolation_level=None) as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                cursor.execute(
+                    '''
+                    SELECT inbox_id, provider, external_id, metadata, attempts FROM payment_inbox
+                    WHERE status IN ('pending', 'processing') AND next_attempt_at <= ?
+                    ORDER BY next_attempt_at, inbox_id
+                    LIMIT ?
+                    ''',
+                    (now, int(limit))
+                )
+                rows = [dict(r) for r in cursor.fetchall()]
+                if rows:
+                    cursor.executemany(
+                        "UPDATE payment_inbox SET status = 'processing', attempts = attempts + 1, next_attempt_at = ?, updated_at = ? WHERE inbox_id = ?",
+                        [(now + int(lease_seconds), now, r['inbox_id']) for r in rows]
+                    )
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+        events = []
+        for row in rows:
+            try:
+                row['metadata'] = json.loads(row['metadata'])
+            except (TypeError, ValueError):
+                row['metadata'] = {}
+            row['attempts'] = int(row['attempts'] or 0) + 1
+            events.append(row)
+        return events
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось получить уведомления об оплате из очереди: {e}")
+        return []
+
+def complete_payment_event(inbox_id: int) -> bool:
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "UPDATE payment_inbox SET status = 'done', last_error = NULL, updated_at = ? WHERE inbox_id = ?",
+                (time.time(), inbox_id)
+            )
+            conn.commit()
+            return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось отметить уведомление об оплате #{inbox_id} обработанным: {e}")
+        return False
+
+def fail_payment_event(inbox_id: int, error: str, retry_at: float | None) -> bool:
+    """Ошибка обработки: retry_at — время следующей попытки, None — попытки исчерпаны."""
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            if retry_at is None:
+                cursor.execute(
+                    "UPDATE payment_inbox SET status = 'failed', last_error = ?, updated_at = ? WHERE inbox_id = ?",
+                    ((error or '')[:1000], time.time(), inbox_id)
+                )
+            else:
+                cursor.execute(
+                    "UPDATE payment_inbox SET status = 'pending', last_error = ?, next_attempt_at = ?, updated_at = ? WHERE inbox_id = ?",
+                    ((error or '')[:1000], float(retry_at), time.time(), inbox_id)
+                )
+            conn.commit()
+            return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось сохранить ошибку обработки уведомления #{inbox_id}: {e}")
+        return False
+
+def defer_payment_event(inbox_id: int, retry_at: float) -> bool:
+    """Откладывает уведомление без учёта попытки (платёж ещё обрабатывается в другом месте)."""
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "UPDATE payment_inbox SET status = 'pending', attempts = MAX(0, attempts - 1), next_attempt_at = ?, updated_at = ? WHERE inbox_id = ?",
+                (float(retry_at), time.time(), inbox_id)
+            )
+            conn.commit()
+            return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось отложить уведомление #{inbox_id}: {e}")
+        return False
+
+def prune_payment_inbox(keep_days: int = 30) -> int:
+    """Удаляет успешно обработанные уведомления старше keep_days (ошибочные остаются для разбора)."""
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "DELETE FROM payment_inbox WHERE status = 'done' AND updated_at < ?",
+                (time.time() - int(keep_days) * 86400,)
+            )
+            conn.commit()
+            return cursor.rowcount or 0
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось очистить очередь платежей: {e}")
+        return 0
+
+# --- Идемпотентная обработка платежей (payment_claims) ---
+
+# Захват в статусе processing старше этого считается брошенным (процесс упал посреди обработки)
+PAYMENT_CLAIM_STALE_SECONDS = 600
+# Недавно обработанные payment_id держим в памяти: повторные уведомления отсекаются без обращения к БД
+PROCESSED_PAYMENTS_LRU_SIZE = 5000
+
+_processed_payments: "OrderedDict[str, None]" = OrderedDict()
+_processed_lock = threading.Lock()
+
+def _remember_processed_payment(payment_id: str):
+    with _processed_lock:
+        _processed_payments[payment_id] = None
+        _processed_payments.move_to_end(payment_id)
+        while len(_processed_payments) > PROCESSED_PAYMENTS_LRU_SIZE:
+            _processed_payments.popitem(last=False)
+
+def is_payment_processed_cached(payment_id: str | None) -> bool:
+    if not payment_id:
+        return False
+    with _processed_lock:
+        if payment_id in _processed_payments:
+            _processed_payments.move_to_end(payment_id)
+            return True
+    return False
+
+# Результаты claim_payment
+PAYMENT_CLAIM_ACQUIRED = 'acquired'
+PAYMENT_CLAIM_DONE = 'done'
+PAYMENT_CLAIM_BUSY = 'busy'
+
+def claim_payment(payment_id: str) -> str:
+    """Атомарно захватывает платёж для обработки.
+    acquired — захват получен; done — платёж уже обработан; busy — платёж сейчас обрабатывается
+    (или захват ещё не признан брошенным), повторить позже."""
+    if is_payment_processed_cached(payment_id):
+        return PAYMENT_CLAIM_DONE
+    now = time.time()
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT OR IGNORE INTO payment_claims (payment_id, status, claimed_at) VALUES (?, 'processing', ?)",
+                (payment_id, now)
+            )
+            if cursor.rowcount == 0:
+                # Запись есть: повторно захватить можно только после ошибки или брошенный захват
+                cursor.execute(
+                    """
+                    UPDATE payment_claims SET status = 'processing', claimed_at = ?, finished_at = NULL
+                    WHERE payment_id = ?
+                      AND (status = 'failed' OR (status = 'processing' AND claimed_at < ?))
+                    """,
+                    (now, payment_id, now - PAYMENT_CLAIM_STALE_SECONDS)
+                )
+            conn.commit()
+            if cursor.rowcount > 0:
+                return PAYMENT_CLAIM_ACQUIRED
+            cursor.execute("SELECT status FROM payment_claims WHERE payment_id = ?", (payment_id,))
+            row = cursor.fetchone()
+            if row and row[0] == 'done':
+                _remember_processed_payment(payment_id)
+                return PAYMENT_CLAIM_DONE
+            return PAYMENT_CLAIM_BUSY
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось захватить платёж {payment_id} для обработки: {e}")
+        # Без захвата не обрабатываем: вызывающая сторона повторит позже
+        raise
+
+def finish_payment_claim(payment_id: str, success: bool) -> bool:
+    """Завершает захват: done — платёж больше не обрабатывается, failed — разрешена повторная попытка."""
+    if success:
+        _remember_processed_payment(payment_id)
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "UPDATE payment_claims SET status = ?, finished_at = ? WHERE payment_id = ?",
+                ('done' if success else 'failed', time.time(), payment_id)
+            )
+            conn.commit()
+            return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось завершить захват платежа {payment_id}: {e}")
+        return False
+
+# --- Версии данных для кэша веб-панели (data_versions) ---
+
+# Таблица -> домен версии; счётчики увеличиваются триггерами
+DATA_VERSION_TABLES = {
+    "users": "users",
+    "vpn_keys": "keys",
+    "transactions": "transactions",
+    "xui_hosts": "hosts",
+    "support_tickets": "tickets",
+    "support_messages": "tickets",
+    "resource_metrics": "metrics",
+}
+
+def get_data_versions(*domains: str) -> tuple | None:
+    """Текущие версии доменов одним запросом; None — версии недоступны (кэш не используем)."""
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            placeholders = ",".join("?" for _ in domains)
+            cursor.execute(f"SELECT domain, version FROM data_versions WHERE domain IN ({placeholders})", domains)
+            found = dict(cursor.fetchall())
+            if len(found) != len(domains):
+                return None
+            return tuple(found[d] for d in domains)
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось получить версии данных: {e}")
+        return None
+
+# --- Постраничная выдача ключей для админки (фильтры + курсор) ---
+
+KEYS_PAGE_SORTS = {
+    # sort -> (выражение сортировки, направление «вперёд»)
+    'new': ("key_id", "DESC"),
+    'old': ("key_id", "ASC"),
+    # datetime(): expiry_date хранится и с пробелом, и с 'T' — сортируем и сравниваем курсор по нормализованному значению
+    'expiry': ("COALESCE(datetime(expiry_date), '')", "ASC"),
+    'expiry_desc': ("COALESCE(datetime(expiry_date), '')", "DESC"),
+}
+KEYS_EXPIRING_DAYS = 3
+
+def get_keys_page(
+    filters: dict | None = None,
+    sort: str = 'new',
+    cursor: str | None = None,
+    limit: int = 50,
+) -> tuple[list[dict], str | None, str | None]:
+    """Страница ключей для админки с фильтрами на стороне БД и курсором без OFFSET.
+    filters: host, user_id, state ('active'|'expired'|'expiring'), gift ('1'|'0'), q (поиск по email/комментарию/UUID).
+    cursor: None — первая страница, 'n{key_id}' — после указанного ключа, 'p{key_id}' — перед ним.
+    Возвращает (keys, prev_cursor, next_cursor).
+    """
+    filters = filters or {}
+    limit = max(1, min(200, int(limit or 50)))
+    sort_expr, forward = KEYS_PAGE_SORTS.get(sort) or KEYS_PAGE_SORTS['new']
+    backward = "ASC" if forward == "DESC" else "DESC"
+    direction, anchor_id = None, None
+    if cursor and cursor[0] in ('n', 'p'):
+        try:
+            direction, anchor_id = cursor[0], int(cursor[1:])
+        except ValueError:
+            direction, anchor_id = None, None
+
+    where = []
+    args: list = []
+    host = normalize_host_name(filters.get('host'))
+    if host:
+        where.append("TRIM(host_name) = TRIM(?)")
+        args.append(host)
+    user_id = filters.get('user_id')
+    if user_id not in (None, ''):
+        where.append("user_id = ?")
+        args.append(int(user_id))
+    state = filters.get('state')
+    # datetime(): expiry_date хранится и с пробелом, и с 'T' (isoformat), строковое сравнение их путает
+    now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    if state == 'active':
+        where.append("datetime(expiry_date) > ?")
+        args.append(now_str)
+    elif state == 'expired':
+        where.append("datetime(expiry_date) <= ?")
+        args.append(now_str)
+    elif state == 'expiring':
+        soon_str = (datetime.now() + timedelta(days=KEYS_EXPIRING_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+        where.append("datetime(expiry_date) > ? AND datetime(expiry_date) <= ?")
+        args.extend([now_str, soon_str])
+    gift = filters.get('gift')
+    if gift in ('1', 1, True):
+        where.append("COALESCE(is_gift, 0) = 1")
+    elif gift in ('0', 0, False):
+        where.append("COALESCE(is_gift, 0) = 0")
+    q = (filters.get('q') or '').strip()
+    if q:
+        like = f"%{q}%"
+        where.append("(key_email LIKE ? OR comment LIKE ? OR xui_client_uuid LIKE ?)")
+        args.extend([like, like, like])
+
+    try:
+        with _connect() as conn:
+            conn.row_factory = sqlite3.Row
+            db = conn.cursor()
+            anchor = None
+            if anchor_id is not None:
+                db.execute(f"SELECT {sort_expr}, key_id FROM vpn_keys WHERE key_id = ?", (anchor_id,))
+                anchor = db.fetchone()
+            if anchor is not None:
+                # Шаг «вперёд» идёт в направлении сортировки, «назад» — против него
+                step = forward if direction == 'n' else backward
+                op = "<" if step == "DESC" else ">"
+                where.append(f"({sort_expr} {op} ? OR ({sort_expr} = ? AND key_id {op} ?))")
+                args.extend([anchor[0], anchor[0], anchor[1]])
+                order = f"{sort_expr} {step}, key_id {step}"
+            else:
+                direction = None
+                order = f"{sort_expr} {forward}, key_id {forward}"
+
+            sql = "SELECT * FROM vpn_keys"
+            if where:
+                sql += " WHERE " + " AND ".join(where)
+            sql += f" ORDER BY {order} LIMIT ?"
+            db.execute(sql, [*args, limit + 1])
+            rows = [dict(r) for r in db.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось получить страницу ключей: {e}")
+        return [], None, None
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == 'p':
+        rows.reverse()
+    if not rows:
+        return [], None, None
+    first_id, last_id = rows[0]['key_id'], rows[-1]['key_id']
+    if direction is None:
+        prev_cursor, next_cursor = None, (f"n{last_id}" if has_more else None)
+    elif direction == 'n':
+        prev_cursor, next_cursor = f"p{first_id}", (f"n{last_id}" if has_more else None)
+    else:
+        prev_cursor, next_cursor = (f"p{first_id}" if has_more else None), f"n{last_id}"
+    return rows, prev_cursor, next_cursor
+
+def get_expired_keys() -> list[dict]:
+    """Ключи с истёкшим сроком (по локальному времени, как expiry_date хранится в БД).
+    expiry_date встречается и как 'YYYY-MM-DD HH:MM:SS', и как isoformat() с 'T', поэтому сравниваем через datetime()."""
+    now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    try:
+        with _connect() as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT * FROM vpn_keys WHERE expiry_date IS NOT NULL AND datetime(expiry_date) <= ? ORDER BY host_name, key_id",
+                (now_str,)
+            )
+            return [dict(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось получить истёкшие ключи: {e}")
+        return []
+
+def delete_keys_by_ids(key_ids: list[int]) -> int:
+    """Удаляет ключи одной транзакцией; возвращает число удалённых."""
+    ids = [int(k) for k in key_ids if k is not None]
+    if not ids:
+        return 0
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            placeholders = ",".join("?" for _ in ids)
+            cursor.execute(f"DELETE FROM vpn_keys WHERE key_id IN ({placeholders})", ids)
+            conn.commit()
+            return cursor.rowcount
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось удалить ключи {ids[:5]}…: {e}")
+        return 0
+
+# --- Ежедневные сводки для графиков (daily_rollups) ---
+
+# Оплаченная транзакция; оплаты с баланса не считаются выручкой (деньги уже учтены при пополнении)
+_PAID_SQL = "LOWER(COALESCE({t}status, '')) IN ('paid', 'completed', 'success')"
+_METHOD_SQL = (
+    "COALESCE(NULLIF({t}payment_method, ''), "
+    "CASE WHEN json_valid({t}metadata) THEN json_extract({t}metadata, '$.payment_method') END, 'unknown')"
+)
+_PURCHASE_KIND_SQL = (
+    "CASE WHEN NOT json_valid({t}metadata) THEN 'new' "
+    "WHEN json_extract({t}metadata, '$.action') = 'top_up' THEN 'top_up' "
+    "WHEN json_extract({t}metadata, '$.action') = 'extend' "
+    "OR COALESCE(json_extract({t}metadata, '$.key_id'), 0) NOT IN (0, '0', '') THEN 'renew' "
+    "ELSE 'new' END"
+)
+# Сколько последних дней пересчитывается из исходных таблиц при ночной сверке
+ROLLUP_RECONCILE_DAYS = 2
+ROLLUP_BACKFILL_DAYS = 366
+
+def _rollup_upsert(day_sql: str, metric: str, dimension_sql: str, value_sql: str) -> str:
+    return (
+        "INSERT INTO daily_rollups (day, metric, dimension, value) "
+        f"VALUES (COALESCE({day_sql}, date('now', 'localtime')), '{metric}', {dimension_sql}, {value_sql}) "
+        "ON CONFLICT(day, metric, dimension) DO UPDATE SET value = value + excluded.value;"
+    )
+
+def _rollup_trigger_statements() -> list[str]:
+    """Триггеры, поддерживающие daily_rollups при записи в users / vpn_keys / transactions."""
+    paid_new = _PAID_SQL.format(t="NEW.")
+    paid_old = _PAID_SQL.format(t="OLD.")
+    payment_body = " ".join([
+        "BEGIN",
+        "INSERT INTO daily_rollups (day, metric, dimension, value) "
+        "SELECT COALESCE(date(NEW.created_date), date('now', 'localtime')), 'revenue', "
+        f"LOWER({_METHOD_SQL.format(t='NEW.')}), COALESCE(NEW.amount_rub, 0) "
+        f"WHERE LOWER({_METHOD_SQL.format(t='NEW.')}) <> 'balance' "
+        "ON CONFLICT(day, metric, dimension) DO UPDATE SET value = value + excluded.value;",
+        _rollup_upsert("date(NEW.created_date)", "purchases", _PURCHASE_KIND_SQL.format(t="NEW."), "1"),
+        "INSERT INTO daily_rollups (day, metric, dimension, value) "
+        "SELECT COALESCE(date(NEW.created_date), date('now', 'localtime')), 'trial_conversions', '', 1 "
+        "WHERE (SELECT COALESCE(trial_used, 0) FROM users WHERE telegram_id = NEW.user_id) = 1 "
+        "AND NOT EXISTS (SELECT 1 FROM transactions t WHERE t.user_id = NEW.user_id "
+        f"AND t.transaction_id <> NEW.transaction_id AND {_PAID_SQL.format(t='t.')}) "
+        "ON CONFLICT(day, metric, dimension) DO UPDATE SET value = value + excluded.value;",
+        "END",
+    ])
+    return [
+        "CREATE TRIGGER IF NOT EXISTS trg_users_insert_rollup AFTER INSERT ON users BEGIN "
+        + _rollup_upsert("date(NEW.registration_date)", "new_users", "''", "1") + " END",
+        "CREATE TRIGGER IF NOT EXISTS trg_vpn_keys_insert_rollup AFTER INSERT ON vpn_keys BEGIN "
+        + _rollup_upsert("date(NEW.created_date)", "new_keys", "''", "1") + " END",
+        f"CREATE TRIGGER IF NOT EXISTS trg_transactions_insert_rollup AFTER INSERT ON transactions "
+        f"WHEN {paid_new} {payment_body}",
+        f"CREATE TRIGGER IF NOT EXISTS trg_transactions_paid_rollup AFTER UPDATE OF status ON transactions "
+        f"WHEN {paid_new} AND NOT {paid_old} {payment_body}",
+    ]
+
+def _reconcile_rollups(cursor: sqlite3.Cursor, start_day: str, end_day: str) -> None:
+    """Пересчитывает сводки за [start_day, end_day] из исходных таблиц (в транзакции вызывающего)."""
+    cursor.execute("DELETE FROM daily_rollups WHERE day BETWEEN ? AND ?", (start_day, end_day))
+    paid = _PAID_SQL.format(t="")
+    method = f"LOWER({_METHOD_SQL.format(t='')})"
+    statements = [
+        "SELECT date(registration_date) AS d, 'new_users', '', COUNT(*) FROM users "
+        "WHERE d BETWEEN ? AND ? GROUP BY d",
+        "SELECT date(created_date) AS d, 'new_keys', '', COUNT(*) FROM vpn_keys "
+        "WHERE d BETWEEN ? AND ? GROUP BY d",
+        f"SELECT date(created_date) AS d, 'revenue', {method} AS m, SUM(COALESCE(amount_rub, 0)) FROM transactions "
+        f"WHERE {paid} AND d BETWEEN ? AND ? AND m <> 'balance' GROUP BY d, m",
+        f"SELECT date(created_date) AS d, 'purchases', {_PURCHASE_KIND_SQL.format(t='')} AS k, COUNT(*) FROM transactions "
+        f"WHERE {paid} AND d BETWEEN ? AND ? GROUP BY d, k",
+        "SELECT d, 'trial_conversions', '', COUNT(*) FROM ("
+        "SELECT MIN(date(t.created_date)) AS d FROM transactions t JOIN users u ON u.telegram_id = t.user_id "
+        f"WHERE {_PAID_SQL.format(t='t.')} AND COALESCE(u.trial_used, 0) = 1 GROUP BY t.user_id"
+        ") WHERE d BETWEEN ? AND ? GROUP BY d",
+    ]
+    for select in statements:
+        cursor.execute(f"INSERT INTO daily_rollups (day, metric, dimension, value) {select}", (start_day, end_day))
+
+def reconcile_daily_rollups(days: int = ROLLUP_RECONCILE_DAYS) -> bool:
+    """Ночная сверка: пересчёт последних дней (поправляет сводки после ручных правок и сбоев).
+    Пустая таблица заполняется за ROLLUP_BACKFILL_DAYS."""
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1 FROM daily_rollups LIMIT 1")
+            if cursor.fetchone() is None:
+                days = max(days, ROLLUP_BACKFILL_DAYS)
+            today = datetime.now().date()
+            start = (today - timedelta(days=max(1, days) - 1)).isoformat()
+            _reconcile_rollups(cursor, start, today.isoformat())
+            conn.commit()
+            return True
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось пересчитать ежедневные сводки: {e}")
+        return False
+
+def get_daily_rollups(days: int = 365) -> dict:
+    """Ряды для графиков за последние days дней из daily_rollups (без обхода исходных таблиц)."""
+    days = max(1, min(ROLLUP_BACKFILL_DAYS, int(days or 365)))
+    stats = {
+        'users': {}, 'keys': {}, 'revenue': {}, 'revenue_by_method': {},
+        'purchases': {'new': {}, 'renew': {}, 'top_up': {}}, 'trial_conversions': {},
+    }
+    start = (datetime.now().date() - timedelta(days=days - 1)).isoformat()
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT day, metric, dimension, value FROM daily_rollups WHERE day >= ? ORDER BY day",
+                (start,)
+            )
+            for day, metric, dimension, value in cursor.fetchall():
+                if metric == 'new_users':
+                    stats['users'][day] = int(value)
+                elif metric == 'new_keys':
+                    stats['keys'][day] = int(value)
+                elif metric == 'revenue':
+                    stats['revenue'][day] = round(stats['revenue'].get(day, 0) + value, 2)
+                    stats['revenue_by_method'].setdefault(dimension, {})[day] = round(value, 2)
+                elif metric == 'purchases':
+                    stats['purchases'].setdefault(dimension, {})[day] = int(value)
+                elif metric == 'trial_conversions':
+                    stats['trial_conversions'][day] = int(value)
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось получить ежедневные сводки: {e}")
+    return stats
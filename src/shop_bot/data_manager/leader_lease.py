@@ -0,0 +1,68 @@
+import asyncio
+import logging
+import os
+import socket
+import uuid
+
+from shop_bot.data_manager import database
+
+logger = logging.getLogger(__name__)
+
+# Аренда лидерства для фоновых задач: только лидер выполняет синхронизацию,
+# уведомления, бэкапы и сбор метрик. Веб-панель и боты работают на всех инстансах.
+LEASE_NAME = "scheduler"
+LEASE_TTL_SECONDS = 90
+HEARTBEAT_INTERVAL_SECONDS = 30
+
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+_is_leader = False
+
+
+def is_leader() -> bool:
+    """Последнее известное состояние (обновляется heartbeat-ом и ensure_leader)."""
+    return _is_leader
+
+
+def ensure_leader() -> bool:
+    """Захватывает или продлевает аренду прямо сейчас. True, если этот инстанс — лидер."""
+    global _is_leader
+    acquired = database.try_acquire_lease(LEASE_NAME, INSTANCE_ID, LEASE_TTL_SECONDS)
+    if acquired != _is_leader:
+        if acquired:
+            logger.info(f"Лидерство: инстанс {INSTANCE_ID} стал лидером фоновых задач.")
+        else:
+            logger.warning(f"Лидерство: инстанс {INSTANCE_ID} больше не лидер, фоновые задачи приостановлены.")
+    _is_leader = acquired
+    return acquired
+
+
+def get_status() -> dict:
+    lease = database.get_lease(LEASE_NAME) or {}
+    return {
+        "instance_id": INSTANCE_ID,
+        "is_leader": _is_leader,
+        "holder": lease.get("holder"),
+        "heartbeat_at": lease.get("heartbeat_at"),
+        "expires_at": lease.get("expires_at"),
+    }
+
+
+async def run_heartbeat():
+    """Фоновое продление аренды, чтобы длинный цикл планировщика не потерял лидерство."""
+    global _is_leader
+    try:
+        while True:
+            try:
+                await asyncio.to_thread(ensure_leader)
+            except Exception as e:
+                logger.error(f"Лидерство: ошибка продления аренды: {e}")
+            await asyncio.sleep(HEARTBEAT_INTERVAL_SECONDS)
+    finally:
+        if _is_leader:
+            try:
+                database.release_lease(LEASE_NAME, INSTANCE_ID)
+                logger.info(f"Лидерство: аренда освобождена инстансом {INSTANCE_ID}.")
+            except Exception:
+                pass
+        _is_leader = False
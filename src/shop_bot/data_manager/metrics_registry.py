@@ -0,0 +1,229 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterable
+
+# Лёгкий реестр метрик в памяти процесса для выдачи в формате Prometheus (/metrics).
+# Счётчики и гистограммы пишутся из любых потоков (короткая блокировка на метрику),
+# а значения, которые уже считаются в других модулях (метрики обработчиков, очередь отправки),
+# подтягиваются сборщиками только в момент запроса /metrics.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Защита от взрыва числа рядов (например, при метках из пользовательских данных)
+MAX_SERIES_PER_METRIC = 1000
+
+# Семейство для сборщика: (имя, тип, описание, [(суффикс, метки, значение), ...])
+Family = tuple[str, str, str, list[tuple[str, dict, float]]]
+
+_metrics: dict[str, "_Metric"] = {}
+_collectors: list[Callable[[], Iterable[Family]]] = []
+_registry_lock = threading.Lock()
+
+# Счётчики обращений в рамках текущей операции (например, обработки апдейта бота): модули нижнего уровня
+# отмечают обращения через count_in_scope, а открывший область читает итог. asyncio.to_thread копирует
+# контекст, так что вызовы из потоков попадают в ту же область.
+_scope_counts: ContextVar[dict | None] = ContextVar("metrics_scope_counts", default=None)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values: dict[tuple, object] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple | None:
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        if key not in self._values and len(self._values) >= MAX_SERIES_PER_METRIC:
+            return None
+        return key
+
+    def samples(self) -> list[tuple[str, dict, float]]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        with self._lock:
+            key = self._key(labels)
+            if key is not None:
+                self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> list[tuple[str, dict, float]]:
+        with self._lock:
+            items = list(self._values.items())
+        return [("", dict(zip(self.labelnames, key)), value) for key, value in items]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float | None, **labels) -> None:
+        with self._lock:
+            key = self._key(labels)
+            if key is None:
+                return
+            if value is None:
+                self._values.pop(key, None)
+            else:
+                self._values[key] = float(value)
+
+    def samples(self) -> list[tuple[str, dict, float]]:
+        with self._lock:
+            items = list(self._values.items())
+        return [("", dict(zip(self.labelnames, key)), value) for key, value in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        idx = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                idx = i
+                break
+        with self._lock:
+            key = self._key(labels)
+            if key is None:
+                return
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][idx] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> list[tuple[str, dict, float]]:
+        with self._lock:
+            items = [(key, list(state[0]), state[1]) for key, state in self._values.items()]
+        out = []
+        for key, counts, total in items:
+            labels = dict(zip(self.labelnames, key))
+            out.extend(histogram_samples(labels, self.buckets, counts, total))
+        return out
+
+
+def histogram_samples(labels: dict, bounds: Iterable[float], counts: list[int], total: float) -> list[tuple[str, dict, float]]:
+    """Ряды гистограммы Prometheus (накопительные корзины, _sum, _count) из поштучных счётчиков корзин;
+    последний элемент counts — значения больше последней границы."""
+    out = []
+    seen = 0
+    for bound, n in zip(bounds, counts):
+        seen += n
+        out.append(("_bucket", {**labels, "le": _format_value(bound)}, seen))
+    count = sum(counts)
+    out.append(("_bucket", {**labels, "le": "+Inf"}, count))
+    out.append(("_sum", labels, total))
+    out.append(("_count", labels, count))
+    return out
+
+
+def _register(metric: _Metric) -> _Metric:
+    with _registry_lock:
+        existing = _metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        _metrics[metric.name] = metric
+        return metric
+
+
+def counter(name: str, help_text: str, labelnames: tuple[str, ...] = ()) -> Counter:
+    return _register(Counter(name, help_text, labelnames))
+
+
+def gauge(name: str, help_text: str, labelnames: tuple[str, ...] = ()) -> Gauge:
+    return _register(Gauge(name, help_text, labelnames))
+
+
+def histogram(name: str, help_text: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+    return _register(Histogram(name, help_text, labelnames, buckets))
+
+
+def register_collector(collect: Callable[[], Iterable[Family]]) -> None:
+    """Сборщик вызывается при каждом запросе /metrics и возвращает готовые семейства."""
+    with _registry_lock:
+        if collect not in _collectors:
+            _collectors.append(collect)
+
+
+def count_in_scope(name: str) -> None:
+    counts = _scope_counts.get()
+    if counts is not None:
+        counts[name] = counts.get(name, 0) + 1
+
+
+@contextmanager
+def counting_scope():
+    """Открывает область подсчёта; отдаёт словарь {имя: число обращений}, заполняемый до выхода из области."""
+    counts: dict[str, int] = {}
+    token = _scope_counts.set(counts)
+    try:
+        yield counts
+    finally:
+        _scope_counts.reset(token)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        if math.isnan(value):
+            return "NaN"
+        if value.is_integer() and abs(value) < 1e15:
+            return str(int(value))
+        return repr(value)
+    return str(value)
+
+
+def _format_family(name: str, kind: str, help_text: str, samples: list[tuple[str, dict, float]]) -> list[str]:
+    lines = [f"# HELP {name} {_escape(help_text)}", f"# TYPE {name} {kind}"]
+    for suffix, labels, value in samples:
+        if labels:
+            label_str = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+            lines.append(f"{name}{suffix}{{{label_str}}} {_format_value(value)}")
+        else:
+            lines.append(f"{name}{suffix} {_format_value(value)}")
+    return lines
+
+
+def render() -> str:
+    """Текст в формате Prometheus exposition 0.0.4."""
+    with _registry_lock:
+        metrics = list(_metrics.values())
+        collectors = list(_collectors)
+    lines: list[str] = []
+    for metric in metrics:
+        samples = metric.samples()
+        if samples:
+            lines.extend(_format_family(metric.name, metric.kind, metric.help, samples))
+    for collect in collectors:
+        try:
+            families = list(collect() or [])
+        except Exception:
+            continue
+        for name, kind, help_text, samples in families:
+            if samples:
+                lines.extend(_format_family(name, kind, help_text, samples))
+    return "\n".join(lines) + "\n"
@@ -3,7 +3,10 @@ import json
 import time
 import logging
 import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait as futures_wait
 from datetime import datetime, timedelta
+from math import ceil
 from typing import Any, Dict, List, Tuple
 
 import paramiko
@@ -12,6 +15,21 @@ from shop_bot.data_manager import database
 
 logger = logging.getLogger(__name__)
 
+# Параллельный SSH-сбор метрик: общий ограниченный пул потоков и таймаут на хост
+SSH_POOL_SIZE = 32
+HOST_METRICS_TIMEOUT_SECONDS = 30
+_ssh_pool: ThreadPoolExecutor | None = None
+_ssh_pool_lock = threading.Lock()
+
+
+def get_ssh_pool() -> ThreadPoolExecutor:
+    """Общий пул потоков для SSH-запросов метрик (создаётся при первом обращении)."""
+    global _ssh_pool
+    with _ssh_pool_lock:
+        if _ssh_pool is None:
+            _ssh_pool = ThreadPoolExecutor(max_workers=SSH_POOL_SIZE, thread_name_prefix="ssh-metrics")
+        return _ssh_pool
+
 
 # -------- Local metrics (container/host running the panel) --------
 def _read_proc_meminfo() -> Tuple[int | None, int | None]:
@@ -288,33 +306,57 @@ def get_host_metrics_via_ssh(host_row: dict) -> Dict[str, Any]:
     return res
 
 
-def collect_hosts_metrics() -> Dict[str, Any]:
-    items: List[Dict[str, Any]] = []
+def _host_without_ssh_item(h: dict) -> Dict[str, Any]:
+    return {
+        'ok': False,
+        'host_name': h.get('host_name'),
+        'host_url': h.get('host_url'),
+        'error': 'SSH не настроен',
+        'cpu_percent': None,
+        'mem_percent': None,
+        'disk_percent': None,
+        'uptime_seconds': None
+    }
+
+
+def _safe_host_metrics(h: dict) -> Dict[str, Any]:
+    try:
+        return get_host_metrics_via_ssh(h)
+    except Exception as e:
+        return {'ok': False, 'host_name': h.get('host_name'), 'error': str(e)}
+
+
+def collect_hosts_metrics(timeout: float = HOST_METRICS_TIMEOUT_SECONDS) -> Dict[str, Any]:
+    """
+    Метрики всех хостов: SSH-запросы выполняются параллельно в общем пуле,
+    поэтому время ответа ~ время самого медленного хоста, а не их сумма.
+    """
     try:
         hosts = database.get_all_hosts()
     except Exception as e:
         return {'ok': False, 'items': [], 'error': f'get_all_hosts failed: {e}'}
 
-    for h in hosts:
+    pool = get_ssh_pool()
+    futures = {}
+    for idx, h in enumerate(hosts):
         # Проверяем наличие SSH настроек
         if h.get('ssh_host') and h.get('ssh_user'):
-            # Хост с SSH - получаем метрики
-            try:
-                m = get_host_metrics_via_ssh(h)
-            except Exception as e:
-                m = {'ok': False, 'host_name': h.get('host_name'), 'error': str(e)}
-        else:
+            futures[idx] = pool.submit(_safe_host_metrics, h)
+
+    if futures:
+        # Хосты сверх размера пула идут «волнами» — даём время на каждую
+        waves = ceil(len(futures) / SSH_POOL_SIZE)
+        futures_wait(list(futures.values()), timeout=timeout * waves)
+
+    items: List[Dict[str, Any]] = []
+    for idx, h in enumerate(hosts):
+        fut = futures.get(idx)
+        if fut is None:
             # Хост без SSH - показываем базовую информацию
-            m = {
-                'ok': False,
-                'host_name': h.get('host_name'),
-                'host_url': h.get('host_url'),
-                'error': 'SSH не настроен',
-                'cpu_percent': None,
-                'mem_percent': None,
-                'disk_percent': None,
-                'uptime_seconds': None
-            }
-        items.append(m)
+            items.append(_host_without_ssh_item(h))
+        elif fut.done():
+            items.append(fut.result())
+        else:
+            items.append({'ok': False, 'host_name': h.get('host_name'), 'error': f'Таймаут сбора метрик ({int(timeout)} с)'})
 
     return {'ok': True, 'items': items}
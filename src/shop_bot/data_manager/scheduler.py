@@ -1,7 +1,9 @@
 import asyncio
 import logging
 import json
+import time
 
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
 from aiogram.utils.keyboard import InlineKeyboardBuilder
@@ -12,9 +14,14 @@ from shop_bot.data_manager import database
 from shop_bot.data_manager import speedtest_runner
 from shop_bot.data_manager import backup_manager
 from shop_bot.data_manager import resource_monitor
+from shop_bot.data_manager import leader_lease
+from shop_bot.data_manager import metrics_registry
 
 from shop_bot.modules import xui_api
 from shop_bot.bot import keyboards
+from shop_bot.bot import message_dispatcher
+from shop_bot.bot import broadcast_engine
+from shop_bot.bot.sqlite_storage import FSM_STATE_TTL_SECONDS
 
 CHECK_INTERVAL_SECONDS = 300
 NOTIFY_BEFORE_HOURS = {72, 48, 24, 1}
@@ -27,10 +34,24 @@ SPEEDTEST_INTERVAL_SECONDS = 8 * 3600
 _last_speedtests_run_at: datetime | None = None
 _last_backup_run_at: datetime | None = None
 
+# Сверка ежедневных сводок (daily_rollups) с исходными таблицами — раз в сутки, после смены даты
+_last_rollup_reconcile_day = None
+
 # Сбор метрик ресурсов (каждые 5 минут)
 METRICS_INTERVAL_SECONDS = 5 * 60
 _last_metrics_run_at: datetime | None = None
 
+# Метрики для /metrics: длительности фаз и последние собранные значения ресурсов
+_PHASE_SECONDS = metrics_registry.histogram(
+    "shopbot_scheduler_phase_duration_seconds", "Длительность фаз планировщика", ("phase",),
+    buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0),
+)
+_PHASE_ERRORS = metrics_registry.counter("shopbot_scheduler_phase_errors_total", "Ошибки в фазах планировщика", ("phase",))
+_RESOURCE_GAUGES = {
+    field: metrics_registry.gauge(f"shopbot_resource_{field}", f"Ресурсы ({field}) по последнему сбору", ("scope", "object"))
+    for field in ("cpu_percent", "mem_percent", "disk_percent", "load1")
+}
+
 def format_time_left(hours: int) -> str:
     if hours >= 24:
         days = hours // 24
@@ -48,6 +69,33 @@ def format_time_left(hours: int) -> str:
         else:
             return f"{hours} часов"
 
+@contextmanager
+def _track_phase(phase: str, interval_seconds: int | float | None, object_name: str | None = None):
+    """Замер фазы планировщика: пишет длительность, объём, ошибки и перерасход интервала в scheduler_runs."""
+    run = {'items': 0, 'errors': 0, 'error': None}
+    started_at = datetime.now()
+    started = time.monotonic()
+    try:
+        yield run
+    except Exception as e:
+        run['errors'] += 1
+        run['error'] = str(e)
+        raise
+    finally:
+        duration_ms = int((time.monotonic() - started) * 1000)
+        _PHASE_SECONDS.observe(duration_ms / 1000.0, phase=phase)
+        if run['errors']:
+            _PHASE_ERRORS.inc(run['errors'], phase=phase)
+        try:
+            database.insert_scheduler_run(
+                phase, object_name, started_at, duration_ms,
+                items=run['items'], errors=run['errors'],
+                interval_sec=int(interval_seconds) if interval_seconds else None,
+                error=run['error'],
+            )
+        except Exception as e:
+            logger.debug(f"Scheduler: не удалось записать телеметрию фазы {phase}: {e}")
+
 async def send_subscription_notification(bot: Bot, user_id: int, key_id: int, time_left_hours: int, expiry_date: datetime):
     try:
         time_text = format_time_left(time_left_hours)
@@ -65,11 +113,17 @@ async def send_subscription_notification(bot: Bot, user_id: int, key_id: int, ti
         builder.button(text="➕ Продлить ключ", callback_data=f"extend_key_{key_id}")
         builder.adjust(2)
         
-        await bot.send_message(chat_id=user_id, text=message, reply_markup=builder.as_markup(), parse_mode='Markdown')
+        await message_dispatcher.send_message(
+            bot, user_id, message,
+            priority=message_dispatcher.PRIORITY_NOTIFY,
+            reply_markup=builder.as_markup(), parse_mode='Markdown'
+        )
         logger.debug(f"Scheduler: Отправлено уведомление пользователю {user_id} по ключу {key_id} (осталось {time_left_hours} ч).")
+        return True
         
     except Exception as e:
         logger.error(f"Scheduler: Ошибка отправки уведомления пользователю {user_id}: {e}")
+        return False
 
 def _cleanup_notified_users(all_db_keys: list[dict]):
     if not notified_users:
@@ -100,34 +154,39 @@ def _cleanup_notified_users(all_db_keys: list[dict]):
 
 async def check_expiring_subscriptions(bot: Bot):
     logger.debug("Scheduler: Проверяю истекающие подписки...")
-    current_time = datetime.now()
-    all_keys = database.get_all_keys()
-    
-    _cleanup_notified_users(all_keys)
-    
-    for key in all_keys:
-        try:
-            expiry_date = datetime.fromisoformat(key['expiry_date'])
-            time_left = expiry_date - current_time
-
-            if time_left.total_seconds() < 0:
-                continue
-
-            total_hours_left = int(time_left.total_seconds() / 3600)
-            user_id = key['user_id']
-            key_id = key['key_id']
-
-            for hours_mark in NOTIFY_BEFORE_HOURS:
-                if hours_mark - 1 < total_hours_left <= hours_mark:
-                    notified_users.setdefault(user_id, {}).setdefault(key_id, set())
-                    
-                    if hours_mark not in notified_users[user_id][key_id]:
-                        await send_subscription_notification(bot, user_id, key_id, hours_mark, expiry_date)
-                        notified_users[user_id][key_id].add(hours_mark)
-                    break 
-                    
-        except Exception as e:
-            logger.error(f"Scheduler: Ошибка обработки истечения для ключа {key.get('key_id')}: {e}")
+    with _track_phase('notifications', CHECK_INTERVAL_SECONDS) as run:
+        current_time = datetime.now()
+        all_keys = database.get_all_keys()
+        
+        _cleanup_notified_users(all_keys)
+        
+        for key in all_keys:
+            try:
+                expiry_date = datetime.fromisoformat(key['expiry_date'])
+                time_left = expiry_date - current_time
+
+                if time_left.total_seconds() < 0:
+                    continue
+
+                total_hours_left = int(time_left.total_seconds() / 3600)
+                user_id = key['user_id']
+                key_id = key['key_id']
+
+                for hours_mark in NOTIFY_BEFORE_HOURS:
+                    if hours_mark - 1 < total_hours_left <= hours_mark:
+                        notified_users.setdefault(user_id, {}).setdefault(key_id, set())
+                        
+                        if hours_mark not in notified_users[user_id][key_id]:
+                            if await send_subscription_notification(bot, user_id, key_id, hours_mark, expiry_date):
+                                run['items'] += 1
+                            else:
+                                run['errors'] += 1
+                            notified_users[user_id][key_id].add(hours_mark)
+                        break 
+                        
+            except Exception as e:
+                run['errors'] += 1
+                logger.error(f"Scheduler: Ошибка обработки истечения для ключа {key.get('key_id')}: {e}")
 
 async def sync_keys_with_panels():
     logger.debug("Scheduler: Запускаю синхронизацию с XUI-панелями...")
@@ -142,154 +201,208 @@ async def sync_keys_with_panels():
         host_name = host['host_name']
         logger.debug(f"Scheduler: Обрабатываю хост: '{host_name}'")
         
-        try:
-            api, inbound = xui_api.login_to_host(
-                host_url=host['host_url'],
-                username=host['host_username'],
-                password=host['host_pass'],
-                inbound_id=host['host_inbound_id']
-            )
-
-            if not api or not inbound:
-                logger.error(f"Scheduler: Не удалось авторизоваться на хосте '{host_name}'. Пропускаю его.")
-                continue
+        with _track_phase('sync', CHECK_INTERVAL_SECONDS, host_name) as run:
+            try:
+                affected = await _sync_host_with_panel(host)
+                if affected is None:
+                    run['errors'] += 1
+                    run['error'] = 'login failed'
+                else:
+                    run['items'] = affected
+                    total_affected_records += affected
+            except Exception as e:
+                run['errors'] += 1
+                run['error'] = str(e)
+                logger.error(f"Scheduler: Непредвиденная ошибка при обработке хоста '{host_name}': {e}", exc_info=True)
             
-            full_inbound_details = api.inbound.get_by_id(inbound.id)
-            clients_on_server = {client.email: client for client in (full_inbound_details.settings.clients or [])}
-            logger.debug(f"Scheduler: Найдено клиентов на панели '{host_name}': {len(clients_on_server)}")
+    logger.debug(f"Scheduler: Синхронизация с XUI-панелями завершена. Затронуто записей: {total_affected_records}.")
 
-            keys_in_db = database.get_keys_for_host(host_name)
-            
-            for db_key in keys_in_db:
-                key_email = db_key['key_email']
-                expiry_date = datetime.fromisoformat(db_key['expiry_date'])
-                now = datetime.now()
-                if expiry_date < now - timedelta(days=5):
-                    logger.debug(f"Scheduler: Ключ '{key_email}' просрочен более 5 дней. Удаляю с панели и из БД.")
-                    try:
-                        await xui_api.delete_client_on_host(host_name, key_email)
-                    except Exception as e:
-                        logger.error(f"Scheduler: Не удалось удалить клиента '{key_email}' с панели: {e}")
-                    deleted = database.delete_key_by_email(key_email)
-                    if deleted:
-                        total_affected_records += 1
-                        logger.debug(f"Scheduler: Ключ '{key_email}' удалён из локальной БД после очистки панели.")
-                    else:
-                        logger.warning(f"Scheduler: Попытка удалить ключ '{key_email}' из локальной БД — записей не затронуто.")
+async def _sync_host_with_panel(host: dict) -> int | None:
+    """Синхронизация ключей одного хоста с панелью. Возвращает число затронутых записей или None, если вход не удался."""
+    host_name = host['host_name']
+    affected = 0
+    api, inbound = xui_api.login_to_host(
+        host_url=host['host_url'],
+        username=host['host_username'],
+        password=host['host_pass'],
+        inbound_id=host['host_inbound_id'],
+        host_name=host_name,
+    )
+
+    if not api or not inbound:
+        logger.error(f"Scheduler: Не удалось авторизоваться на хосте '{host_name}'. Пропускаю его.")
+        return None
+
+    full_inbound_details = api.inbound.get_by_id(inbound.id)
+    clients_on_server = {client.email: client for client in (full_inbound_details.settings.clients or [])}
+    logger.debug(f"Scheduler: Найдено клиентов на панели '{host_name}': {len(clients_on_server)}")
+
+    keys_in_db = database.get_keys_for_host(host_name)
+
+    for db_key in keys_in_db:
+        key_email = db_key['key_email']
+        expiry_date = datetime.fromisoformat(db_key['expiry_date'])
+        now = datetime.now()
+        if expiry_date < now - timedelta(days=5):
+            logger.debug(f"Scheduler: Ключ '{key_email}' просрочен более 5 дней. Удаляю с панели и из БД.")
+            try:
+                await xui_api.delete_client_on_host(host_name, key_email)
+            except Exception as e:
+                logger.error(f"Scheduler: Не удалось удалить клиента '{key_email}' с панели: {e}")
+            deleted = database.delete_key_by_email(key_email)
+            if deleted:
+                affected += 1
+                logger.debug(f"Scheduler: Ключ '{key_email}' удалён из локальной БД после очистки панели.")
+            else:
+                logger.warning(f"Scheduler: Попытка удалить ключ '{key_email}' из локальной БД — записей не затронуто.")
+            continue
+
+        server_client = clients_on_server.pop(key_email, None)
+
+        if server_client:
+            reset_days = server_client.reset if server_client.reset is not None else 0
+            server_expiry_ms = server_client.expiry_time + reset_days * 24 * 3600 * 1000
+            local_expiry_dt = expiry_date
+            local_expiry_ms = int(local_expiry_dt.timestamp() * 1000)
+
+            if abs(server_expiry_ms - local_expiry_ms) > 1000:
+                database.update_key_status_from_server(key_email, server_client)
+                affected += 1
+                logger.debug(f"Scheduler: Синхронизирован ключ '{key_email}' для хоста '{host_name}' (обновлён).")
+        else:
+            logger.warning(f"Scheduler: Ключ '{key_email}' для хоста '{host_name}' не найден на сервере. Помечаю к удалению в локальной БД.")
+            database.update_key_status_from_server(key_email, None)
+            affected += 1
+
+    if clients_on_server:
+        # Try to attach orphan clients from panel to local DB so old keys get subscriptions
+        for orphan_email, orphan_client in clients_on_server.items():
+            try:
+                # Extract user_id from email like: user12345-key1-...@telegram.bot
+                import re
+                m = re.search(r"user(\d+)", orphan_email)
+                user_id = int(m.group(1)) if m else None
+                if not user_id:
+                    logger.warning(
+                        f"Scheduler: Найден осиротевший клиент '{orphan_email}' на '{host_name}', но не удалось определить user_id — пропускаю."
+                    )
                     continue
 
-                server_client = clients_on_server.pop(key_email, None)
+                # Check that user exists
+                usr = database.get_user(user_id)
+                if not usr:
+                    logger.warning(
+                        f"Scheduler: Осиротевший клиент '{orphan_email}' указывает на user_id={user_id}, но пользователь не найден — пропускаю."
+                    )
+                    continue
+
+                # If key already present (race/duplicate), skip insert
+                existing = database.get_key_by_email(orphan_email)
+                if existing:
+                    continue
+
+                reset_days = getattr(orphan_client, 'reset', 0) or 0
+                expiry_ms = int(getattr(orphan_client, 'expiry_time', 0)) + int(reset_days) * 24 * 3600 * 1000
+                client_uuid = getattr(orphan_client, 'id', None) or getattr(orphan_client, 'email', None) or ''
 
-                if server_client:
-                    reset_days = server_client.reset if server_client.reset is not None else 0
-                    server_expiry_ms = server_client.expiry_time + reset_days * 24 * 3600 * 1000
-                    local_expiry_dt = expiry_date
-                    local_expiry_ms = int(local_expiry_dt.timestamp() * 1000)
+                if not client_uuid:
+                    logger.warning(
+                        f"Scheduler: У осиротевшего клиента '{orphan_email}' нет UUID/id — не могу привязать."
+                    )
+                    continue
 
-                    if abs(server_expiry_ms - local_expiry_ms) > 1000:
-                        database.update_key_status_from_server(key_email, server_client)
-                        total_affected_records += 1
-                        logger.debug(f"Scheduler: Синхронизирован ключ '{key_email}' для хоста '{host_name}' (обновлён).")
+                new_id = database.add_new_key(
+                    user_id=user_id,
+                    host_name=host_name,
+                    xui_client_uuid=str(client_uuid),
+                    key_email=orphan_email,
+                    expiry_timestamp_ms=expiry_ms,
+                )
+                if new_id:
+                    logger.info(
+                        f"Scheduler: Осиротевший клиент '{orphan_email}' на '{host_name}' привязан к пользователю {user_id} как key_id={new_id}."
+                    )
+                    affected += 1
                 else:
-                    logger.warning(f"Scheduler: Ключ '{key_email}' для хоста '{host_name}' не найден на сервере. Помечаю к удалению в локальной БД.")
-                    database.update_key_status_from_server(key_email, None)
-                    total_affected_records += 1
-
-            if clients_on_server:
-                # Try to attach orphan clients from panel to local DB so old keys get subscriptions
-                for orphan_email, orphan_client in clients_on_server.items():
-                    try:
-                        # Extract user_id from email like: user12345-key1-...@telegram.bot
-                        import re
-                        m = re.search(r"user(\d+)", orphan_email)
-                        user_id = int(m.group(1)) if m else None
-                        if not user_id:
-                            logger.warning(
-                                f"Scheduler: Найден осиротевший клиент '{orphan_email}' на '{host_name}', но не удалось определить user_id — пропускаю."
-                            )
-                            continue
-
-                        # Check that user exists
-                        usr = database.get_user(user_id)
-                        if not usr:
-                            logger.warning(
-                                f"Scheduler: Осиротевший клиент '{orphan_email}' указывает на user_id={user_id}, но пользователь не найден — пропускаю."
-                            )
-                            continue
-
-                        # If key already present (race/duplicate), skip insert
-                        existing = database.get_key_by_email(orphan_email)
-                        if existing:
-                            continue
-
-                        reset_days = getattr(orphan_client, 'reset', 0) or 0
-                        expiry_ms = int(getattr(orphan_client, 'expiry_time', 0)) + int(reset_days) * 24 * 3600 * 1000
-                        client_uuid = getattr(orphan_client, 'id', None) or getattr(orphan_client, 'email', None) or ''
-
-                        if not client_uuid:
-                            logger.warning(
-                                f"Scheduler: У осиротевшего клиента '{orphan_email}' нет UUID/id — не могу привязать."
-                            )
-                            continue
-
-                        new_id = database.add_new_key(
-                            user_id=user_id,
-                            host_name=host_name,
-                            xui_client_uuid=str(client_uuid),
-                            key_email=orphan_email,
-                            expiry_timestamp_ms=expiry_ms,
-                        )
-                        if new_id:
-                            logger.info(
-                                f"Scheduler: Осиротевший клиент '{orphan_email}' на '{host_name}' привязан к пользователю {user_id} как key_id={new_id}."
-                            )
-                            total_affected_records += 1
-                        else:
-                            logger.warning(
-                                f"Scheduler: Не удалось привязать осиротевшего клиента '{orphan_email}' на '{host_name}'."
-                            )
-                    except Exception as e:
-                        logger.error(
-                            f"Scheduler: Ошибка при попытке привязать осиротевшего клиента '{orphan_email}' на '{host_name}': {e}",
-                            exc_info=True,
-                        )
+                    logger.warning(
+                        f"Scheduler: Не удалось привязать осиротевшего клиента '{orphan_email}' на '{host_name}'."
+                    )
+            except Exception as e:
+                logger.error(
+                    f"Scheduler: Ошибка при попытке привязать осиротевшего клиента '{orphan_email}' на '{host_name}': {e}",
+                    exc_info=True,
+                )
 
-        except Exception as e:
-            logger.error(f"Scheduler: Непредвиденная ошибка при обработке хоста '{host_name}': {e}", exc_info=True)
-            
-    logger.debug(f"Scheduler: Синхронизация с XUI-панелями завершена. Затронуто записей: {total_affected_records}.")
+    return affected
 
 async def periodic_subscription_check(bot_controller: BotController):
     logger.info("Scheduler: Планировщик фоновых задач запущен.")
+    heartbeat_task = asyncio.create_task(leader_lease.run_heartbeat())
     await asyncio.sleep(10)
 
-    while True:
-        try:
-            await sync_keys_with_panels()
-
-            # Периодические измерения скорости по всем хостам (оба варианта: SSH и сетевой)
-            await _maybe_run_periodic_speedtests()
-            await _maybe_collect_host_metrics()
+    try:
+        while True:
+            with _track_phase('cycle', CHECK_INTERVAL_SECONDS):
+                await _run_scheduler_cycle(bot_controller)
+            logger.info(f"Scheduler: Цикл завершён. Следующая проверка через {CHECK_INTERVAL_SECONDS} сек.")
+            await asyncio.sleep(CHECK_INTERVAL_SECONDS)
+    finally:
+        heartbeat_task.cancel()
+
+async def _run_scheduler_cycle(bot_controller: BotController):
+    # Одиночные задачи выполняет только лидер (при нескольких инстансах на общей БД)
+    try:
+        leader = await asyncio.to_thread(leader_lease.ensure_leader)
+    except Exception as e:
+        logger.error(f"Scheduler: Не удалось проверить лидерство: {e}")
+        leader = False
+    if not leader:
+        logger.info("Scheduler: Инстанс не является лидером, фоновые задачи пропущены.")
+        return
 
-            # Ежедневный автобэкап БД с отправкой админам
-            bot = bot_controller.get_bot_instance() if bot_controller.get_status().get("is_running") else None
+    try:
+        # Телеметрия хранится 14 дней
+        database.prune_scheduler_runs(keep_days=14)
+        # Брошенные диалоги (FSM) старше суток
+        removed = database.fsm_cleanup(FSM_STATE_TTL_SECONDS)
+        if removed:
+            logger.info(f"Scheduler: Удалено устаревших состояний FSM: {removed}")
+        # Обработанные уведомления об оплате храним 30 дней
+        database.prune_payment_inbox(keep_days=30)
+        await _maybe_reconcile_daily_rollups()
+
+        await sync_keys_with_panels()
+
+        # Периодические измерения скорости по всем хостам (оба варианта: SSH и сетевой)
+        await _maybe_run_periodic_speedtests()
+        await _maybe_collect_host_metrics()
+
+        # Лидерство могло истечь за время долгих задач — не рискуем двойной отправкой
+        if not leader_lease.is_leader():
+            logger.warning("Scheduler: Лидерство потеряно во время цикла, бэкап и уведомления пропущены.")
+            return
+
+        # Ежедневный автобэкап БД с отправкой админам
+        bot = bot_controller.get_bot_instance() if bot_controller.get_status().get("is_running") else None
+        if bot:
+            await _maybe_run_daily_backup(bot)
+
+        if bot_controller.get_status().get("is_running"):
+            bot = bot_controller.get_bot_instance()
             if bot:
-                await _maybe_run_daily_backup(bot)
-
-            if bot_controller.get_status().get("is_running"):
-                bot = bot_controller.get_bot_instance()
-                if bot:
-                    await check_expiring_subscriptions(bot)
-                else:
-                    logger.warning("Scheduler: Бот помечен как запущенный, но экземпляр недоступен.")
+                await check_expiring_subscriptions(bot)
+                # Рассылки, прерванные перезапуском бота, продолжаются с места остановки
+                try:
+                    broadcast_engine.resume_interrupted_campaigns(bot)
+                except Exception as e:
+                    logger.error(f"Scheduler: Не удалось возобновить рассылки: {e}")
             else:
-                logger.debug("Scheduler: Бот остановлен, уведомления пользователям пропущены.")
+                logger.warning("Scheduler: Бот помечен как запущенный, но экземпляр недоступен.")
+        else:
+            logger.debug("Scheduler: Бот остановлен, уведомления пользователям пропущены.")
 
-        except Exception as e:
-            logger.error(f"Scheduler: Необработанная ошибка в основном цикле: {e}", exc_info=True)
-            
-        logger.info(f"Scheduler: Цикл завершён. Следующая проверка через {CHECK_INTERVAL_SECONDS} сек.")
-        await asyncio.sleep(CHECK_INTERVAL_SECONDS)
+    except Exception as e:
+        logger.error(f"Scheduler: Необработанная ошибка в основном цикле: {e}", exc_info=True)
 
 async def _maybe_run_periodic_speedtests():
     global _last_speedtests_run_at
@@ -307,30 +420,29 @@ async def _run_speedtests_for_all_hosts():
     if not hosts:
         logger.debug("Scheduler: Нет хостов для измерений скорости.")
         return
-    logger.info(f"Scheduler: Запускаю speedtest для {len(hosts)} хост(ов)...")
-    for h in hosts:
-        host_name = h.get('host_name')
-        if not host_name:
-            continue
-        try:
-            logger.info(f"Scheduler: Speedtest для '{host_name}' запущен...")
-            # Ограничим каждый хост таймаутом, чтобы не зависнуть надолго
-            try:
-                async with asyncio.timeout(180):
-                    res = await speedtest_runner.run_both_for_host(host_name)
-            except AttributeError:
-                # Для Python <3.11: fallback через wait_for
-                res = await asyncio.wait_for(speedtest_runner.run_both_for_host(host_name), timeout=180)
-            ok = res.get('ok')
-            err = res.get('error')
-            if ok:
-                logger.info(f"Scheduler: Speedtest для '{host_name}' завершён успешно")
-            else:
-                logger.warning(f"Scheduler: Speedtest для '{host_name}' завершён с ошибками: {err}")
-        except asyncio.TimeoutError:
-            logger.warning(f"Scheduler: Таймаут speedtest для хоста '{host_name}'")
-        except Exception as e:
-            logger.error(f"Scheduler: Ошибка выполнения speedtest для '{host_name}': {e}", exc_info=True)
+    concurrency = speedtest_runner.get_speedtest_concurrency()
+    logger.info(f"Scheduler: Запускаю speedtest для {len(hosts)} хост(ов), параллельно до {concurrency}...")
+
+    async def _on_result(host_name: str, res: dict):
+        if res.get('ok'):
+            logger.info(f"Scheduler: Speedtest для '{host_name}' завершён успешно")
+        else:
+            logger.warning(f"Scheduler: Speedtest для '{host_name}' завершён с ошибками: {res.get('error')}")
+
+    with _track_phase('speedtests', SPEEDTEST_INTERVAL_SECONDS) as run:
+        summary = await speedtest_runner.run_speedtests_for_hosts(
+            [h.get('host_name') for h in hosts],
+            concurrency=concurrency,
+            timeout=180,
+            on_result=_on_result,
+        )
+        run['items'] = summary.get('ok_count', 0)
+        run['errors'] = summary.get('host_count', 0) - summary.get('ok_count', 0)
+    logger.info(
+        f"Scheduler: Speedtest завершён для {summary.get('ok_count')}/{summary.get('host_count')} хост(ов) "
+        f"за {summary.get('elapsed_sec')} сек."
+    )
+    return summary
 
 async def _maybe_run_daily_backup(bot: Bot):
     global _last_backup_run_at
@@ -353,29 +465,74 @@ async def _maybe_run_daily_backup(bot: Bot):
 
     if _last_backup_run_at and (now - _last_backup_run_at).total_seconds() < interval_seconds:
         return
-    try:
-        # Пытаемся обновить время запуска сразу, чтобы не заспамить, если бэкап упадет
-        _last_backup_run_at = now
-        
-        zip_path = backup_manager.create_backup_file()
-        if zip_path and zip_path.exists():
-            try:
-                sent = await backup_manager.send_backup_to_admins(bot, zip_path)
-                logger.info(f"Scheduler: Создан бэкап {zip_path.name}, отправлен {sent} адм.")
-            except Exception as e:
-                logger.error(f"Scheduler: Не удалось отправить бэкап: {e}")
-            try:
-                backup_manager.cleanup_old_backups(keep=7)
-            except Exception:
-                pass
-    except Exception as e:
-        logger.error(f"Scheduler: Критическая ошибка при создании и отправке бэкапа: {e}", exc_info=True)
+    with _track_phase('backup', interval_seconds) as run:
+        try:
+            # Пытаемся обновить время запуска сразу, чтобы не заспамить, если бэкап упадет
+            _last_backup_run_at = now
+            
+            zip_path = backup_manager.create_backup_file()
+            if zip_path and zip_path.exists():
+                try:
+                    sent = await backup_manager.send_backup_to_admins(bot, zip_path)
+                    run['items'] = sent
+                    logger.info(f"Scheduler: Создан бэкап {zip_path.name}, отправлен {sent} адм.")
+                except Exception as e:
+                    run['errors'] += 1
+                    run['error'] = str(e)
+                    logger.error(f"Scheduler: Не удалось отправить бэкап: {e}")
+                try:
+                    backup_manager.cleanup_old_backups(keep=7)
+                except Exception:
+                    pass
+            else:
+                run['errors'] += 1
+                run['error'] = 'backup file was not created'
+        except Exception as e:
+            run['errors'] += 1
+            run['error'] = str(e)
+            logger.error(f"Scheduler: Критическая ошибка при создании и отправке бэкапа: {e}", exc_info=True)
+
+
+async def _maybe_reconcile_daily_rollups():
+    global _last_rollup_reconcile_day
+    today = datetime.now().date()
+    if _last_rollup_reconcile_day == today:
+        return
+    with _track_phase('rollups', 24 * 3600) as run:
+        ok = await asyncio.to_thread(database.reconcile_daily_rollups)
+        run['items'] = database.ROLLUP_RECONCILE_DAYS if ok else 0
+        run['errors'] = 0 if ok else 1
+    if ok:
+        _last_rollup_reconcile_day = today
+
+
 async def _maybe_collect_host_metrics():
     global _last_metrics_run_at
     now = datetime.now()
     if _last_metrics_run_at and (now - _last_metrics_run_at).total_seconds() < METRICS_INTERVAL_SECONDS:
         return
-    
+    with _track_phase('metrics', METRICS_INTERVAL_SECONDS) as run:
+        collected, failed = await _collect_metrics_once()
+        run['items'] = collected
+        run['errors'] = failed
+    _last_metrics_run_at = now
+
+def _export_resource_gauges(scope: str, object_name: str, m: dict) -> None:
+    load = m.get('loadavg') or {}
+    values = {
+        'cpu_percent': m.get('cpu_percent'),
+        'mem_percent': m.get('mem_percent'),
+        'disk_percent': m.get('disk_percent'),
+        'load1': load.get('1m') if isinstance(load, dict) else None,
+    }
+    for field, value in values.items():
+        _RESOURCE_GAUGES[field].set(value, scope=scope, object=object_name)
+
+async def _collect_metrics_once() -> tuple[int, int]:
+    """Собирает локальные метрики и метрики хостов. Возвращает (успешно, с ошибкой)."""
+    collected = 0
+    failed = 0
+
     # Собираем локальные метрики
     try:
         local_metrics = await asyncio.wait_for(asyncio.to_thread(resource_monitor.get_local_metrics), timeout=10)
@@ -390,25 +547,39 @@ async def _maybe_collect_host_metrics():
                 net_bytes_recv=local_metrics.get('network_recv'),
                 raw_json=json.dumps(local_metrics, ensure_ascii=False)
             )
+            _export_resource_gauges('local', 'panel', local_metrics)
+            collected += 1
+        else:
+            failed += 1
     except Exception as e:
+        failed += 1
         logger.error(f"Scheduler: Ошибка сбора локальных метрик: {e}")
     
     # Собираем метрики хостов
     hosts = database.get_all_hosts()
     if not hosts:
-        _last_metrics_run_at = now
-        return
-    for h in hosts:
-        host_name = h.get('host_name')
-        if not host_name:
-            continue
-        if not (h.get('ssh_host') and h.get('ssh_user')):
-            continue
-        try:
+        return collected, failed
+    ssh_hosts = [h for h in hosts if h.get('host_name') and h.get('ssh_host') and h.get('ssh_user')]
+    if ssh_hosts:
+        loop = asyncio.get_running_loop()
+        pool = resource_monitor.get_ssh_pool()
+        # Таймаут отсчитывается с момента, когда хост получил слот в пуле
+        slots = asyncio.Semaphore(resource_monitor.SSH_POOL_SIZE)
+
+        async def _collect(h: dict):
+            host_name = h.get('host_name')
             try:
-                m = await asyncio.wait_for(asyncio.to_thread(resource_monitor.get_host_metrics_via_ssh, h), timeout=30)
-            except AttributeError:
-                m = await asyncio.wait_for(asyncio.to_thread(resource_monitor.get_host_metrics_via_ssh, h), timeout=30)
+                async with slots:
+                    m = await asyncio.wait_for(
+                        loop.run_in_executor(pool, resource_monitor.get_host_metrics_via_ssh, h),
+                        timeout=resource_monitor.HOST_METRICS_TIMEOUT_SECONDS,
+                    )
+            except asyncio.TimeoutError:
+                logger.warning(f"Scheduler: Таймаут сбора метрик для хоста '{host_name}'")
+                return False
+            except Exception as e:
+                logger.error(f"Scheduler: Ошибка сбора метрик для '{host_name}': {e}")
+                return False
             try:
                 database.insert_host_metrics(host_name, m)
                 # Также сохраняем в resource_metrics для графиков
@@ -421,10 +592,12 @@ async def _maybe_collect_host_metrics():
                         load1=m.get('loadavg', {}).get('1m') if m.get('loadavg') else None,
                         raw_json=json.dumps(m, ensure_ascii=False)
                     )
+                    _export_resource_gauges('host', host_name, m)
             except Exception as e:
                 logger.warning(f"Scheduler: insert_host_metrics failed for {host_name}: {e}")
-        except asyncio.TimeoutError:
-            logger.warning(f"Scheduler: Таймаут сбора метрик для хоста '{host_name}'")
-        except Exception as e:
-            logger.error(f"Scheduler: Ошибка сбора метрик для '{host_name}': {e}")
-    _last_metrics_run_at = now
+            return bool(m and m.get('ok'))
+
+        results = await asyncio.gather(*(_collect(h) for h in ssh_hosts))
+        collected += sum(1 for r in results if r)
+        failed += sum(1 for r in results if not r)
+    return collected, failed
@@ -1,7 +1,10 @@
 import asyncio
+import html
 import json
 import logging
 import re
+import time
+from typing import Awaitable, Callable
 from urllib.parse import urlparse
 
 import aiohttp
@@ -11,6 +14,10 @@ from shop_bot.data_manager import database
 
 logger = logging.getLogger(__name__)
 
+# Сколько хостов тестировать одновременно по умолчанию и максимум
+DEFAULT_SPEEDTEST_CONCURRENCY = 4
+MAX_SPEEDTEST_CONCURRENCY = 16
+
 
 def _parse_host_port_from_url(url: str) -> tuple[str | None, int | None, bool]:
     try:
@@ -467,25 +474,84 @@ async def auto_install_speedtest_on_host(host_name: str) -> dict:
     return await loop.run_in_executor(None, _install)
 
 
+def get_speedtest_concurrency() -> int:
+    """Сколько хостов тестировать одновременно (настройка speedtest_concurrency)."""
+    try:
+        value = int(str(database.get_setting("speedtest_concurrency") or DEFAULT_SPEEDTEST_CONCURRENCY).strip())
+    except Exception:
+        value = DEFAULT_SPEEDTEST_CONCURRENCY
+    return max(1, min(value, MAX_SPEEDTEST_CONCURRENCY))
+
+
+async def run_speedtests_for_hosts(
+    host_names: list[str],
+    concurrency: int | None = None,
+    timeout: float = 180,
+    on_result: Callable[[str, dict], Awaitable[None]] | None = None,
+) -> dict:
+    """
+    Запускает run_both_for_host параллельно для списка хостов, не более concurrency одновременно.
+    Каждый результат пишется в БД сразу по готовности (внутри run_both_for_host);
+    on_result, если задан, вызывается по мере завершения хостов.
+    """
+    names = [n for n in dict.fromkeys(host_names or []) if n]
+    limit = max(1, int(concurrency or get_speedtest_concurrency()))
+    semaphore = asyncio.Semaphore(limit)
+    results: dict[str, dict] = {}
+    started = time.monotonic()
+
+    async def _one(host_name: str) -> None:
+        async with semaphore:
+            try:
+                res = await asyncio.wait_for(run_both_for_host(host_name), timeout=timeout)
+            except asyncio.TimeoutError:
+                res = {'ok': False, 'details': {}, 'error': f'timeout {int(timeout)}s'}
+            except Exception as e:
+                res = {'ok': False, 'details': {}, 'error': str(e)}
+        results[host_name] = res
+        if on_result:
+            try:
+                await on_result(host_name, res)
+            except Exception as e:
+                logger.debug(f"Speedtest: on_result для '{host_name}' завершился ошибкой: {e}")
+
+    await asyncio.gather(*(_one(n) for n in names))
+    ok_count = sum(1 for r in results.values() if r.get('ok'))
+    return {
+        'ok': ok_count == len(names),
+        'results': {n: results[n] for n in names if n in results},
+        'host_count': len(names),
+        'ok_count': ok_count,
+        'concurrency': limit,
+        'elapsed_sec': round(time.monotonic() - started, 1),
+    }
+
+
+def format_speedtest_summary(summary: dict) -> str:
+    """Текстовая сводка по run_speedtests_for_hosts для администраторов."""
+    lines = []
+    for name, res in (summary.get('results') or {}).items():
+        if res.get('ok'):
+            det = res.get('details') or {}
+            ssh = det.get('ssh') or {}
+            net = det.get('net') or {}
+            dm = ssh.get('download_mbps') or net.get('download_mbps')
+            um = ssh.get('upload_mbps') or net.get('upload_mbps')
+            lines.append(f"• {html.escape(str(name))}: ✅ ↓ {dm or '—'} ↑ {um or '—'}")
+        else:
+            lines.append(f"• {html.escape(str(name))}: ❌ {html.escape(str(res.get('error') or 'ошибка'))}")
+    header = (
+        f"🏁 Тест для всех завершён: {summary.get('ok_count', 0)}/{summary.get('host_count', 0)} успешно "
+        f"за {summary.get('elapsed_sec', 0)} сек."
+    )
+    return header + ("\n" + "\n".join(lines) if lines else "")
+
+
 def run_speedtests_for_all_hosts() -> dict:
     """
-    Synchronous helper for Flask route: runs speedtests for all hosts sequentially.
-    Uses asyncio.run for each host to avoid requiring a pre-existing event loop in Flask.
+    Synchronous helper for Flask route: runs speedtests for all hosts concurrently
+    (up to speedtest_concurrency at once) inside a single asyncio.run.
     Returns summary dict with per-host results and aggregated status.
     """
     hosts = database.get_all_hosts() or []
-    summary: dict[str, dict] = {}
-    all_ok = True
-    for h in hosts:
-        host_name = h.get('host_name')
-        if not host_name:
-            continue
-        try:
-            res = asyncio.run(run_both_for_host(host_name))
-            summary[host_name] = res
-            if not res.get('ok'):
-                all_ok = False
-        except Exception as e:
-            summary[host_name] = {'ok': False, 'error': str(e)}
-            all_ok = False
-    return {'ok': all_ok, 'results': summary, 'host_count': len(hosts)}
+    return asyncio.run(run_speedtests_for_hosts([h.get('host_name') for h in hosts]))
@@ -7,14 +7,28 @@ from typing import List, Dict
 from py3xui import Api, Client, Inbound
 
 from shop_bot.data_manager.database import get_host, get_key_by_email, get_setting
+from shop_bot.data_manager import metrics_registry
 
 logger = logging.getLogger(__name__)
 
-def login_to_host(host_url: str, username: str, password: str, inbound_id: int) -> tuple[Api | None, Inbound | None]:
+_PANEL_SECONDS = metrics_registry.histogram(
+    "shopbot_panel_request_duration_seconds", "Длительность операций с API панелей 3x-ui", ("host", "op")
+)
+_PANEL_ERRORS = metrics_registry.counter("shopbot_panel_errors_total", "Ошибки операций с API панелей 3x-ui", ("host", "op"))
+
+
+def _panel_label(host_url: str, host_name: str | None) -> str:
+    return host_name or urlparse(host_url or "").netloc or "unknown"
+
+def login_to_host(host_url: str, username: str, password: str, inbound_id: int, host_name: str | None = None) -> tuple[Api | None, Inbound | None]:
+    # Вход в панель — первый шаг любой операции с 3x-ui, учитываем его в метриках обработчиков
+    metrics_registry.count_in_scope("panel")
+    label = _panel_label(host_url, host_name)
     try:
-        api = Api(host=host_url, username=username, password=password)
-        api.login()
-        inbounds: List[Inbound] = api.inbound.get_list()
+        with _PANEL_SECONDS.time(host=label, op="login"):
+            api = Api(host=host_url, username=username, password=password)
+            api.login()
+            inbounds: List[Inbound] = api.inbound.get_list()
         target_inbound = next((inbound for inbound in inbounds if inbound.id == inbound_id), None)
         
         if target_inbound is None:
@@ -22,6 +36,7 @@ def login_to_host(host_url: str, username: str, password: str, inbound_id: int)
             return None, None
         return api, target_inbound
     except Exception as e:
+        _PANEL_ERRORS.inc(host=label, op="login")
         logger.error(f"Не удалось выполнить вход или получить входящий трафик для хоста '{host_url}': {e}", exc_info=True)
         return None, None
 
@@ -194,18 +209,21 @@ async def create_or_update_key_on_host(host_name: str, email: str, days_to_add:
         host_url=host_data['host_url'],
         username=host_data['host_username'],
         password=host_data['host_pass'],
-        inbound_id=host_data['host_inbound_id']
+        inbound_id=host_data['host_inbound_id'],
+        host_name=host_name,
     )
     if not api or not inbound:
         logger.error(f"Сбой рабочего процесса: Не удалось войти или найти inbound на хосте '{host_name}'.")
         return None
         
     # Prefer exact expiry when provided (e.g., switching hosts), otherwise add days (purchase/extend/trial)
-    client_uuid, new_expiry_ms, client_sub_token = update_or_create_client_on_panel(
-        api, inbound.id, email, days_to_add=days_to_add, target_expiry_ms=expiry_timestamp_ms
-    )
+    with _PANEL_SECONDS.time(host=host_name, op="update_client"):
+        client_uuid, new_expiry_ms, client_sub_token = update_or_create_client_on_panel(
+            api, inbound.id, email, days_to_add=days_to_add, target_expiry_ms=expiry_timestamp_ms
+        )
 
     if not client_uuid:
+        _PANEL_ERRORS.inc(host=host_name, op="update_client")
         logger.error(f"Сбой рабочего процесса: Не удалось создать/обновить клиента '{email}' на хосте '{host_name}'.")
         return None
     
@@ -222,7 +240,8 @@ async def create_or_update_key_on_host(host_name: str, email: str, days_to_add:
         "host_name": host_name
     }
 
-async def get_key_details_from_host(key_data: dict) -> dict | None:
+def get_key_details_from_host(key_data: dict) -> dict | None:
+    """Синхронный вход в панель и сборка ссылки; из цикла событий вызывать через asyncio.to_thread."""
     host_name = key_data.get('host_name')
     if not host_name:
         logger.error(f"Не удалось получить данные ключа: отсутствует host_name для key_id {key_data.get('key_id')}")
@@ -237,7 +256,8 @@ async def get_key_details_from_host(key_data: dict) -> dict | None:
         host_url=host_db_data['host_url'],
         username=host_db_data['host_username'],
         password=host_db_data['host_pass'],
-        inbound_id=host_db_data['host_inbound_id']
+        inbound_id=host_db_data['host_inbound_id'],
+        host_name=host_name,
     )
     if not api or not inbound: return None
 
@@ -265,33 +285,43 @@ async def get_key_details_from_host(key_data: dict) -> dict | None:
     connection_string = get_subscription_link(key_data['xui_client_uuid'], host_db_data['host_url'], host_name, sub_token=client_sub_token)
     return {"connection_string": connection_string}
 
-async def delete_client_on_host(host_name: str, client_email: str) -> bool:
+def login_to_host_by_name(host_name: str) -> tuple[Api | None, Inbound | None]:
+    """Вход в панель хоста по его имени в БД (для серии операций одной сессией)."""
     host_data = get_host(host_name)
     if not host_data:
-        logger.error(f"Не удалось удалить клиента: хост '{host_name}' не найден.")
-        return False
-
-    api, inbound = login_to_host(
+        logger.error(f"Хост '{host_name}' не найден.")
+        return None, None
+    return login_to_host(
         host_url=host_data['host_url'],
         username=host_data['host_username'],
         password=host_data['host_pass'],
-        inbound_id=host_data['host_inbound_id']
+        inbound_id=host_data['host_inbound_id'],
+        host_name=host_name,
     )
 
-    if not api or not inbound:
-        logger.error(f"Не удалось удалить клиента: ошибка входа или поиска inbound для хоста '{host_name}'.")
-        return False
-        
+def delete_client_with_api(api: Api, inbound: Inbound, host_name: str, client_uuid: str | None, client_email: str) -> bool:
+    """Удаляет клиента в уже открытой сессии панели."""
     try:
-        client_to_delete = get_key_by_email(client_email)
-        if client_to_delete:
-            api.client.delete(inbound.id, client_to_delete['xui_client_uuid'])
+        if client_uuid:
+            with _PANEL_SECONDS.time(host=host_name, op="delete_client"):
+                api.client.delete(inbound.id, client_uuid)
             logger.info(f"Клиент '{client_email}' успешно удалён с хоста '{host_name}'.")
-            return True
         else:
             logger.warning(f"Клиент с email '{client_email}' не найден на хосте '{host_name}' для удаления (возможно, уже удалён).")
-            return True
-            
+        return True
     except Exception as e:
+        _PANEL_ERRORS.inc(host=host_name, op="delete_client")
         logger.error(f"Не удалось удалить клиента '{client_email}' с хоста '{host_name}': {e}", exc_info=True)
-        return False
\ No newline at end of file
+        return False
+
+async def delete_client_on_host(host_name: str, client_email: str) -> bool:
+    api, inbound = login_to_host_by_name(host_name)
+    if not api or not inbound:
+        logger.error(f"Не удалось удалить клиента: ошибка входа или поиска inbound для хоста '{host_name}'.")
+        return False
+    client_to_delete = get_key_by_email(client_email)
+    return delete_client_with_api(
+        api, inbound, host_name,
+        client_to_delete['xui_client_uuid'] if client_to_delete else None,
+        client_email,
+    )
\ No newline at end of file
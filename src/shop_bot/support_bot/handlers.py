@@ -6,6 +6,7 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.enums import ChatMemberStatus
 from aiogram.exceptions import TelegramBadRequest
 
+from shop_bot.bot import message_dispatcher
 from shop_bot.data_manager.database import (
     get_setting,
     create_support_ticket,
@@ -544,7 +545,7 @@ def get_support_router() -> Router:
                     raise
             try:
                 user_id = int(ticket.get('user_id'))
-                await bot.send_message(chat_id=user_id, text=f"✅ Ваш тикет #{ticket_id} был закрыт администратором. Спасибо за обращение!")
+                await message_dispatcher.send_message(bot, user_id, f"✅ Ваш тикет #{ticket_id} был закрыт администратором. Спасибо за обращение!")
             except Exception:
                 pass
         else:
@@ -583,7 +584,7 @@ def get_support_router() -> Router:
                     raise
             try:
                 user_id = int(ticket.get('user_id'))
-                await bot.send_message(chat_id=user_id, text=f"🔓 Ваш тикет #{ticket_id} был переоткрыт администратором. Вы можете продолжить переписку.")
+                await message_dispatcher.send_message(bot, user_id, f"🔓 Ваш тикет #{ticket_id} был переоткрыт администратором. Вы можете продолжить переписку.")
             except Exception:
                 pass
         else:
@@ -766,9 +767,10 @@ def get_support_router() -> Router:
         if currently_banned:
             status_text = f"✅ Пользователь {user_id} разбанен."
             try:
-                await bot.send_message(
-                    user_id,
-                    "✅ Ваш аккаунт разблокирован администратором. Вы снова можете пользоваться сервисом."
+                await message_dispatcher.send_message(
+                    bot, user_id,
+                    "✅ Ваш аккаунт разблокирован администратором. Вы снова можете пользоваться сервисом.",
+                    priority=message_dispatcher.PRIORITY_ALERT
                 )
             except Exception:
                 pass
@@ -779,7 +781,7 @@ def get_support_router() -> Router:
             if support_contact:
                 ban_message += f"\nЕсли это ошибка, свяжитесь с поддержкой: {support_contact}"
             try:
-                await bot.send_message(user_id, ban_message)
+                await message_dispatcher.send_message(bot, user_id, ban_message, priority=message_dispatcher.PRIORITY_ALERT)
             except Exception:
                 pass
         try:
@@ -9,22 +9,32 @@ from shop_bot.data_manager import database
 from shop_bot.data_manager.database import get_admin_ids
 from shop_bot.support_bot.handlers import get_support_router
 from shop_bot.bot.middlewares import BanMiddleware
+from shop_bot.bot.handler_metrics import HandlerMetricsMiddleware
+from shop_bot.bot.message_dispatcher import MessageDispatcher
+from shop_bot.bot import update_webhook
+from shop_bot.bot.sqlite_storage import SQLiteStorage
 
 logger = logging.getLogger(__name__)
 
 class SupportBotController:
     def __init__(self):
-        self._dp = Dispatcher()
+        # FSM в общей БД: состояния не теряются при рестарте и доступны нескольким воркерам
+        self._dp = Dispatcher(storage=SQLiteStorage())
         self._bot: Bot | None = None
         self._task = None
         self._is_running = False
         self._loop: asyncio.AbstractEventLoop | None = None
+        self._outbox: MessageDispatcher | None = None
+        # Событие остановки для режима вебхука (в режиме опроса не используется)
+        self._webhook_stop: asyncio.Event | None = None
         
         # Инициализация роутера один раз
         self._setup_dispatcher()
 
     def _setup_dispatcher(self):
         # Подключаем BanMiddleware
+        # Замер задержки по обработчикам (кнопки/команды) — снаружи, чтобы учесть весь путь апдейта
+        self._dp.update.outer_middleware(HandlerMetricsMiddleware("support"))
         self._dp.message.middleware(BanMiddleware())
         self._dp.callback_query.middleware(BanMiddleware())
         
@@ -41,8 +51,15 @@ class SupportBotController:
     async def _start_polling(self):
         self._is_running = True
         logger.info("Запущен опрос Telegram (Support-бот)...")
+        self._outbox = MessageDispatcher(self._bot, name="support")
+        self._outbox.start()
+        # Множество забаненных для BanMiddleware загружаем заранее, а не на первом апдейте
+        await asyncio.to_thread(database.load_banned_users)
         try:
-            await self._dp.start_polling(self._bot)
+            if await asyncio.to_thread(update_webhook.is_webhook_mode):
+                await self._run_webhook()
+            else:
+                await self._dp.start_polling(self._bot)
         except asyncio.CancelledError:
             logger.info("Опрос остановлен (задача отменена).")
         except Exception as e:
@@ -51,11 +68,23 @@ class SupportBotController:
             logger.info("Опрос корректно остановлен.")
             self._is_running = False
             self._task = None
+            if self._outbox:
+                await self._outbox.stop()
+                self._outbox = None
             if self._bot:
                 await self._bot.close()
             self._bot = None
             # self._dp = None <-- Не удаляем диспетчер
 
+    async def _run_webhook(self):
+        self._webhook_stop = asyncio.Event()
+        try:
+            await update_webhook.start_webhook("support", self._dp, self._bot)
+            await self._webhook_stop.wait()
+        finally:
+            self._webhook_stop = None
+            await update_webhook.stop_webhook("support")
+
     def start(self):
         if self._is_running:
             return {"status": "error", "message": "Support-бот уже запущен."}
@@ -78,10 +107,12 @@ class SupportBotController:
         try:
             self._bot = Bot(token=token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
             
-            try:
-                asyncio.run_coroutine_threadsafe(self._bot.delete_webhook(drop_pending_updates=True), self._loop)
-            except Exception as e:
-                logger.warning(f"Не удалось удалить вебхук перед запуском опроса: {e}")
+            # В режиме опроса снимаем вебхук; в режиме вебхука он будет установлен при старте
+            if not update_webhook.is_webhook_mode():
+                try:
+                    asyncio.run_coroutine_threadsafe(self._bot.delete_webhook(drop_pending_updates=True), self._loop)
+                except Exception as e:
+                    logger.warning(f"Не удалось удалить вебхук перед запуском опроса: {e}")
 
             self._task = asyncio.run_coroutine_threadsafe(self._start_polling(), self._loop)
             logger.info("Команда на запуск передана в цикл событий.")
@@ -100,8 +131,14 @@ class SupportBotController:
             return {"status": "error", "message": "Критическая ошибка: компоненты бота недоступны."}
 
         logger.info("Отправляю сигнал на корректную остановку...")
-        asyncio.run_coroutine_threadsafe(self._dp.stop_polling(), self._loop)
+        if self._webhook_stop is not None:
+            self._loop.call_soon_threadsafe(self._webhook_stop.set)
+        else:
+            asyncio.run_coroutine_threadsafe(self._dp.stop_polling(), self._loop)
         return {"status": "success", "message": "Команда на остановку support-бота отправлена."}
 
+    def get_outbox(self) -> MessageDispatcher | None:
+        return self._outbox
+
     def get_status(self):
         return {"is_running": self._is_running}
@@ -0,0 +1,283 @@
+import asyncio
+import itertools
+import logging
+import threading
+import time
+from typing import Awaitable, Callable
+
+from shop_bot.data_manager import database
+from shop_bot.data_manager import speedtest_runner
+from shop_bot.modules import xui_api
+from shop_bot.bot import message_dispatcher
+
+logger = logging.getLogger(__name__)
+
+# Фоновые задачи веб-панели: массовые действия выполняются в основном цикле событий бота,
+# HTTP-запрос только ставит задачу и сразу отвечает, а прогресс опрашивается отдельно.
+MAX_CONCURRENT_JOBS = 2
+# Сколько клиентов удалять с панели за один заход в поток (между порциями — прогресс и проверка отмены)
+PANEL_BATCH_SIZE = 25
+# Завершённые задачи хранятся в памяти для опроса прогресса
+FINISHED_JOBS_KEEP = 50
+
+ACTIVE_STATUSES = ('queued', 'running')
+
+_jobs: dict[int, "Job"] = {}
+_lock = threading.Lock()
+_ids = itertools.count(1)
+_semaphore: asyncio.Semaphore | None = None
+
+
+class Job:
+    """Состояние фоновой задачи; пишется из цикла событий, читается потоками веб-сервера."""
+
+    def __init__(self, kind: str, title: str, dedup_key: str | None = None, cooperative: bool = True):
+        self.job_id = next(_ids)
+        self.kind = kind
+        self.title = title
+        self.dedup_key = dedup_key
+        self.status = 'queued'
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self.message = ''
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_requested = False
+        # cooperative=False — задача не проверяет флаг отмены, её корутина отменяется целиком
+        self.cooperative = cooperative
+        self.future = None
+
+    def set_total(self, total: int) -> None:
+        self.total = max(0, int(total))
+
+    def advance(self, ok: int = 0, failed: int = 0) -> None:
+        self.done += ok + failed
+        self.failed += failed
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.job_id,
+            "kind": self.kind,
+            "title": self.title,
+            "status": self.status,
+            "total": self.total,
+            "done": self.done,
+            "failed": self.failed,
+            "percent": int(self.done * 100 / self.total) if self.total else (100 if self.status == 'done' else 0),
+            "message": self.message,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+def _prune_finished() -> None:
+    finished = sorted(
+        (j for j in _jobs.values() if j.status not in ACTIVE_STATUSES),
+        key=lambda j: j.finished_at or 0,
+    )
+    for job in finished[:-FINISHED_JOBS_KEEP] if len(finished) > FINISHED_JOBS_KEEP else []:
+        _jobs.pop(job.job_id, None)
+
+
+async def _run(job: Job, work: Callable[[Job], Awaitable[str | None]]) -> None:
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(MAX_CONCURRENT_JOBS)
+    async with _semaphore:
+        if job.cancel_requested:
+            return
+        job.status = 'running'
+        job.started_at = time.time()
+        logger.info(f"Фоновая задача #{job.job_id} ({job.title}): запущена.")
+        try:
+            message = await work(job)
+            job.message = message or job.message
+            job.status = 'cancelled' if job.cancel_requested else 'done'
+        except asyncio.CancelledError:
+            job.status = 'cancelled'
+            raise
+        except Exception as e:
+            job.status = 'failed'
+            job.error = str(e)
+            logger.error(f"Фоновая задача #{job.job_id} ({job.title}): ошибка: {e}", exc_info=True)
+        finally:
+            job.finished_at = time.time()
+            logger.info(f"Фоновая задача #{job.job_id} ({job.title}): {job.status}, {job.done}/{job.total}.")
+
+
+def submit(loop: asyncio.AbstractEventLoop | None, kind: str, title: str,
+           work: Callable[[Job], Awaitable[str | None]], dedup_key: str | None = None,
+           cooperative: bool = True) -> Job:
+    """Ставит задачу в цикл событий бота. Повторный запуск с тем же dedup_key возвращает активную задачу."""
+    if not loop or not loop.is_running():
+        raise RuntimeError("Цикл событий не запущен, фоновые задачи недоступны")
+    with _lock:
+        if dedup_key:
+            for existing in _jobs.values():
+                if existing.dedup_key == dedup_key and existing.status in ACTIVE_STATUSES:
+                    return existing
+        job = Job(kind, title, dedup_key, cooperative)
+        _jobs[job.job_id] = job
+        _prune_finished()
+    job.future = asyncio.run_coroutine_threadsafe(_run(job, work), loop)
+    return job
+
+
+def get_job(job_id: int) -> dict | None:
+    with _lock:
+        job = _jobs.get(job_id)
+        return job.to_dict() if job else None
+
+
+def list_jobs(limit: int = 20) -> list[dict]:
+    with _lock:
+        jobs = sorted(_jobs.values(), key=lambda j: j.job_id, reverse=True)[:limit]
+        return [j.to_dict() for j in jobs]
+
+
+def cancel(job_id: int) -> bool:
+    """Просит задачу остановиться: она завершит текущую порцию и выйдет."""
+    with _lock:
+        job = _jobs.get(job_id)
+        if not job or job.status not in ACTIVE_STATUSES:
+            return False
+        job.cancel_requested = True
+        if job.status == 'queued':
+            # Ещё не запущена: _run увидит флаг и сразу выйдет
+            job.status = 'cancelled'
+            job.finished_at = time.time()
+            return True
+        future = job.future if not job.cooperative else None
+    if future is not None:
+        future.cancel()
+    return True
+
+
+# --- Задачи ---
+
+async def _notify(bot, items: list[tuple[int, str]]) -> None:
+    if not bot or not items:
+        return
+    results = await asyncio.gather(
+        *(message_dispatcher.send_message(bot, user_id, text) for user_id, text in items if user_id),
+        return_exceptions=True,
+    )
+    for res in results:
+        if isinstance(res, Exception):
+            logger.debug(f"Фоновая задача: не удалось отправить уведомление: {res}")
+
+
+async def _delete_keys_by_host(job: Job, keys: list[dict], on_batch: Callable[[list[dict], list[bool]], Awaitable[None]]) -> int:
+    """Удаляет клиентов с панелей: один вход на хост, затем порции по PANEL_BATCH_SIZE.
+    Возвращает число ошибок панели."""
+    by_host: dict[str, list[dict]] = {}
+    for k in keys:
+        by_host.setdefault(k.get('host_name'), []).append(k)
+    panel_errors = 0
+    for host_name, host_keys in by_host.items():
+        if job.cancel_requested:
+            break
+        api, inbound = await asyncio.to_thread(xui_api.login_to_host_by_name, host_name)
+        for start in range(0, len(host_keys), PANEL_BATCH_SIZE):
+            if job.cancel_requested:
+                break
+            batch = host_keys[start:start + PANEL_BATCH_SIZE]
+            if api and inbound:
+                results = await asyncio.to_thread(
+                    lambda: [xui_api.delete_client_with_api(api, inbound, host_name, k.get('xui_client_uuid'), k.get('key_email')) for k in batch]
+                )
+            else:
+                results = [False] * len(batch)
+            panel_errors += results.count(False)
+            await on_batch(batch, results)
+    return panel_errors
+
+
+def sweep_expired_keys_job(bot) -> Callable[[Job], Awaitable[str]]:
+    async def work(job: Job) -> str:
+        keys = await asyncio.to_thread(database.get_expired_keys)
+        job.set_total(len(keys))
+
+        async def on_batch(batch: list[dict], results: list[bool]) -> None:
+            # Как и раньше, истёкший ключ удаляется из БД даже при ошибке панели
+            removed = await asyncio.to_thread(database.delete_keys_by_ids, [k.get('key_id') for k in batch])
+            job.advance(ok=removed, failed=len(batch) - removed)
+            await _notify(bot, [
+                (k.get('user_id'),
+                 "Ваш ключ был автоматически удалён по истечении срока.\n"
+                 f"Хост: {k.get('host_name')}\nEmail: {k.get('key_email')}\n"
+                 "При необходимости вы можете оформить новый ключ.")
+                for k in batch
+            ])
+
+        panel_errors = await _delete_keys_by_host(job, keys, on_batch)
+        return f"Удалено истёкших ключей: {job.done - job.failed}. Ошибок: {job.failed}. Ошибок панели: {panel_errors}."
+    return work
+
+
+def revoke_user_keys_job(bot, user_id: int) -> Callable[[Job], Awaitable[str]]:
+    async def work(job: Job) -> str:
+        keys = await asyncio.to_thread(database.get_user_keys, user_id)
+        job.set_total(len(keys))
+
+        async def on_batch(batch: list[dict], results: list[bool]) -> None:
+            job.advance(ok=results.count(True), failed=results.count(False))
+
+        await _delete_keys_by_host(job, keys, on_batch)
+        if job.cancel_requested:
+            return f"Отзыв ключей пользователя {user_id} остановлен: обработано {job.done} из {job.total}."
+        # Из БД удаляются все ключи пользователя, как и при синхронном отзыве
+        await asyncio.to_thread(database.delete_user_keys, user_id)
+        revoked = job.done - job.failed
+        await _notify(bot, [(user_id, (
+            "❌ Ваши VPN‑ключи были отозваны администратором.\n"
+            f"Всего ключей: {job.total}\n"
+            f"Отозвано: {revoked}"
+        ))])
+        if revoked == job.total:
+            return f"Все {job.total} ключей для пользователя {user_id} были успешно отозваны."
+        return f"Удалось отозвать {revoked} из {job.total} ключей для пользователя {user_id}. Проверьте логи."
+    return work
+
+
+def speedtests_job(host_names: list[str]) -> Callable[[Job], Awaitable[str]]:
+    async def work(job: Job) -> str:
+        names = [n for n in dict.fromkeys(host_names) if n]
+        job.set_total(len(names))
+        errors: list[str] = []
+
+        async def on_result(host_name: str, res: dict) -> None:
+            if res.get('ok'):
+                job.advance(ok=1)
+            else:
+                job.advance(failed=1)
+                errors.append(f"{host_name}: {res.get('error') or 'unknown'}")
+
+        summary = await speedtest_runner.run_speedtests_for_hosts(names, on_result=on_result)
+        message = f"Тесты скорости выполнены: {summary.get('ok_count', 0)}/{len(names)}"
+        if errors:
+            message += f". Ошибки: {'; '.join(errors[:3])}{'…' if len(errors) > 3 else ''}"
+        return message
+    return work
+
+
+def host_speedtest_job(host_name: str, method: str = 'both') -> Callable[[Job], Awaitable[str]]:
+    async def work(job: Job) -> str:
+        job.set_total(1)
+        if method == 'ssh':
+            res = await speedtest_runner.run_and_store_ssh_speedtest(host_name)
+        elif method == 'net':
+            res = await speedtest_runner.run_and_store_net_probe(host_name)
+        else:
+            res = await speedtest_runner.run_both_for_host(host_name)
+        ok = bool(res and res.get('ok'))
+        job.advance(ok=int(ok), failed=int(not ok))
+        if not ok:
+            raise RuntimeError(f"Ошибка теста: {res.get('error') if res else 'unknown'}")
+        return "Тест выполнен."
+    return work
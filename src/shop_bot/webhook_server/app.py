@@ -11,7 +11,7 @@ from hmac import compare_digest
 from datetime import datetime
 from functools import wraps
 from math import ceil
-from flask import Flask, request, render_template, redirect, url_for, flash, session, current_app, jsonify, send_file
+from flask import Flask, Response, request, render_template, redirect, url_for, flash, session, current_app, jsonify, send_file, g
 from flask_wtf.csrf import CSRFProtect, generate_csrf
 import secrets
 import urllib.parse
@@ -22,25 +22,34 @@ logger = logging.getLogger(__name__)
 logging.getLogger('werkzeug').setLevel(logging.WARNING)
 
 from shop_bot.modules import xui_api
-from shop_bot.bot import handlers
 from shop_bot.bot import keyboards
+from shop_bot.bot import message_dispatcher
+from shop_bot.bot import handler_metrics
+from shop_bot.bot import payment_inbox
+from shop_bot.webhook_server.response_cache import cached_response
+from shop_bot.webhook_server import admin_jobs
+from shop_bot.webhook_server import event_bus
+from shop_bot.webhook_server import serving
+from shop_bot.webhook_server import static_assets
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from shop_bot.support_bot_controller import SupportBotController
 from shop_bot.data_manager import speedtest_runner
 from shop_bot.data_manager import backup_manager
 from shop_bot.data_manager import resource_monitor
+from shop_bot.data_manager import leader_lease
+from shop_bot.data_manager import metrics_registry
 from shop_bot.data_manager import database
 from shop_bot.data_manager.database import (
     get_all_settings, update_setting, get_all_hosts, get_plans_for_host,
     create_host, delete_host, create_plan, delete_plan, update_plan, get_user_count,
-    get_total_keys_count, get_total_spent_sum, get_daily_stats_for_charts,
-    get_recent_transactions, get_paginated_transactions, get_all_users, get_user_keys,
-    ban_user, unban_user, delete_user_keys, get_setting, find_and_complete_ton_transaction, find_and_complete_pending_transaction,
+    get_total_keys_count, get_total_spent_sum,
+    get_recent_transactions, get_paginated_transactions, get_user_keys,
+    ban_user, unban_user, get_setting, find_and_complete_ton_transaction, find_and_complete_pending_transaction,
     get_tickets_paginated, get_open_tickets_count, get_ticket, get_ticket_messages,
     add_support_message, set_ticket_status, delete_ticket,
     get_closed_tickets_count, get_all_tickets_count, update_host_subscription_url,
     update_host_url, update_host_name, update_host_ssh_settings, get_latest_speedtest, get_speedtests,
-    get_all_keys, get_keys_for_user, get_key_by_id, delete_key_by_id, update_key_comment, update_key_info,
+    get_keys_page, get_keys_for_user, get_key_by_id, delete_key_by_id, update_key_comment, update_key_info,
     add_new_key, get_balance, adjust_user_balance, get_referrals_for_user,
     get_user, get_key_by_email, get_host)
 
@@ -76,6 +85,15 @@ ALL_SETTINGS_KEYS = [
     "panel_brand_title",
     # Backups
     "backup_interval_days",
+    # Speedtests
+    "speedtest_concurrency",
+    # Telegram updates (polling / webhook)
+    "bot_update_mode", "bot_webhook_base_url", "bot_webhook_listen_host", "bot_webhook_port",
+    "bot_webhook_concurrency", "bot_webhook_secret",
+    # HTTP server (admin panel / payment webhooks)
+    "http_server_mode", "http_admin_workers", "http_webhook_workers", "http_request_timeout", "http_max_connections",
+    # Prometheus /metrics
+    "metrics_token",
     # Monitoring
     "monitoring_enabled", "monitoring_interval_sec",
     "monitoring_cpu_threshold", "monitoring_mem_threshold", "monitoring_disk_threshold",
@@ -118,6 +136,8 @@ def create_webhook_app(bot_controller_instance):
         static_folder='static'
     )
     flask_app.wsgi_app = ProxyFix(flask_app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_port=1, x_prefix=1)
+    # Статика с отпечатками и предсжатием, gzip для крупных JSON-ответов
+    static_assets.init_app(flask_app)
     
     # SECRET_KEY из окружения или сгенерированный на лету (без хардкода)
     flask_app.config['SECRET_KEY'] = os.getenv('SHOPBOT_SECRET_KEY') or secrets.token_hex(32)
@@ -132,6 +152,31 @@ def create_webhook_app(bot_controller_instance):
     def log_request_info():
         print(f"REQUEST: {request.method} {request.url}", flush=True)
 
+    # Метрики платёжных вебхуков: счётчик по провайдеру и исходу, длительность обработки
+    webhook_requests = metrics_registry.counter(
+        "shopbot_payment_webhooks_total", "Уведомления платёжных систем по провайдеру и исходу", ("provider", "outcome")
+    )
+    webhook_seconds = metrics_registry.histogram(
+        "shopbot_payment_webhook_duration_seconds", "Длительность обработки уведомлений платёжных систем", ("provider",)
+    )
+
+    @flask_app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @flask_app.after_request
+    def record_webhook_metrics(response):
+        # Только существующие маршруты: метка провайдера не должна зависеть от произвольных путей
+        if request.url_rule is not None and serving.is_webhook_path(request.path):
+            provider = request.path.strip('/')[:-len('-webhook')]
+            code = response.status_code
+            outcome = 'ok' if code < 400 else ('rejected' if code < 500 else 'error')
+            webhook_requests.inc(provider=provider, outcome=outcome)
+            started = g.get('request_started')
+            if started is not None:
+                webhook_seconds.observe(time.perf_counter() - started, provider=provider)
+        return response
+
     @flask_app.context_processor
     def inject_current_year():
         # Добавляем csrf_token в шаблоны для meta и скрытых полей
@@ -251,7 +296,7 @@ def create_webhook_app(bot_controller_instance):
         transactions, total_transactions = get_paginated_transactions(page=page, per_page=per_page)
         total_pages = ceil(total_transactions / per_page)
         
-        chart_data = get_daily_stats_for_charts(days=30)
+        chart_data = database.get_daily_rollups(days=30)
         common_data = get_common_template_data()
         
         return render_template(
@@ -316,38 +361,115 @@ def create_webhook_app(bot_controller_instance):
     @flask_app.route('/dashboard/run-speedtests', methods=['POST'])
     @login_required
     def run_speedtests_route():
-        try:
-            speedtest_runner.run_speedtests_for_all_hosts()
-            return jsonify({"ok": True})
-        except Exception as e:
-            return jsonify({"ok": False, "error": str(e)}), 500
+        return run_all_speedtests_route()
 
     # Partials for dashboard fragments (auto-update without reload)
     @flask_app.route('/dashboard/stats.partial')
     @login_required
     def dashboard_stats_partial():
-        stats = {
-            "user_count": get_user_count(),
-            "total_keys": get_total_keys_count(),
-            "total_spent": get_total_spent_sum(),
-            "host_count": len(get_all_hosts())
-        }
-        common_data = get_common_template_data()
-        return render_template('partials/dashboard_stats.html', stats=stats, **common_data)
+        def build():
+            stats = {
+                "user_count": get_user_count(),
+                "total_keys": get_total_keys_count(),
+                "total_spent": get_total_spent_sum(),
+                "host_count": len(get_all_hosts())
+            }
+            common_data = get_common_template_data()
+            return render_template('partials/dashboard_stats.html', stats=stats, **common_data)
+        return cached_response(('dashboard_stats',), ('users', 'keys', 'transactions', 'hosts', 'tickets'), build)
 
     @flask_app.route('/dashboard/transactions.partial')
     @login_required
     def dashboard_transactions_partial():
         page = request.args.get('page', 1, type=int)
         per_page = 8
-        transactions, total_transactions = get_paginated_transactions(page=page, per_page=per_page)
-        return render_template('partials/dashboard_transactions.html', transactions=transactions)
+
+        def build():
+            transactions, total_transactions = get_paginated_transactions(page=page, per_page=per_page)
+            return render_template('partials/dashboard_transactions.html', transactions=transactions)
+        return cached_response(('dashboard_transactions', page), ('transactions', 'users'), build)
 
     @flask_app.route('/dashboard/charts.json')
     @login_required
     def dashboard_charts_json():
-        data = get_daily_stats_for_charts(days=30)
-        return jsonify(data)
+        # Ряды берутся из ежедневных сводок (daily_rollups): год истории без обхода users/vpn_keys/transactions.
+        # Окно сдвигается с датой, поэтому она тоже входит в версию
+        days = max(1, min(366, request.args.get('days', 365, type=int) or 365))
+        return cached_response(
+            ('dashboard_charts', days), ('users', 'keys', 'transactions'),
+            lambda: jsonify(database.get_daily_rollups(days=days)),
+            extra_version=datetime.now().date().isoformat(),
+        )
+
+    # --- Живые обновления панели (SSE) ---
+    event_bus.register_status_source('bot', lambda: _bot_controller.get_status())
+    event_bus.register_status_source('support_bot', lambda: _support_bot_controller.get_status())
+
+    @flask_app.route('/events/stream')
+    @login_required
+    def events_stream():
+        # Поток держит рабочий поток сервера, поэтому их число ограничено; сверх лимита клиент опрашивает фрагменты сам
+        q = event_bus.subscribe(limit=serving.max_event_streams())
+        if q is None:
+            return Response("event stream limit reached", status=503, mimetype='text/plain')
+        resp = Response(event_bus.stream(q), mimetype='text/event-stream')
+        resp.headers['Cache-Control'] = 'no-cache'
+        resp.headers['X-Accel-Buffering'] = 'no'
+        return resp
+
+    @flask_app.route('/bot-control.partial')
+    @login_required
+    def bot_control_partial():
+        return render_template('partials/bot_control.html', **get_common_template_data())
+
+    # --- Prometheus ---
+    def _collect_handler_metrics():
+        snapshot = handler_metrics.get_snapshot()
+        bounds = [b / 1000.0 for b in snapshot['bucket_bounds_ms']]
+        durations, errors = [], []
+        for row in snapshot['handlers']:
+            labels = {'bot': row['bot'], 'handler': row['label']}
+            durations.extend(metrics_registry.histogram_samples(labels, bounds, row['buckets'], row['total_ms'] / 1000.0))
+            errors.append(('', labels, row['errors']))
+        return [
+            ("shopbot_telegram_update_duration_seconds", "histogram", "Длительность обработки апдейтов Telegram по обработчикам", durations),
+            ("shopbot_telegram_update_errors_total", "counter", "Апдейты Telegram, завершившиеся ошибкой", errors),
+        ]
+
+    def _collect_dispatcher_metrics():
+        gauges = {'queue_depth': [], 'in_flight': [], 'paused_for_seconds': []}
+        counters = {'enqueued': [], 'sent': [], 'failed': [], 'retried': [], 'dropped': []}
+        for name, m in message_dispatcher.get_all_metrics().items():
+            labels = {'bot': name}
+            for field, samples in (*gauges.items(), *counters.items()):
+                samples.append(('', labels, m.get(field) or 0))
+        families = [
+            (f"shopbot_outbound_{field}", "gauge", f"Очередь исходящих сообщений: {field}", samples)
+            for field, samples in gauges.items()
+        ]
+        families += [
+            (f"shopbot_outbound_{field}_total", "counter", f"Очередь исходящих сообщений: {field}", samples)
+            for field, samples in counters.items()
+        ]
+        return families
+
+    metrics_registry.register_collector(_collect_handler_metrics)
+    metrics_registry.register_collector(_collect_dispatcher_metrics)
+
+    @flask_app.route('/metrics')
+    def prometheus_metrics():
+        # Без входа в панель, по токену в заголовке Authorization: Bearer <token> (не в URL — он попадает в логи). Токен не задан — эндпоинта нет
+        token = (get_setting('metrics_token') or '').strip()
+        if not token:
+            return 'Not Found', 404
+        auth = request.headers.get('Authorization', '')
+        provided = auth[7:].strip() if auth.lower().startswith('bearer ') else ''
+        if not compare_digest(provided.encode('utf-8'), token.encode('utf-8')):
+            return Response('Unauthorized', status=401, headers={'WWW-Authenticate': 'Bearer'})
+        resp = Response(metrics_registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+        resp.headers['Cache-Control'] = 'no-store'
+        return resp
+
     # --- Resource Monitor ---
     @flask_app.route('/monitor')
     @login_required
@@ -398,11 +520,49 @@ def create_webhook_app(bot_controller_instance):
         try:
             since_hours = int(request.args.get('since_hours', '24'))
             limit = int(request.args.get('limit', '500'))
-            items = database.get_metrics_series(scope, object_name, since_hours=since_hours, limit=limit)
-            return jsonify({"ok": True, "items": items})
+
+            def build():
+                items = database.get_metrics_series(scope, object_name, since_hours=since_hours, limit=limit)
+                return jsonify({"ok": True, "items": items})
+            # Окно выборки сдвигается со временем — кэшируем не дольше минуты
+            return cached_response(
+                ('monitor_metrics', scope, object_name, since_hours, limit), ('metrics',), build,
+                extra_version=int(time.time() // 60),
+            )
         except Exception as e:
             return jsonify({"ok": False, "error": str(e)}), 500
 
+    @flask_app.route('/monitor/scheduler.json')
+    @login_required
+    def monitor_scheduler_json():
+        # Телеметрия фаз планировщика: p50/p95 длительностей, ошибки, перерасход интервала и тренд цикла
+        try:
+            since_hours = max(1, min(int(request.args.get('since_hours', '24')), 24 * 14))
+            phases = database.get_scheduler_run_stats(since_hours=since_hours)
+            series = database.get_scheduler_run_series('cycle', since_hours=since_hours)
+            try:
+                leader = leader_lease.get_status()
+            except Exception:
+                leader = None
+            return jsonify({"ok": True, "phases": phases, "series": series, "leader": leader})
+        except Exception as e:
+            return jsonify({"ok": False, "error": str(e)}), 500
+
+    @flask_app.route('/monitor/handlers.json')
+    @login_required
+    def monitor_handlers_json():
+        # Задержки обработки апдейтов по кнопкам/командам (в памяти процесса, с момента запуска)
+        try:
+            return jsonify({"ok": True, **handler_metrics.get_snapshot()})
+        except Exception as e:
+            return jsonify({"ok": False, "error": str(e)}), 500
+
+    @flask_app.route('/monitor/handlers/reset', methods=['POST'])
+    @login_required
+    def monitor_handlers_reset():
+        handler_metrics.reset()
+        return jsonify({"ok": True})
+
     # --- Support partials ---
     @flask_app.route('/support/table.partial')
     @login_required
@@ -416,20 +576,20 @@ def create_webhook_app(bot_controller_instance):
     @flask_app.route('/support/open-count.partial')
     @login_required
     def support_open_count_partial():
-        try:
-            count = get_open_tickets_count() or 0
-        except Exception:
-            count = 0
-        # Возвращаем готовый HTML-бейдж (или пустую строку)
-        if count and count > 0:
-            html = (
-                '<span class="badge bg-green-lt" title="Открытые тикеты">'
-                '<span class="status-dot status-dot-animated bg-green"></span>'
-                f" {count}</span>"
-            )
-        else:
-            html = ''
-        return html, 200, {"Content-Type": "text/html; charset=utf-8"}
+        def build():
+            try:
+                count = get_open_tickets_count() or 0
+            except Exception:
+                count = 0
+            # Возвращаем готовый HTML-бейдж (или пустую строку)
+            if count and count > 0:
+                return (
+                    '<span class="badge bg-green-lt" title="Открытые тикеты">'
+                    '<span class="status-dot status-dot-animated bg-green"></span>'
+                    f" {count}</span>"
+                )
+            return ''
+        return cached_response(('support_open_count',), ('tickets',), build)
 
     @flask_app.route('/users')
     @login_required
@@ -515,49 +675,107 @@ def create_webhook_app(bot_controller_instance):
                     text = f"💳 Ваш баланс был изменён администратором: {sign}{delta:.2f} RUB\nТекущий баланс: {get_balance(user_id):.2f} RUB"
                     loop = current_app.config.get('EVENT_LOOP')
                     if loop and loop.is_running():
-                        asyncio.run_coroutine_threadsafe(bot.send_message(chat_id=user_id, text=text), loop)
+                        asyncio.run_coroutine_threadsafe(message_dispatcher.send_message(bot, user_id, text), loop)
                         logger.info(f"Запланирована отправка уведомления о балансе пользователю {user_id}")
                     else:
                         # fallback, если по какой-то причине нет общего цикла (не рекомендуется, но лучше чем молча не отправить)
                         logger.warning("Цикл событий (EVENT_LOOP) не запущен; использую резервный asyncio.run для уведомления о балансе")
-                        asyncio.run(bot.send_message(chat_id=user_id, text=text))
+                        asyncio.run(message_dispatcher.send_message(bot, user_id, text))
                 else:
                     logger.warning("Экземпляр бота отсутствует; не могу отправить уведомление о балансе")
         except Exception as e:
             logger.warning(f"Не удалось отправить уведомление о балансе: {e}")
         return redirect(url_for('users_page'))
 
+    KEYS_PAGE_SIZE = 50
+
+    def _keys_page_args() -> tuple[dict, str, str | None]:
+        """Фильтры, сортировка и курсор списка ключей из query-параметров."""
+        args = request.args
+        user_raw = (args.get('user') or '').strip()
+        user_id = None
+        if user_raw:
+            if user_raw.lstrip('-').isdigit():
+                user_id = int(user_raw)
+            else:
+                found = database.get_user_by_username(user_raw)
+                # Неизвестный @username — пустой результат, а не все ключи
+                user_id = found['telegram_id'] if found else 0
+        filters = {
+            'host': args.get('host') or None,
+            'user_id': user_id,
+            'state': args.get('state') or None,
+            'gift': args.get('gift') or None,
+            'q': (args.get('q') or '').strip()[:100] or None,
+        }
+        return filters, args.get('sort') or 'new', args.get('cursor') or None
+
     @flask_app.route('/admin/keys')
     @login_required
     def admin_keys_page():
-        keys = []
-        try:
-            keys = get_all_keys()
-        except Exception:
-            keys = []
         hosts = []
         try:
             hosts = get_all_hosts()
         except Exception:
             hosts = []
-        users = []
-        try:
-            users = get_all_users()
-        except Exception:
-            users = []
         common_data = get_common_template_data()
-        return render_template('admin_keys.html', keys=keys, hosts=hosts, users=users, **common_data)
+        # Таблица ключей подгружается фрагментом /admin/keys/table.partial с фильтрами и курсором
+        return render_template('admin_keys.html', hosts=hosts, **common_data)
 
-    # Partial: admin keys table tbody
+    # Partial: admin keys table tbody (одна страница с учётом фильтров)
     @flask_app.route('/admin/keys/table.partial')
     @login_required
     def admin_keys_table_partial():
-        keys = []
+        filters, sort, cursor = _keys_page_args()
+
+        def build():
+            keys, prev_cursor, next_cursor = get_keys_page(filters, sort, cursor, KEYS_PAGE_SIZE)
+            return render_template(
+                'partials/admin_keys_table.html',
+                keys=keys, prev_cursor=prev_cursor, next_cursor=next_cursor,
+            )
+        key = ('admin_keys', tuple(sorted(filters.items())), sort, cursor)
+        # Фильтр «истекает/истёк» зависит от текущего времени — версия кэша меняется раз в минуту
+        minute = int(time.time() // 60) if filters.get('state') else None
+        return cached_response(key, ('keys',), build, extra_version=minute)
+
+    @flask_app.route('/admin/keys.json')
+    @login_required
+    def admin_keys_json():
+        filters, sort, cursor = _keys_page_args()
         try:
-            keys = get_all_keys()
-        except Exception:
-            keys = []
-        return render_template('partials/admin_keys_table.html', keys=keys)
+            limit = int(request.args.get('limit') or KEYS_PAGE_SIZE)
+        except ValueError:
+            limit = KEYS_PAGE_SIZE
+        keys, prev_cursor, next_cursor = get_keys_page(filters, sort, cursor, limit)
+        items = [
+            {
+                "key_id": k.get('key_id'),
+                "user_id": k.get('user_id'),
+                "host_name": k.get('host_name'),
+                "key_email": k.get('key_email'),
+                "xui_client_uuid": k.get('xui_client_uuid'),
+                "expiry_date": k.get('expiry_date'),
+                "created_date": k.get('created_date'),
+                "comment": k.get('comment'),
+                "is_gift": bool(k.get('is_gift')),
+            } for k in keys
+        ]
+        return jsonify({"ok": True, "items": items, "prev_cursor": prev_cursor, "next_cursor": next_cursor})
+
+    @flask_app.route('/admin/users/search.json')
+    @login_required
+    def admin_users_search_json():
+        q = (request.args.get('q') or '').strip().lstrip('@')[:64]
+        if not q:
+            return jsonify({"ok": True, "items": []})
+        users, _, _ = database.get_users_keyset(None, 8, q)
+        # Точное совпадение username — первым, даже если не попало в первые результаты поиска
+        exact = database.get_user_by_username(q) if not q.isdigit() else None
+        if exact:
+            users = [exact] + [u for u in users if u.get('telegram_id') != exact.get('telegram_id')][:7]
+        items = [{"telegram_id": u.get('telegram_id'), "username": u.get('username')} for u in users]
+        return jsonify({"ok": True, "items": items})
 
     @flask_app.route('/admin/hosts/<host_name>/plans')
     @login_required
@@ -631,11 +849,11 @@ def create_webhook_app(bot_controller_instance):
                 loop = current_app.config.get('EVENT_LOOP')
                 if loop and loop.is_running():
                     asyncio.run_coroutine_threadsafe(
-                        bot.send_message(chat_id=user_id, text=text, parse_mode='HTML', disable_web_page_preview=True),
+                        message_dispatcher.send_message(bot, user_id, text, parse_mode='HTML', disable_web_page_preview=True),
                         loop
                     )
                 else:
-                    asyncio.run(bot.send_message(chat_id=user_id, text=text, parse_mode='HTML', disable_web_page_preview=True))
+                    asyncio.run(message_dispatcher.send_message(bot, user_id, text, parse_mode='HTML', disable_web_page_preview=True))
         except Exception as e:
             logger.warning(f"Не удалось уведомить пользователя о новом ключе: {e}")
         return redirect(request.referrer or url_for('admin_keys_page'))
@@ -683,11 +901,11 @@ def create_webhook_app(bot_controller_instance):
                 loop = current_app.config.get('EVENT_LOOP')
                 if loop and loop.is_running():
                     asyncio.run_coroutine_threadsafe(
-                        bot.send_message(chat_id=user_id, text=text, parse_mode='HTML', disable_web_page_preview=True),
+                        message_dispatcher.send_message(bot, user_id, text, parse_mode='HTML', disable_web_page_preview=True),
                         loop
                     )
                 else:
-                    asyncio.run(bot.send_message(chat_id=user_id, text=text, parse_mode='HTML', disable_web_page_preview=True))
+                    asyncio.run(message_dispatcher.send_message(bot, user_id, text, parse_mode='HTML', disable_web_page_preview=True))
         except Exception as e:
             logger.warning(f"Не удалось уведомить пользователя (ajax): {e}")
 
@@ -779,11 +997,11 @@ def create_webhook_app(bot_controller_instance):
                     loop = current_app.config.get('EVENT_LOOP')
                     if loop and loop.is_running():
                         asyncio.run_coroutine_threadsafe(
-                            bot.send_message(chat_id=user_id, text=text, parse_mode='HTML', disable_web_page_preview=True),
+                            message_dispatcher.send_message(bot, user_id, text, parse_mode='HTML', disable_web_page_preview=True),
                             loop
                         )
                     else:
-                        asyncio.run(bot.send_message(chat_id=user_id, text=text, parse_mode='HTML', disable_web_page_preview=True))
+                        asyncio.run(message_dispatcher.send_message(bot, user_id, text, parse_mode='HTML', disable_web_page_preview=True))
             except Exception as notify_err:
                 logger.warning(f"Не удалось уведомить пользователя (standalone ajax): {notify_err}")
 
@@ -897,9 +1115,9 @@ def create_webhook_app(bot_controller_instance):
                     bot = _bot_controller.get_bot_instance()
                     loop = current_app.config.get('EVENT_LOOP')
                     if bot and loop and loop.is_running():
-                        asyncio.run_coroutine_threadsafe(bot.send_message(chat_id=user_id, text=text), loop)
+                        asyncio.run_coroutine_threadsafe(message_dispatcher.send_message(bot, user_id, text), loop)
                     elif bot:
-                        asyncio.run(bot.send_message(chat_id=user_id, text=text))
+                        asyncio.run(message_dispatcher.send_message(bot, user_id, text))
             except Exception:
                 pass
 
@@ -907,61 +1125,56 @@ def create_webhook_app(bot_controller_instance):
         except Exception as e:
             return jsonify({"ok": False, "error": str(e)}), 500
 
+    def _wants_json() -> bool:
+        return 'application/json' in (request.headers.get('Accept') or '') or request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+
+    def _start_job(kind: str, title: str, work, redirect_to: str, dedup_key: str | None = None, cooperative: bool = True):
+        """Ставит фоновую задачу и отвечает сразу: JSON с job_id для AJAX или flash + redirect."""
+        try:
+            job = admin_jobs.submit(current_app.config.get('EVENT_LOOP'), kind, title, work, dedup_key, cooperative)
+        except Exception as e:
+            logger.error(f"Не удалось запустить фоновую задачу '{title}': {e}")
+            if _wants_json():
+                return jsonify({"ok": False, "error": str(e)}), 503
+            flash(f"Не удалось запустить задачу: {e}", 'danger')
+            return redirect(redirect_to)
+        if _wants_json():
+            return jsonify({
+                "ok": True,
+                "job_id": job.job_id,
+                "status_url": url_for('admin_job_json', job_id=job.job_id),
+            }), 202
+        flash(f"Задача #{job.job_id} «{title}» запущена в фоне.", 'info')
+        return redirect(redirect_to)
+
     @flask_app.route('/admin/keys/sweep-expired', methods=['POST'])
     @login_required
     def sweep_expired_keys_route():
-        from datetime import datetime
-        removed = 0
-        failed = 0
-        now = datetime.utcnow()
-        keys = get_all_keys()
-        for k in keys:
-            exp = k.get('expiry_date')
-            exp_dt = None
-            try:
-                if isinstance(exp, str):
-                    try:
-                        from datetime import datetime as dt
-                        exp_dt = dt.fromisoformat(exp)
-                    except Exception:
-                        # fallback: если в БД дата как 'YYYY-MM-DD HH:MM:SS'
-                        try:
-                            exp_dt = datetime.strptime(exp, '%Y-%m-%d %H:%M:%S')
-                        except Exception:
-                            exp_dt = None
-                else:
-                    exp_dt = exp
-            except Exception:
-                exp_dt = None
-            if not exp_dt or exp_dt > now:
-                continue
-            # Истёкший — пробуем удалить на сервере и в БД, уведомляем пользователя
-            try:
-                try:
-                    asyncio.run(xui_api.delete_client_on_host(k.get('host_name'), k.get('key_email')))
-                except Exception:
-                    pass
-                delete_key_by_id(k.get('key_id'))
-                removed += 1
-                # Уведомление пользователю о автоудалении
-                try:
-                    bot = _bot_controller.get_bot_instance()
-                    loop = current_app.config.get('EVENT_LOOP')
-                    text = (
-                        "Ваш ключ был автоматически удалён по истечении срока.\n"
-                        f"Хост: {k.get('host_name')}\nEmail: {k.get('key_email')}\n"
-                        "При необходимости вы можете оформить новый ключ."
-                    )
-                    if bot and loop and loop.is_running():
-                        asyncio.run_coroutine_threadsafe(bot.send_message(chat_id=k.get('user_id'), text=text), loop)
-                    else:
-                        asyncio.run(bot.send_message(chat_id=k.get('user_id'), text=text))
-                except Exception:
-                    pass
-            except Exception:
-                failed += 1
-        flash(f"Удалено истёкших ключей: {removed}. Ошибок: {failed}.", 'success' if failed == 0 else 'warning')
-        return redirect(request.referrer or url_for('admin_keys_page'))
+        return _start_job(
+            'sweep_expired', "Удаление истёкших ключей",
+            admin_jobs.sweep_expired_keys_job(_bot_controller.get_bot_instance()),
+            request.referrer or url_for('admin_keys_page'),
+            dedup_key='sweep_expired',
+        )
+
+    @flask_app.route('/admin/jobs.json')
+    @login_required
+    def admin_jobs_json():
+        return jsonify({"ok": True, "items": admin_jobs.list_jobs()})
+
+    @flask_app.route('/admin/jobs/<int:job_id>.json')
+    @login_required
+    def admin_job_json(job_id: int):
+        job = admin_jobs.get_job(job_id)
+        if not job:
+            return jsonify({"ok": False, "error": "not_found"}), 404
+        return jsonify({"ok": True, "job": job})
+
+    @flask_app.route('/admin/jobs/<int:job_id>/cancel', methods=['POST'])
+    @login_required
+    def admin_job_cancel(job_id: int):
+        ok = admin_jobs.cancel(job_id)
+        return jsonify({"ok": ok, "job": admin_jobs.get_job(job_id)})
 
     @flask_app.route('/admin/keys/<int:key_id>/comment', methods=['POST'])
     @login_required
@@ -996,21 +1209,14 @@ def create_webhook_app(bot_controller_instance):
     @login_required
     def run_host_speedtest_route(host_name: str):
         method = (request.form.get('method') or '').strip().lower()
-        try:
-            if method == 'ssh':
-                res = asyncio.run(speedtest_runner.run_and_store_ssh_speedtest(host_name))
-            elif method == 'net':
-                res = asyncio.run(speedtest_runner.run_and_store_net_probe(host_name))
-            else:
-                # both
-                res = asyncio.run(speedtest_runner.run_both_for_host(host_name))
-        except Exception as e:
-            res = {'ok': False, 'error': str(e)}
-        wants_json = 'application/json' in (request.headers.get('Accept') or '') or request.headers.get('X-Requested-With') == 'XMLHttpRequest'
-        if wants_json:
-            return jsonify(res)
-        flash(('Тест выполнен.' if res and res.get('ok') else f"Ошибка теста: {res.get('error') if res else 'unknown'}"), 'success' if res and res.get('ok') else 'danger')
-        return redirect(request.referrer or url_for('settings_page'))
+        if method not in ('ssh', 'net'):
+            method = 'both'
+        return _start_job(
+            'speedtest', f"Тест скорости: {host_name}",
+            admin_jobs.host_speedtest_job(host_name, method),
+            request.referrer or url_for('settings_page'),
+            dedup_key=f"speedtest:{host_name}", cooperative=False,
+        )
 
     @flask_app.route('/admin/hosts/<host_name>/speedtests.json')
     @login_required
@@ -1036,29 +1242,12 @@ def create_webhook_app(bot_controller_instance):
             hosts = get_all_hosts()
         except Exception:
             hosts = []
-        errors = []
-        ok_count = 0
-        for h in hosts:
-            name = h.get('host_name')
-            if not name:
-                continue
-            try:
-                res = asyncio.run(speedtest_runner.run_both_for_host(name))
-                if res and res.get('ok'):
-                    ok_count += 1
-                else:
-                    errors.append(f"{name}: {res.get('error') if res else 'unknown'}")
-            except Exception as e:
-                errors.append(f"{name}: {e}")
-
-        wants_json = 'application/json' in (request.headers.get('Accept') or '') or request.headers.get('X-Requested-With') == 'XMLHttpRequest'
-        if wants_json:
-            return jsonify({"ok": len(errors) == 0, "done": ok_count, "total": len(hosts), "errors": errors})
-        if errors:
-            flash(f"Выполнено для {ok_count}/{len(hosts)}. Ошибки: {'; '.join(errors[:3])}{'…' if len(errors) > 3 else ''}", 'warning')
-        else:
-            flash(f"Тесты скорости выполнены для всех хостов: {ok_count}/{len(hosts)}", 'success')
-        return redirect(request.referrer or url_for('dashboard_page'))
+        return _start_job(
+            'speedtest', "Тесты скорости для всех хостов",
+            admin_jobs.speedtests_job([h.get('host_name') for h in hosts]),
+            request.referrer or url_for('dashboard_page'),
+            dedup_key='speedtest:all', cooperative=False,
+        )
 
     # --- Host speedtest auto-install ---
     @flask_app.route('/admin/hosts/<host_name>/speedtest/install', methods=['POST'])
@@ -1149,7 +1338,7 @@ def create_webhook_app(bot_controller_instance):
                         user_chat_id = ticket.get('user_id')
                         if bot and loop and loop.is_running() and user_chat_id:
                             text = f"Ответ по тикету #{ticket_id}:\n\n{message}"
-                            asyncio.run_coroutine_threadsafe(bot.send_message(user_chat_id, text), loop)
+                            asyncio.run_coroutine_threadsafe(message_dispatcher.send_message(bot, user_chat_id, text), loop)
                         else:
                             logger.error("Ответ поддержки: support-бот или цикл событий недоступны; сообщение пользователю не отправлено.")
                     except Exception as e:
@@ -1162,7 +1351,7 @@ def create_webhook_app(bot_controller_instance):
                         if bot and loop and loop.is_running() and forum_chat_id and thread_id:
                             text = f"💬 Ответ админа из панели по тикету #{ticket_id}:\n\n{message}"
                             asyncio.run_coroutine_threadsafe(
-                                bot.send_message(chat_id=int(forum_chat_id), text=text, message_thread_id=int(thread_id)),
+                                message_dispatcher.send_message(bot, int(forum_chat_id), text, message_thread_id=int(thread_id)),
                                 loop
                             )
                     except Exception as e:
@@ -1189,7 +1378,7 @@ def create_webhook_app(bot_controller_instance):
                         user_chat_id = ticket.get('user_id')
                         if bot and loop and loop.is_running() and user_chat_id:
                             text = f"✅ Ваш тикет #{ticket_id} был закрыт администратором. Вы можете создать новое обращение при необходимости."
-                            asyncio.run_coroutine_threadsafe(bot.send_message(int(user_chat_id), text), loop)
+                            asyncio.run_coroutine_threadsafe(message_dispatcher.send_message(bot, int(user_chat_id), text), loop)
                     except Exception as e:
                         logger.warning(f"Закрытие тикета: не удалось уведомить пользователя {ticket.get('user_id')} о закрытии тикета #{ticket_id}: {e}")
                     flash('Тикет закрыт.', 'success')
@@ -1217,7 +1406,7 @@ def create_webhook_app(bot_controller_instance):
                         user_chat_id = ticket.get('user_id')
                         if bot and loop and loop.is_running() and user_chat_id:
                             text = f"🔓 Ваш тикет #{ticket_id} снова открыт. Вы можете продолжить переписку."
-                            asyncio.run_coroutine_threadsafe(bot.send_message(int(user_chat_id), text), loop)
+                            asyncio.run_coroutine_threadsafe(message_dispatcher.send_message(bot, int(user_chat_id), text), loop)
                     except Exception as e:
                         logger.warning(f"Открытие тикета: не удалось уведомить пользователя {ticket.get('user_id')} об открытии тикета #{ticket_id}: {e}")
                     flash('Тикет открыт.', 'success')
@@ -1570,11 +1759,11 @@ def create_webhook_app(bot_controller_instance):
                 loop = current_app.config.get('EVENT_LOOP')
                 if loop and loop.is_running():
                     asyncio.run_coroutine_threadsafe(
-                        bot.send_message(chat_id=user_id, text=text, reply_markup=kb.as_markup()),
+                        message_dispatcher.send_message(bot, user_id, text, reply_markup=kb.as_markup(), priority=message_dispatcher.PRIORITY_ALERT),
                         loop
                     )
                 else:
-                    asyncio.run(bot.send_message(chat_id=user_id, text=text, reply_markup=kb.as_markup()))
+                    asyncio.run(message_dispatcher.send_message(bot, user_id, text, reply_markup=kb.as_markup(), priority=message_dispatcher.PRIORITY_ALERT))
         except Exception as e:
             logger.warning(f"Не удалось отправить уведомление о бане пользователю {user_id}: {e}")
         return redirect(url_for('users_page'))
@@ -1594,11 +1783,11 @@ def create_webhook_app(bot_controller_instance):
                 loop = current_app.config.get('EVENT_LOOP')
                 if loop and loop.is_running():
                     asyncio.run_coroutine_threadsafe(
-                        bot.send_message(chat_id=user_id, text=text, reply_markup=kb.as_markup()),
+                        message_dispatcher.send_message(bot, user_id, text, reply_markup=kb.as_markup(), priority=message_dispatcher.PRIORITY_ALERT),
                         loop
                     )
                 else:
-                    asyncio.run(bot.send_message(chat_id=user_id, text=text, reply_markup=kb.as_markup()))
+                    asyncio.run(message_dispatcher.send_message(bot, user_id, text, reply_markup=kb.as_markup(), priority=message_dispatcher.PRIORITY_ALERT))
         except Exception as e:
             logger.warning(f"Не удалось отправить уведомление о разбане пользователю {user_id}: {e}")
         return redirect(url_for('users_page'))
@@ -1606,48 +1795,12 @@ def create_webhook_app(bot_controller_instance):
     @flask_app.route('/users/revoke/<int:user_id>', methods=['POST'])
     @login_required
     def revoke_keys_route(user_id):
-        keys_to_revoke = get_user_keys(user_id)
-        success_count = 0
-        total = len(keys_to_revoke)
-
-        for key in keys_to_revoke:
-            result = asyncio.run(xui_api.delete_client_on_host(key['host_name'], key['key_email']))
-            if result:
-                success_count += 1
-
-        # удаляем из БД все ключи пользователя
-        delete_user_keys(user_id)
-
-        # уведомление пользователю в Telegram
-        try:
-            bot = _bot_controller.get_bot_instance()
-            if bot:
-                text = (
-                    "❌ Ваши VPN‑ключи были отозваны администратором.\n"
-                    f"Всего ключей: {total}\n"
-                    f"Отозвано: {success_count}"
-                )
-                loop = current_app.config.get('EVENT_LOOP')
-                if loop and loop.is_running():
-                    asyncio.run_coroutine_threadsafe(bot.send_message(chat_id=user_id, text=text), loop)
-                else:
-                    asyncio.run(bot.send_message(chat_id=user_id, text=text))
-        except Exception:
-            pass
-
-        message = (
-            f"Все {total} ключей для пользователя {user_id} были успешно отозваны." if success_count == total
-            else f"Удалось отозвать {success_count} из {total} ключей для пользователя {user_id}. Проверьте логи."
+        return _start_job(
+            'revoke_keys', f"Отзыв ключей пользователя {user_id}",
+            admin_jobs.revoke_user_keys_job(_bot_controller.get_bot_instance(), user_id),
+            url_for('users_page'),
+            dedup_key=f"revoke:{user_id}",
         )
-        category = 'success' if success_count == total else 'warning'
-
-        # Если это AJAX-запрос (из таблицы пользователей) — возвращаем JSON
-        wants_json = 'application/json' in (request.headers.get('Accept') or '') or request.headers.get('X-Requested-With') == 'XMLHttpRequest'
-        if wants_json:
-            return jsonify({"ok": success_count == total, "message": message, "revoked": success_count, "total": total}), 200
-
-        flash(message, category)
-        return redirect(url_for('users_page'))
 
     @flask_app.route('/add-host', methods=['POST'])
     @login_required
@@ -1713,23 +1866,33 @@ def create_webhook_app(bot_controller_instance):
             flash('Не удалось обновить тариф (возможно, он не найден).', 'danger')
         return redirect(url_for('settings_page', tab='hosts'))
 
+    def _accept_payment(provider: str, external_id, metadata: dict) -> bool:
+        """Сохраняет подтверждённый платёж в очередь и будит воркер бота. Обработка — асинхронно, с повторами.
+        False — запись в БД не удалась: отвечаем провайдеру ошибкой, чтобы он прислал уведомление ещё раз."""
+        if database.is_payment_processed_cached(metadata.get('payment_id')):
+            logger.info(f"{provider}: повторное уведомление по уже обработанному платежу {metadata.get('payment_id')}")
+            return True
+        if not database.enqueue_payment_event(provider, external_id, metadata):
+            return False
+        _wake_payment_worker()
+        return True
+
+    def _wake_payment_worker() -> None:
+        loop = current_app.config.get('EVENT_LOOP')
+        if loop and loop.is_running():
+            loop.call_soon_threadsafe(payment_inbox.wake)
+
     @csrf.exempt
     @flask_app.route('/yookassa-webhook', methods=['POST'])
     def yookassa_webhook_handler():
         try:
             event_json = request.json
             if event_json.get("event") == "payment.succeeded":
-                metadata = event_json.get("object", {}).get("metadata", {})
-                
-                bot = _bot_controller.get_bot_instance()
-                payment_processor = handlers.process_successful_payment
+                payment_object = event_json.get("object", {})
+                metadata = payment_object.get("metadata", {})
 
-                if metadata and bot is not None and payment_processor is not None:
-                    loop = current_app.config.get('EVENT_LOOP')
-                    if loop and loop.is_running():
-                        asyncio.run_coroutine_threadsafe(payment_processor(bot, metadata), loop)
-                    else:
-                        logger.error("YooKassa вебхук: цикл событий недоступен!")
+                if metadata and not _accept_payment("yookassa", payment_object.get("id"), metadata):
+                    return 'Error', 500
             return 'OK', 200
         except Exception as e:
             logger.error(f"Ошибка в обработчике вебхука YooKassa: {e}", exc_info=True)
@@ -1769,14 +1932,8 @@ def create_webhook_app(bot_controller_instance):
                     "promo_code": (parts[9] if len(parts) > 9 and parts[9] else None),
                 }
                 
-                bot = _bot_controller.get_bot_instance()
-                loop = current_app.config.get('EVENT_LOOP')
-                payment_processor = handlers.process_successful_payment
-
-                if bot and loop and loop.is_running():
-                    asyncio.run_coroutine_threadsafe(payment_processor(bot, metadata), loop)
-                else:
-                    logger.error("CryptoBot вебхук: не удалось обработать платёж — бот или цикл событий не запущены.")
+                if not _accept_payment("cryptobot", payload_data.get('invoice_id'), metadata):
+                    return 'Error', 500
 
             return 'OK', 200
             
@@ -1895,10 +2052,14 @@ def create_webhook_app(bot_controller_instance):
                 f.write(f"Calling find_and_complete_pending_transaction for {payment_id}...\n")
             print(f"Calling find_and_complete_pending_transaction for {payment_id}...", flush=True)
             
+            # Статус paid и запись в очередь платежей — одна транзакция SQLite: при ошибке (500) провайдер
+            # повторит уведомление, и транзакция всё ещё будет в статусе pending
             metadata = find_and_complete_pending_transaction(
                 payment_id=payment_id,
                 amount_rub=withdraw_amount,
-                payment_method='YooMoney'
+                payment_method='YooMoney',
+                enqueue_as='yoomoney',
+                external_id=data.get('operation_id') or payment_id,
             )
             
             with open(log_file, "a", encoding="utf-8") as f:
@@ -1912,26 +2073,12 @@ def create_webhook_app(bot_controller_instance):
                 print("Transaction not found or already processed", flush=True)
                 return 'OK', 200
             
-            # 2. Зачисляем средства пользователю / выдаем ключ
-            bot = _bot_controller.get_bot_instance()
-            loop = current_app.config.get('EVENT_LOOP')
-            payment_processor = handlers.process_successful_payment
-            
-            with open(log_file, "a", encoding="utf-8") as f:
-                f.write(f"Bot: {bot}, Loop: {loop}, Loop Running: {loop.is_running() if loop else 'N/A'}\n")
-            print(f"Bot: {bot}, Loop: {loop}, Loop Running: {loop.is_running() if loop else 'N/A'}", flush=True)
+            # 2. Зачисляем средства пользователю / выдаем ключ (платёж уже в очереди, будим воркер)
+            _wake_payment_worker()
 
-            if bot and loop and loop.is_running():
-                asyncio.run_coroutine_threadsafe(payment_processor(bot, metadata), loop)
-                logger.info(f"YooMoney webhook: платёж {payment_id} успешно обработан")
-                with open(log_file, "a", encoding="utf-8") as f:
-                    f.write("Payment processor scheduled\n")
-                print("Payment processor scheduled", flush=True)
-            else:
-                logger.error("YooMoney webhook: бот или цикл событий не запущены")
-                with open(log_file, "a", encoding="utf-8") as f:
-                    f.write("Bot or loop not running\n")
-                print("Bot or loop not running", flush=True)
+            logger.info(f"YooMoney webhook: платёж {payment_id} принят в обработку")
+            with open(log_file, "a", encoding="utf-8") as f:
+                f.write("Payment enqueued\n")
 
             return 'OK', 200
 
@@ -1969,13 +2116,9 @@ def create_webhook_app(bot_controller_instance):
                 if not metadata_str: return 'Error', 400
                 
                 metadata = json.loads(metadata_str)
-                
-                bot = _bot_controller.get_bot_instance()
-                loop = current_app.config.get('EVENT_LOOP')
-                payment_processor = handlers.process_successful_payment
 
-                if bot and loop and loop.is_running():
-                    asyncio.run_coroutine_threadsafe(payment_processor(bot, metadata), loop)
+                if not _accept_payment("heleket", data.get('uuid') or data.get('order_id'), metadata):
+                    return 'Error', 500
             
             return 'OK', 200
         except Exception as e:
@@ -1998,16 +2141,12 @@ def create_webhook_app(bot_controller_instance):
                         amount_nano = int(in_msg.get('value', 0))
                         amount_ton = float(amount_nano / 1_000_000_000)
 
-                        metadata = find_and_complete_ton_transaction(payment_id, amount_ton)
+                        # Статус paid и запись в очередь платежей — одна транзакция SQLite
+                        metadata = find_and_complete_ton_transaction(payment_id, amount_ton, enqueue_as="ton")
                         
                         if metadata:
                             logger.info(f"TON Платеж успешен для payment_id: {payment_id}")
-                            bot = _bot_controller.get_bot_instance()
-                            loop = current_app.config.get('EVENT_LOOP')
-                            payment_processor = handlers.process_successful_payment
-
-                            if bot and loop and loop.is_running():
-                                asyncio.run_coroutine_threadsafe(payment_processor(bot, metadata), loop)
+                            _wake_payment_worker()
             
             return 'OK', 200
         except Exception as e:
@@ -2280,22 +2419,14 @@ def create_webhook_app(bot_controller_instance):
                 
                 logger.info(f"Unitpay pay: {order_sum} RUB, account: {payment_id}")
                 
-                try:
-                    bot = _bot_controller.get_bot_instance()
-                    if bot:
-                        from shop_bot.data_manager.database import get_transaction_by_payment_id
-                        from shop_bot.bot.handlers import process_successful_payment
-                        
-                        tx = get_transaction_by_payment_id(payment_id)
-                        if tx:
-                            metadata = tx.get('metadata', {})
-                            metadata['amount'] = order_sum
-                            loop = current_app.config.get('EVENT_LOOP')
-                            if loop and loop.is_running():
-                                asyncio.run_coroutine_threadsafe(process_successful_payment(bot, metadata), loop)
-                except Exception as e:
-                    logger.error(f"Unitpay notify error: {e}")
-                    
+                from shop_bot.data_manager.database import get_transaction_by_payment_id
+
+                tx = get_transaction_by_payment_id(payment_id)
+                if tx:
+                    metadata = json.loads(tx.get('metadata') or '{}')
+                    if not _accept_payment("unitpay", up_params.get('unitpayId') or payment_id, metadata):
+                        return jsonify({'error': {'message': 'Temporary error'}}), 500
+
                 return jsonify({'result': {'message': 'Success'}}), 200
                 
             elif method == 'error':
@@ -2331,22 +2462,14 @@ def create_webhook_app(bot_controller_instance):
             
             logger.info(f"Freekassa payment: {amount}, order: {merchant_order_id}")
             
-            try:
-                bot = _bot_controller.get_bot_instance()
-                if bot:
-                    from shop_bot.data_manager.database import get_transaction_by_payment_id
-                    from shop_bot.bot.handlers import process_successful_payment
-                    
-                    tx = get_transaction_by_payment_id(merchant_order_id)
-                    if tx:
-                        metadata = tx.get('metadata', {})
-                        metadata['amount'] = float(amount)
-                        loop = current_app.config.get('EVENT_LOOP')
-                        if loop and loop.is_running():
-                            asyncio.run_coroutine_threadsafe(process_successful_payment(bot, metadata), loop)
-            except Exception as e:
-                logger.error(f"Freekassa notify error: {e}")
-            
+            from shop_bot.data_manager.database import get_transaction_by_payment_id
+
+            tx = get_transaction_by_payment_id(merchant_order_id)
+            if tx:
+                metadata = json.loads(tx.get('metadata') or '{}')
+                if not _accept_payment("freekassa", intid or merchant_order_id, metadata):
+                    return 'Error', 500
+
             return 'YES', 200
         except Exception as e:
             logger.error(f"Freekassa webhook error: {e}", exc_info=True)
@@ -2375,22 +2498,14 @@ def create_webhook_app(bot_controller_instance):
             
             logger.info(f"Enot.io payment: {amount}, order: {merchant_id}")
             
-            try:
-                bot = _bot_controller.get_bot_instance()
-                if bot:
-                    from shop_bot.data_manager.database import get_transaction_by_payment_id
-                    from shop_bot.bot.handlers import process_successful_payment
-                    
-                    tx = get_transaction_by_payment_id(merchant_id)
-                    if tx:
-                        metadata = tx.get('metadata', {})
-                        metadata['amount'] = float(amount)
-                        loop = current_app.config.get('EVENT_LOOP')
-                        if loop and loop.is_running():
-                            asyncio.run_coroutine_threadsafe(process_successful_payment(bot, metadata), loop)
-            except Exception as e:
-                logger.error(f"Enot.io notify error: {e}")
-            
+            from shop_bot.data_manager.database import get_transaction_by_payment_id
+
+            tx = get_transaction_by_payment_id(merchant_id)
+            if tx:
+                metadata = json.loads(tx.get('metadata') or '{}')
+                if not _accept_payment("enot", request.form.get('invoice_id') or merchant_id, metadata):
+                    return 'Error', 500
+
             return 'OK', 200
         except Exception as e:
             logger.error(f"Enot.io webhook error: {e}", exc_info=True)
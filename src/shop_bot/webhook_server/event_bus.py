@@ -0,0 +1,150 @@
+import json
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Iterator
+
+from shop_bot.data_manager import database
+
+logger = logging.getLogger(__name__)
+
+# Шина событий для живого обновления панели (Server-Sent Events).
+# Один поток-наблюдатель на процесс сверяет версии данных (data_versions, их увеличивают триггеры
+# при любой записи — из бота, планировщика или панели) и статусы ботов, и рассылает изменения
+# всем открытым потокам. Нагрузка на БД — один лёгкий запрос в секунду, независимо от числа вкладок,
+# и только пока есть хотя бы один подписчик.
+WATCH_INTERVAL_SECONDS = 1.0
+HEARTBEAT_SECONDS = 15
+# Поток переоткрывается браузером автоматически; ограничение срока освобождает поток waitress
+STREAM_MAX_SECONDS = 300
+RECONNECT_MS = 3000
+SUBSCRIBER_QUEUE_SIZE = 100
+
+_subscribers: set[queue.Queue] = set()
+_lock = threading.Lock()
+_watcher: threading.Thread | None = None
+_status_sources: dict[str, Callable[[], dict]] = {}
+_closing = False
+
+
+def register_status_source(name: str, get_status: Callable[[], dict]) -> None:
+    """Источник статуса (например, бота): изменения is_running рассылаются событием status."""
+    _status_sources[name] = get_status
+
+
+def publish(event_type: str, data: dict) -> None:
+    with _lock:
+        subscribers = list(_subscribers)
+    for q in subscribers:
+        try:
+            q.put_nowait((event_type, data))
+        except queue.Full:
+            # Вкладка не успевает читать — пусть перечитает всё целиком
+            try:
+                while True:
+                    q.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                q.put_nowait(("resync", {}))
+            except queue.Full:
+                pass
+
+
+def subscribe(limit: int | None = None) -> queue.Queue | None:
+    """Новый подписчик; None — достигнут предел одновременных потоков или идёт остановка."""
+    global _watcher
+    with _lock:
+        if _closing or (limit is not None and len(_subscribers) >= limit):
+            return None
+        q: queue.Queue = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        _subscribers.add(q)
+        if _watcher is None or not _watcher.is_alive():
+            _watcher = threading.Thread(target=_watch, name="event-bus", daemon=True)
+            _watcher.start()
+    return q
+
+
+def unsubscribe(q: queue.Queue) -> None:
+    with _lock:
+        _subscribers.discard(q)
+
+
+def subscriber_count() -> int:
+    with _lock:
+        return len(_subscribers)
+
+
+def shutdown() -> None:
+    """Закрывает все потоки (при остановке сервера), чтобы они не держали рабочие потоки."""
+    global _closing
+    with _lock:
+        _closing = True
+        subscribers = list(_subscribers)
+    for q in subscribers:
+        try:
+            q.put_nowait(None)
+        except queue.Full:
+            pass
+
+
+def _read_statuses() -> dict:
+    statuses = {}
+    for name, get_status in list(_status_sources.items()):
+        try:
+            statuses[name] = bool((get_status() or {}).get("is_running"))
+        except Exception:
+            continue
+    return statuses
+
+
+def _watch() -> None:
+    global _watcher
+    domains = tuple(dict.fromkeys(database.DATA_VERSION_TABLES.values()))
+    last_versions = database.get_data_versions(*domains)
+    last_statuses = _read_statuses()
+    while True:
+        time.sleep(WATCH_INTERVAL_SECONDS)
+        with _lock:
+            if not _subscribers or _closing:
+                _watcher = None
+                return
+        try:
+            versions = database.get_data_versions(*domains)
+            if versions is not None and last_versions is not None and versions != last_versions:
+                changed = [d for d, old, new in zip(domains, last_versions, versions) if old != new]
+                publish("data", {"domains": changed})
+            if versions is not None:
+                last_versions = versions
+            statuses = _read_statuses()
+            for name, running in statuses.items():
+                if last_statuses.get(name) != running:
+                    publish("status", {"name": name, "is_running": running})
+            last_statuses = statuses
+        except Exception as e:
+            logger.debug(f"Шина событий: ошибка опроса изменений: {e}")
+
+
+def _format(event_type: str, data: dict) -> str:
+    return f"event: {event_type}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def stream(q: queue.Queue) -> Iterator[str]:
+    """Тело ответа text/event-stream для подписчика q."""
+    deadline = time.monotonic() + STREAM_MAX_SECONDS
+    try:
+        yield f"retry: {RECONNECT_MS}\n\n"
+        yield _format("hello", {"statuses": _read_statuses()})
+        while time.monotonic() < deadline:
+            try:
+                item = q.get(timeout=HEARTBEAT_SECONDS)
+            except queue.Empty:
+                # Комментарий-пинг: держит соединение и обнаруживает закрытые вкладки
+                yield ": ping\n\n"
+                continue
+            if item is None:
+                return
+            yield _format(*item)
+    finally:
+        unsubscribe(q)
@@ -0,0 +1,64 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable
+
+from flask import Response, request
+
+from shop_bot.data_manager import database
+
+# Кэш ответов для опрашиваемых фрагментов панели (partials/JSON).
+# Ответ хранится вместе с версией данных, из которых он собран: пока версия не изменилась,
+# повторный опрос не трогает таблицы и шаблоны, а браузер с тем же ETag получает 304 без тела.
+RESPONSE_CACHE_MAX_ENTRIES = 256
+
+_entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+_lock = threading.Lock()
+
+
+def _make_etag(key: tuple, version) -> str:
+    return hashlib.sha1(repr((key, version)).encode("utf-8")).hexdigest()[:24]
+
+
+def _finalize(resp: Response, etag: str | None) -> Response:
+    if etag:
+        resp.set_etag(etag)
+    # Браузер может хранить ответ, но обязан сверять ETag перед использованием
+    resp.headers["Cache-Control"] = "private, max-age=0, must-revalidate"
+    return resp
+
+
+def cached_response(key: tuple, domains: tuple[str, ...], build: Callable[[], Response | str], extra_version=None) -> Response:
+    """Отдаёт ответ из кэша, пока версии доменов данных (и extra_version) не изменились.
+
+    build() вызывается только при промахе и возвращает Response или HTML-строку.
+    """
+    versions = database.get_data_versions(*domains) if domains else ()
+    if versions is None:
+        # Версии недоступны — работаем без кэша
+        result = build()
+        return _finalize(result if isinstance(result, Response) else Response(result, mimetype="text/html"), None)
+
+    version = (versions, extra_version, database.get_ui_config_version())
+    etag = _make_etag(key, version)
+    # Слабое сравнение: сжатый ответ уходит со слабым ETag (static_assets.compress_json_response)
+    if request.if_none_match.contains_weak(etag):
+        return _finalize(Response(status=304), etag)
+
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None and entry[0] == version:
+            _entries.move_to_end(key)
+            body, mimetype = entry[1], entry[2]
+            return _finalize(Response(body, mimetype=mimetype), etag)
+
+    result = build()
+    resp = result if isinstance(result, Response) else Response(result, mimetype="text/html")
+    if resp.status_code != 200:
+        return _finalize(resp, None)
+    with _lock:
+        _entries[key] = (version, resp.get_data(), resp.mimetype)
+        _entries.move_to_end(key)
+        while len(_entries) > RESPONSE_CACHE_MAX_ENTRIES:
+            _entries.popitem(last=False)
+    return _finalize(resp, etag)
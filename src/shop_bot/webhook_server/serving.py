@@ -0,0 +1,152 @@
+import logging
+import time
+
+from shop_bot.data_manager import database
+
+try:
+    from waitress.server import create_server
+    from waitress.task import ThreadedTaskDispatcher
+    waitress_available = True
+except ImportError:
+    waitress_available = False
+
+logger = logging.getLogger(__name__)
+
+# Рабочий HTTP-сервер для веб-панели и платёжных вебхуков (waitress).
+# Запросы разбираются на два независимых пула потоков: вебхуки платёжных систем не ждут в очереди
+# за медленными страницами админки.
+DEFAULT_HOST = "0.0.0.0"
+DEFAULT_PORT = 1488
+DEFAULT_ADMIN_WORKERS = 8
+DEFAULT_WEBHOOK_WORKERS = 8
+DEFAULT_REQUEST_TIMEOUT = 30
+DEFAULT_MAX_CONNECTIONS = 200
+MAX_WORKERS = 64
+DRAIN_TIMEOUT_SECONDS = 15
+
+_server = None
+_dispatcher = None
+
+
+def is_webhook_path(path: str) -> bool:
+    return (path or "").rstrip("/").endswith("-webhook")
+
+
+def _int_setting(key: str, default: int, low: int, high: int) -> int:
+    try:
+        value = int(database.get_setting(key) or default)
+    except (TypeError, ValueError):
+        value = default
+    return max(low, min(high, value))
+
+
+def get_serving_config() -> dict:
+    return {
+        "mode": (database.get_setting("http_server_mode") or "production").strip().lower(),
+        "admin_workers": _int_setting("http_admin_workers", DEFAULT_ADMIN_WORKERS, 1, MAX_WORKERS),
+        "webhook_workers": _int_setting("http_webhook_workers", DEFAULT_WEBHOOK_WORKERS, 1, MAX_WORKERS),
+        "request_timeout": _int_setting("http_request_timeout", DEFAULT_REQUEST_TIMEOUT, 5, 600),
+        "max_connections": _int_setting("http_max_connections", DEFAULT_MAX_CONNECTIONS, 10, 5000),
+    }
+
+
+def max_event_streams() -> int:
+    """Сколько потоков SSE можно держать одновременно: каждый занимает поток пула админки,
+    поэтому под них отдаётся не больше половины пула."""
+    config = get_serving_config()
+    if config["mode"] == "development" or not waitress_available:
+        return MAX_WORKERS
+    return max(1, config["admin_workers"] // 2)
+
+
+class _RoutingTaskDispatcher:
+    """Диспетчер задач waitress с двумя пулами: по пути запроса выбирается пул вебхуков или админки."""
+
+    def __init__(self, admin_workers: int, webhook_workers: int):
+        self.admin = ThreadedTaskDispatcher()
+        self.webhook = ThreadedTaskDispatcher()
+        self.admin.set_thread_count(admin_workers)
+        self.webhook.set_thread_count(webhook_workers)
+
+    def set_thread_count(self, count: int) -> None:
+        # Размеры пулов задаются в конструкторе, общий threads из настроек waitress не используется
+        pass
+
+    def add_task(self, task) -> None:
+        # Задача waitress — канал (соединение); обрабатывается первый запрос из его очереди
+        requests = getattr(task, "requests", None) or []
+        path = getattr(requests[0], "path", "") if requests else ""
+        (self.webhook if is_webhook_path(path) else self.admin).add_task(task)
+
+    def is_idle(self) -> bool:
+        for pool in (self.admin, self.webhook):
+            with pool.lock:
+                if pool.queue or pool.active_count > 0:
+                    return False
+        return True
+
+    def shutdown(self, cancel_pending: bool = True, timeout: float = 5) -> bool:
+        self.admin.shutdown(cancel_pending, timeout)
+        self.webhook.shutdown(cancel_pending, timeout)
+        return True
+
+
+def serve(flask_app, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT) -> None:
+    """Запускает веб-панель в текущем потоке (блокирует до остановки процесса)."""
+    global _server, _dispatcher
+    config = get_serving_config()
+    if config["mode"] != "development" and not waitress_available:
+        logger.warning("HTTP-сервер: пакет waitress не установлен, использую отладочный сервер Werkzeug.")
+    if config["mode"] == "development" or not waitress_available:
+        logger.info(f"HTTP-сервер (Werkzeug dev server) запущен: http://{host}:{port}")
+        flask_app.run(host=host, port=port, use_reloader=False, debug=False)
+        return
+    dispatcher = _RoutingTaskDispatcher(config["admin_workers"], config["webhook_workers"])
+    server = create_server(
+        flask_app,
+        _dispatcher=dispatcher,
+        host=host,
+        port=port,
+        # Простаивающее keep-alive соединение и медленный клиент закрываются по этому таймауту
+        channel_timeout=config["request_timeout"],
+        connection_limit=config["max_connections"],
+        backlog=256,
+        asyncore_use_poll=True,
+        ident="shopbot",
+    )
+    _server, _dispatcher = server, dispatcher
+    logger.info(
+        f"HTTP-сервер запущен: http://{host}:{port} (админка {config['admin_workers']}, "
+        f"вебхуки {config['webhook_workers']} потоков, таймаут {config['request_timeout']} с)"
+    )
+    server.run()
+
+
+def stop(timeout: float = DRAIN_TIMEOUT_SECONDS) -> None:
+    """Плавная остановка: перестаём принимать соединения и даём текущим запросам доработать."""
+    global _server, _dispatcher
+    server, dispatcher = _server, _dispatcher
+    if server is None or dispatcher is None:
+        return
+    _server = _dispatcher = None
+
+    def _stop_accepting():
+        # Выполняется в потоке цикла waitress: закрываем слушающий сокет и простаивающие keep-alive соединения
+        server.accepting = False
+        server.del_channel()
+        server.socket.close()
+        for channel in list(server.active_channels.values()):
+            if not channel.requests:
+                channel.will_close = True
+
+    server.trigger.pull_trigger(_stop_accepting)
+    deadline = time.monotonic() + timeout
+    drained = dispatcher.is_idle()
+    while not drained and time.monotonic() < deadline:
+        time.sleep(0.1)
+        drained = dispatcher.is_idle()
+    dispatcher.shutdown(cancel_pending=True, timeout=1)
+    if drained:
+        logger.info("HTTP-сервер остановлен, все запросы завершены.")
+    else:
+        logger.warning("HTTP-сервер остановлен, часть запросов не успела завершиться.")
@@ -27,6 +27,70 @@ document.addEventListener('DOMContentLoaded', function () {
         if (s.includes('<head') && s.includes('<title') && s.includes('</html>')) return true;
         return false;
     }
+    // Фоновые задачи панели: индикатор прогресса с отменой, опрос статуса до завершения
+    window.trackJob = function(jobId, opts){
+        const options = opts || {};
+        const statusUrl = options.statusUrl || `/admin/jobs/${jobId}.json`;
+        let box = document.getElementById('admin-jobs-box');
+        if (!box) {
+            box = document.createElement('div');
+            box.id = 'admin-jobs-box';
+            box.className = 'position-fixed bottom-0 start-0 p-3';
+            box.style.zIndex = '1080';
+            box.style.width = '320px';
+            document.body.appendChild(box);
+        }
+        const card = document.createElement('div');
+        card.className = 'card glass mb-2';
+        card.innerHTML = '<div class="card-body p-2"><div class="d-flex align-items-center gap-2 mb-1">'
+            + '<div class="small fw-semibold text-truncate flex-grow-1" data-job-title>Задача #' + jobId + '</div>'
+            + '<button type="button" class="btn btn-sm btn-outline-danger py-0" data-job-cancel>Отменить</button></div>'
+            + '<div class="progress progress-sm"><div class="progress-bar" data-job-bar style="width:0%"></div></div>'
+            + '<div class="tiny text-secondary mt-1" data-job-text>В очереди…</div></div>';
+        box.appendChild(card);
+        const titleEl = card.querySelector('[data-job-title]');
+        const barEl = card.querySelector('[data-job-bar]');
+        const textEl = card.querySelector('[data-job-text]');
+        card.querySelector('[data-job-cancel]').addEventListener('click', async () => {
+            const fd = new FormData();
+            fd.append('csrf_token', getCsrfToken());
+            try { await fetch(`/admin/jobs/${jobId}/cancel`, { method: 'POST', body: fd, credentials: 'same-origin' }); } catch(_){ }
+        });
+        async function poll(){
+            let job = null;
+            try {
+                const resp = await fetch(statusUrl, { headers: { 'Accept': 'application/json' }, cache: 'no-store', credentials: 'same-origin' });
+                const data = await resp.json();
+                job = data && data.job;
+            } catch(_){ }
+            if (!job) { setTimeout(poll, 3000); return; }
+            titleEl.textContent = job.title || titleEl.textContent;
+            barEl.style.width = (job.percent || 0) + '%';
+            textEl.textContent = job.total ? `${job.done}/${job.total}` + (job.failed ? `, ошибок: ${job.failed}` : '') : (job.status === 'queued' ? 'В очереди…' : 'Выполняется…');
+            if (job.status === 'queued' || job.status === 'running') { setTimeout(poll, 1500); return; }
+            card.remove();
+            const category = job.status === 'done' ? (job.failed ? 'warning' : 'success') : (job.status === 'cancelled' ? 'secondary' : 'danger');
+            const text = job.message || job.error || (job.status === 'cancelled' ? 'Задача отменена' : 'Задача завершена');
+            try { window.showToast(category, text, 6000); } catch(_){ }
+            if (typeof options.onDone === 'function') { try { await options.onDone(job); } catch(_){ } }
+        }
+        poll();
+    };
+    // POST формы, которая ставит фоновую задачу; возвращает ответ сервера ({ok, job_id, status_url})
+    window.startJob = async function(form, opts){
+        const fd = new FormData(form);
+        if (!fd.get('csrf_token')) { const t = getCsrfToken(); if (t) fd.append('csrf_token', t); }
+        const resp = await fetch(form.action, { method: 'POST', body: fd, headers: { 'Accept': 'application/json' }, credentials: 'same-origin' });
+        let data = null;
+        try { data = await resp.json(); } catch(_){ }
+        if (!resp.ok || !data || !data.ok || !data.job_id) {
+            try { window.showToast('danger', (data && data.error) || 'Не удалось запустить задачу'); } catch(_){ }
+            return null;
+        }
+        window.trackJob(data.job_id, Object.assign({ statusUrl: data.status_url }, opts || {}));
+        return data;
+    };
+
     // Global partial refresh by container id
     window.refreshContainerById = async function(id){
         const node = document.getElementById(id);
@@ -34,7 +98,7 @@ document.addEventListener('DOMContentLoaded', function () {
         const url = node.getAttribute('data-fetch-url');
         if (!url) return;
         try {
-            const resp = await fetch(url, { headers: { 'Accept': 'text/html' }, cache: 'no-store', credentials: 'same-origin' });
+            const resp = await fetch(url, { headers: { 'Accept': 'text/html' }, cache: 'no-cache', credentials: 'same-origin' });
             if (resp.redirected) { window.location.href = resp.url; return; }
             if (resp.status === 401 || resp.status === 403) { window.location.href = '/login'; return; }
             if (!resp.ok) return;
@@ -188,6 +252,17 @@ document.addEventListener('DOMContentLoaded', function () {
                     event.preventDefault();
                     return;
                 }
+                // Фоновая задача: ставим и показываем прогресс, по завершении обновляем целевой блок
+                if (form.getAttribute('data-ajax') === 'job') {
+                    event.preventDefault();
+                    const targetId = form.getAttribute('data-refresh-target');
+                    try {
+                        await window.startJob(form, { onDone: async () => {
+                            if (targetId) { try { await window.refreshContainerById(targetId); } catch(_){ } }
+                        } });
+                    } catch(_){ try { window.showToast('danger', 'Не удалось запустить задачу'); } catch(__){} }
+                    return;
+                }
                 // AJAX delete
                 if (form.getAttribute('data-ajax') === 'delete') {
                     event.preventDefault();
@@ -380,15 +455,36 @@ document.addEventListener('DOMContentLoaded', function () {
             }
         });
 
+        // Выручка по дням (сумма по всем способам оплаты, без оплат с баланса)
+        const revenueChartCanvas = document.getElementById('revenueChart');
+        let revenueChart = null;
+        if (revenueChartCanvas) {
+            revenueChart = new Chart(revenueChartCanvas.getContext('2d'), {
+                type: 'bar',
+                data: prepareChartData(CHART_DATA.revenue || {}, 'Выручка, RUB', '#ae3ec9'),
+                options: {
+                    scales: {
+                        y: { beginAtZero: true, ticks: { font: { size: window.innerWidth <= 768 ? 10 : 12 }, display: true } },
+                        x: { ticks: { font: { size: window.innerWidth <= 768 ? 10 : 12 }, maxTicksLimit: window.innerWidth <= 768 ? 8 : 15, maxRotation: 45, minRotation: 45, display: true } }
+                    },
+                    responsive: true,
+                    maintainAspectRatio: false,
+                    layout: { autoPadding: true, padding: 0 },
+                    plugins: { legend: { display: true, labels: { font: { size: window.innerWidth <= 768 ? 12 : 14 } } } }
+                }
+            });
+        }
+
         window.addEventListener('resize', () => {
             updateChartFontsAndLabels(usersChart);
             updateChartFontsAndLabels(keysChart);
+            if (revenueChart) updateChartFontsAndLabels(revenueChart);
         });
 
         // --- Auto refresh charts data without page reload ---
         async function refreshCharts(){
             try{
-                const resp = await fetch('/dashboard/charts.json', { headers: { 'Accept': 'application/json' }, credentials: 'same-origin', cache: 'no-store' });
+                const resp = await fetch('/dashboard/charts.json', { headers: { 'Accept': 'application/json' }, credentials: 'same-origin', cache: 'no-cache' });
                 if (resp.redirected) { window.location.href = resp.url; return; }
                 if (resp.status === 401 || resp.status === 403) { window.location.href = '/login'; return; }
                 if (!resp.ok) return;
@@ -402,9 +498,19 @@ document.addEventListener('DOMContentLoaded', function () {
                 keysChart.data.datasets[0].data = newKeys.datasets[0].data;
                 usersChart.update('none');
                 keysChart.update('none');
+                if (revenueChart) {
+                    const revenue = prepareChartData(fresh.revenue || {}, 'Выручка, RUB', '#ae3ec9');
+                    revenueChart.data.labels = revenue.labels;
+                    revenueChart.data.datasets[0].data = revenue.datasets[0].data;
+                    revenueChart.update('none');
+                }
             }catch(_){/* noop */}
         }
-        setInterval(refreshCharts, 10000);
+        setInterval(() => { if (!window.__sseLive) refreshCharts(); }, 10000);
+        window.addEventListener('sse:data', (e) => {
+            const domains = (e.detail && e.detail.domains) || [];
+            if (domains.some(d => d === 'users' || d === 'keys' || d === 'transactions')) refreshCharts();
+        });
     }
 
     function initializeTicketAutoRefresh() {
@@ -505,7 +611,12 @@ document.addEventListener('DOMContentLoaded', function () {
         }
 
         fetchAndRender();
-        const interval = setInterval(fetchAndRender, 2500);
+        // При открытом потоке событий переписка перечитывается по событию tickets, таймер — запасной вариант
+        const interval = setInterval(() => { if (!window.__sseLive) fetchAndRender(); }, 2500);
+        window.addEventListener('sse:data', (e) => {
+            const domains = (e.detail && e.detail.domains) || [];
+            if (domains.includes('tickets')) fetchAndRender();
+        });
         window.addEventListener('beforeunload', () => clearInterval(interval));
     }
 
@@ -519,13 +630,15 @@ document.addEventListener('DOMContentLoaded', function () {
         const nodes = Array.from(document.querySelectorAll('[data-fetch-url]'));
         if (!nodes.length) return;
         nodes.forEach(node => {
-            const url = node.getAttribute('data-fetch-url');
             const interval = Number(node.getAttribute('data-fetch-interval')||'8000');
-            if (!url) return;
+            if (!node.getAttribute('data-fetch-url')) return;
             let timer = null;
             async function tick(){
                 try{
-                    const resp = await fetch(url, { headers: { 'Accept': 'text/html' }, cache: 'no-store', credentials: 'same-origin' });
+                    // URL читается на каждом тике: страница может менять его (фильтры, курсор)
+                    const url = node.getAttribute('data-fetch-url');
+                    if (!url) return;
+                    const resp = await fetch(url, { headers: { 'Accept': 'text/html' }, cache: 'no-cache', credentials: 'same-origin' });
                     if (resp.redirected) { window.location.href = resp.url; return; }
                     if (resp.status === 401 || resp.status === 403) { window.location.href = '/login'; return; }
                     if (!resp.ok) return;
@@ -551,12 +664,68 @@ document.addEventListener('DOMContentLoaded', function () {
                 }catch(_){/* noop */}
             }
             tick();
-            timer = setInterval(tick, Math.max(4000, interval));
+            node.__softRefresh = tick;
+            // Узлы с data-sse-domains при открытом потоке событий обновляются по событиям, а не по таймеру
+            timer = setInterval(() => {
+                if (window.__sseLive && node.hasAttribute('data-sse-domains')) return;
+                tick();
+            }, Math.max(4000, interval));
             node.addEventListener('soft-update-stop', ()=>{ if (timer){ clearInterval(timer); timer=null; } });
             window.addEventListener('beforeunload', ()=>{ if (timer){ clearInterval(timer); timer=null; } });
         });
     }
 
+    // Живые обновления (Server-Sent Events): один поток на вкладку вместо опроса фрагментов по таймерам.
+    // Узел с data-sse-domains перечитывается (data-fetch-url или data-sse-url), когда меняется один из его доменов;
+    // остальные модули слушают событие window 'sse:data'. Если поток недоступен, работают прежние таймеры.
+    function initializeLiveEvents() {
+        if (!window.EventSource) return;
+        if (!document.querySelector('[data-sse-domains]')) return;
+        let connectedOnce = false;
+
+        async function refreshNode(node){
+            if (node.__softRefresh) { await node.__softRefresh(); return; }
+            if (node.id && node.hasAttribute('data-fetch-url')) { await window.refreshContainerById(node.id); return; }
+            const url = node.getAttribute('data-sse-url');
+            if (!url) return;
+            try {
+                const resp = await fetch(url, { headers: { 'Accept': 'text/html' }, cache: 'no-cache', credentials: 'same-origin' });
+                if (!resp.ok) return;
+                const html = await resp.text();
+                if (html && !isFullDocument(html) && html !== node.innerHTML) {
+                    node.innerHTML = html;
+                    try { initTooltipsWithin(node); } catch(_){ }
+                    try { setupConfirmationForms(node); } catch(_){ }
+                }
+            } catch(_){ }
+        }
+        function refreshDomains(domains){
+            document.querySelectorAll('[data-sse-domains]').forEach(node => {
+                const own = (node.getAttribute('data-sse-domains') || '').split(/\s+/);
+                if (!domains || own.some(d => domains.includes(d))) refreshNode(node);
+            });
+            try { window.dispatchEvent(new CustomEvent('sse:data', { detail: { domains: domains || ['users', 'keys', 'transactions', 'hosts', 'tickets', 'metrics'] } })); } catch(_){ }
+        }
+
+        const source = new EventSource('/events/stream');
+        source.addEventListener('hello', () => {
+            window.__sseLive = true;
+            // После переподключения могли пропустить изменения — перечитываем всё один раз
+            if (connectedOnce) refreshDomains(null);
+            connectedOnce = true;
+        });
+        source.addEventListener('data', (e) => {
+            try { refreshDomains(JSON.parse(e.data).domains || []); } catch(_){ }
+        });
+        source.addEventListener('resync', () => refreshDomains(null));
+        source.addEventListener('status', () => refreshDomains(['bot']));
+        source.addEventListener('error', () => {
+            // Браузер переподключится сам; до этого работают таймеры
+            window.__sseLive = false;
+        });
+        window.addEventListener('beforeunload', () => { try { source.close(); } catch(_){ } });
+    }
+
     // Settings tabs: show/hide sections by hash and set active nav link
     function initializeSettingsTabs() {
         const nav = document.querySelector('.nav.nav-pills');
@@ -688,6 +857,7 @@ document.addEventListener('DOMContentLoaded', function () {
     initializeTicketAutoRefresh();
     // Автоперезагрузка выключена: initializeGlobalAutoRefresh();
     initializeSoftAutoUpdate();
+    initializeLiveEvents();
     initializeSettingsTabs();
     initializeThemeToggle();
     initializeCsrfForForms();
@@ -0,0 +1,144 @@
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+
+from flask import Flask, Response, current_app, request, send_from_directory
+
+try:
+    import brotli
+    brotli_available = True
+except ImportError:
+    brotli_available = False
+
+logger = logging.getLogger(__name__)
+
+# Раздача статики панели (css/js/img) и сжатие JSON-ответов.
+# При старте для каждого файла считается отпечаток содержимого: url_for('static', ...) добавляет его
+# в ссылку (?v=...), и такой URL кэшируется браузером «навсегда» — после обновления файла меняется сам URL.
+# Текстовые файлы сразу сжимаются в gzip (и brotli, если пакет установлен) и отдаются из памяти.
+STATIC_MAX_AGE_SECONDS = 365 * 24 * 3600
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.svg', '.json', '.txt', '.map', '.html'}
+# Меньше этого размера сжатие не окупает заголовки и работу процессора
+COMPRESS_MIN_BYTES = 1024
+JSON_GZIP_LEVEL = 5
+
+_assets: dict[str, dict] = {}
+
+
+def _scan(static_folder: str) -> dict[str, dict]:
+    assets = {}
+    for root, _dirs, files in os.walk(static_folder):
+        for name in files:
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, static_folder).replace(os.sep, '/')
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except OSError as e:
+                logger.warning(f"Статика: не удалось прочитать {rel}: {e}")
+                continue
+            entry = {'version': hashlib.sha1(data).hexdigest()[:12], 'variants': {}}
+            if os.path.splitext(name)[1].lower() in COMPRESSIBLE_EXTENSIONS and len(data) >= COMPRESS_MIN_BYTES:
+                entry['mimetype'] = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+                entry['variants']['identity'] = data
+                gz = gzip.compress(data, compresslevel=9, mtime=0)
+                if len(gz) < len(data):
+                    entry['variants']['gzip'] = gz
+                if brotli_available:
+                    br = brotli.compress(data, quality=11)
+                    if len(br) < len(data):
+                        entry['variants']['br'] = br
+            assets[rel] = entry
+    return assets
+
+
+def asset_version(filename: str) -> str | None:
+    entry = _assets.get(filename)
+    return entry['version'] if entry else None
+
+
+def _pick_encoding(variants: dict) -> str:
+    accepted = request.accept_encodings
+    for encoding in ('br', 'gzip'):
+        if encoding in variants and accepted[encoding]:
+            return encoding
+    return 'identity'
+
+
+def _cache_control(resp: Response, entry: dict) -> None:
+    if request.args.get('v') == entry['version']:
+        resp.headers['Cache-Control'] = f"public, max-age={STATIC_MAX_AGE_SECONDS}, immutable"
+    else:
+        # Ссылка без отпечатка (или со старым) — браузер сверяет ETag при каждом использовании
+        resp.headers['Cache-Control'] = "no-cache"
+
+
+def serve_static(filename: str):
+    entry = _assets.get(filename)
+    if entry is None:
+        # Файл появился после старта — обычная отдача Flask
+        return _fallback(filename)
+    variants = entry['variants']
+    if not variants:
+        # Картинки и мелкие файлы отдаются с диска (ETag и 304 — средствами Flask)
+        resp = _fallback(filename)
+        _cache_control(resp, entry)
+        return resp
+    encoding = _pick_encoding(variants)
+    etag = entry['version'] if encoding == 'identity' else f"{entry['version']}-{encoding}"
+    if request.if_none_match.contains_weak(etag):
+        resp = Response(status=304)
+    else:
+        resp = Response(variants[encoding], mimetype=entry['mimetype'])
+        if encoding != 'identity':
+            resp.headers['Content-Encoding'] = encoding
+    resp.set_etag(etag)
+    resp.headers['Vary'] = 'Accept-Encoding'
+    _cache_control(resp, entry)
+    return resp
+
+
+def _fallback(filename: str) -> Response:
+    return send_from_directory(current_app.static_folder, filename, max_age=0)
+
+
+def compress_json_response(resp: Response) -> Response:
+    """gzip для крупных JSON-ответов. Потоковые ответы (SSE, файлы) не трогаем."""
+    if (resp.mimetype != 'application/json' or resp.status_code != 200 or resp.is_streamed
+            or resp.direct_passthrough or 'Content-Encoding' in resp.headers):
+        return resp
+    if not request.accept_encodings['gzip']:
+        return resp
+    data = resp.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return resp
+    resp.set_data(gzip.compress(data, compresslevel=JSON_GZIP_LEVEL))
+    resp.headers['Content-Encoding'] = 'gzip'
+    resp.vary.add('Accept-Encoding')
+    # Тело зависит от кодировки: сильный ETag становится слабым (сравнение If-None-Match — слабое)
+    etag, weak = resp.get_etag()
+    if etag and not weak:
+        resp.set_etag(etag, weak=True)
+    return resp
+
+
+def init_app(flask_app: Flask) -> None:
+    global _assets
+    _assets = _scan(flask_app.static_folder)
+    compressed = sum(1 for e in _assets.values() if len(e['variants']) > 1)
+    logger.info(
+        f"Статика: {len(_assets)} файлов, предсжато {compressed} "
+        f"(gzip{', brotli' if brotli_available else ''})."
+    )
+
+    @flask_app.url_defaults
+    def add_static_fingerprint(endpoint, values):
+        if endpoint == 'static' and 'filename' in values and 'v' not in values:
+            version = asset_version(values['filename'])
+            if version:
+                values['v'] = version
+
+    flask_app.view_functions['static'] = serve_static
+    flask_app.after_request(compress_json_response)